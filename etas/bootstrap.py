@@ -0,0 +1,290 @@
+##############################################################################
+# parametric bootstrap of the ETAS inversion
+#
+# synthetic catalogs are simulated from fitted parameters with
+# generate_catalog and inverted with ETASParameterCalculation in worker
+# processes. each catalog has its own seed, derived from one root seed, such
+# that the results do not depend on the number of processes or on the order
+# in which catalogs finish. results are appended to a json lines file as soon
+# as a catalog is done, and catalogs which are already in the file are
+# skipped when the bootstrap is run again.
+##############################################################################
+
+import json
+import logging
+import numbers
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from etas.geometry import Region
+from etas.inversion import ETASParameterCalculation, read_shape_coords
+from etas.simulation import generate_catalog
+
+logger = logging.getLogger(__name__)
+
+# settings shared with the worker processes of bootstrap_inversion. the
+# region is prepared once per process
+bootstrap_setup = None
+
+
+def init_bootstrap_worker(setup):
+    global bootstrap_setup
+    bootstrap_setup = dict(setup)
+    bootstrap_setup["region"] = Region(
+        read_shape_coords(setup["metadata"]["shape_coords"]))
+
+
+def run_bootstrap_catalog(catalog_id, seed):
+    """
+    Simulates catalog catalog_id with the given seed and inverts it with
+    the settings of the worker. Returns the result as a json-serializable
+    dict.
+    """
+    setup = bootstrap_setup
+    metadata = setup["metadata"]
+
+    # generate_catalog draws from the global random state
+    np.random.seed(seed)
+    catalog = generate_catalog(
+        polygon=setup["region"],
+        timewindow_start=pd.to_datetime(setup["burn_start"]),
+        timewindow_end=pd.to_datetime(metadata["timewindow_end"]),
+        parameters=setup["parameters"],
+        mc=metadata["mc"],
+        beta_main=setup["beta"],
+        delta_m=metadata.get("delta_m", 0),
+    )
+    catalog = catalog[["latitude", "longitude", "time", "magnitude"]]
+    catalog.index.name = "id"
+
+    catalog_metadata = dict(
+        metadata,
+        catalog=catalog,
+        id="{}_bootstrap_{}".format(metadata.get("id", "etas"), catalog_id),
+    )
+    # synthetic catalogs are not inverted again, their pairs are not cached
+    catalog_metadata.pop("fn_catalog", None)
+    catalog_metadata.pop("pair_cache_dir", None)
+    catalog_metadata.setdefault("theta_0", setup["parameters"])
+    if metadata.get("pair_chunk_dir") is not None:
+        # pairs of catalogs which are inverted at the same time must not
+        # be written to the same directory
+        catalog_metadata["pair_chunk_dir"] = os.path.join(
+            metadata["pair_chunk_dir"], "bootstrap_{}".format(catalog_id))
+
+    calculation = ETASParameterCalculation(catalog_metadata)
+    calculation.region = setup["region"]
+    calculation.prepare()
+    theta = calculation.invert()
+
+    return {
+        "catalog": catalog_id,
+        "seed": seed,
+        "root_entropy": setup["root_entropy"],
+        "n_events": len(catalog),
+        "n_target_events": len(calculation.target_events),
+        "n_iterations": calculation.i,
+        "final_parameters": {
+            key: None if value is None else float(value)
+            for key, value in theta.items()
+        },
+    }
+
+
+def read_bootstrap_results(fn_results):
+    """
+    Reads the results of a bootstrap from the json lines file fn_results.
+    An incomplete last line, e.g. of a crashed run, is skipped.
+    """
+    results = []
+    if not os.path.exists(fn_results):
+        return results
+    with open(fn_results, "r") as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(
+                    "    skipping incomplete line in {}".format(fn_results))
+    return results
+
+
+def bootstrap_inversion(
+        inversion_config,
+        parameters,
+        n_catalogs,
+        fn_results,
+        beta=None,
+        burn_start=None,
+        n_processes=None,
+        seed=None,
+):
+    """
+    Parametric bootstrap of the ETAS parameters. Simulates n_catalogs
+    synthetic catalogs from parameters and inverts each of them with the
+    settings of inversion_config, in parallel.
+
+    Results are appended to fn_results as soon as a catalog is inverted.
+    If fn_results already contains results, only the missing catalogs are
+    simulated, with the same seeds as in the first run. Catalogs whose
+    inversion fails are logged and left out, they are tried again in the
+    next run.
+
+    Parameters
+    ----------
+    inversion_config : dict
+        Metadata of ETASParameterCalculation. The catalog is replaced by
+        the synthetic catalogs, mc needs to be a number and three_dim
+        False.
+    parameters : dict
+        Parameters from which the catalogs are simulated, as estimated in
+        the ETAS EM inversion. They are also the initial values of the
+        inversions if inversion_config has no theta_0.
+    n_catalogs : int
+        Number of synthetic catalogs.
+    fn_results : str
+        Path of the json lines file with one result per catalog.
+    beta : float, optional
+        Beta of the simulated magnitudes, defaults to beta of
+        inversion_config.
+    burn_start : str or datetime, optional
+        Start of the simulation, defaults to auxiliary_start. Events
+        before auxiliary_start are not part of the inverted catalogs, but
+        trigger events after it.
+    n_processes : int, optional
+        Number of worker processes, defaults to the number of CPUs.
+    seed : int, optional
+        Root seed from which the seeds of the catalogs are derived. Must
+        be the same as in the first run when resuming.
+
+    Returns
+    -------
+    results : pd.DataFrame
+        One row per inverted catalog, with its seed, number of events,
+        number of EM iterations and final parameters.
+
+    Raises
+    ------
+    RuntimeError
+        If no catalog could be inverted.
+    """
+    mc = inversion_config["mc"]
+    if not isinstance(mc, numbers.Real) or isinstance(mc, bool):
+        raise ValueError(
+            "bootstrap_inversion requires a constant mc, not {!r}.".format(
+                mc))
+    if inversion_config.get("three_dim", False):
+        raise ValueError(
+            "bootstrap_inversion does not support three_dim catalogs.")
+    if beta is None:
+        beta = inversion_config.get("beta")
+    if beta is None:
+        raise ValueError("beta is needed to simulate magnitudes.")
+
+    previous = read_bootstrap_results(fn_results)
+    done = {result["catalog"] for result in previous}
+    if previous:
+        root_entropy = previous[0]["root_entropy"]
+        if seed is not None and root_entropy != seed:
+            raise ValueError(
+                "{} contains results of root seed {}, not {}.".format(
+                    fn_results, root_entropy, seed))
+    else:
+        root_entropy = np.random.SeedSequence(seed).entropy
+    seeds = [
+        int(sequence.generate_state(1)[0])
+        for sequence in np.random.SeedSequence(root_entropy).spawn(
+            n_catalogs)
+    ]
+    missing = [i for i in range(n_catalogs) if i not in done]
+    logger.info(
+        "START BOOTSTRAP, {} of {} catalogs to invert".format(
+            len(missing), n_catalogs))
+
+    setup = {
+        "metadata": inversion_config,
+        "parameters": parameters,
+        "beta": beta,
+        "burn_start": (
+            burn_start if burn_start is not None
+            else inversion_config["auxiliary_start"]
+        ),
+        "root_entropy": root_entropy,
+    }
+    if os.path.dirname(fn_results):
+        os.makedirs(os.path.dirname(fn_results), exist_ok=True)
+    if previous:
+        # an incomplete last line is removed, such that new results start
+        # on a new line
+        fn_tmp = "{}.{}.tmp".format(fn_results, os.getpid())
+        with open(fn_tmp, "w") as f:
+            for result in previous:
+                f.write(json.dumps(result) + "\n")
+        os.replace(fn_tmp, fn_results)
+    with ProcessPoolExecutor(
+        max_workers=n_processes,
+        initializer=init_bootstrap_worker,
+        initargs=(setup,),
+    ) as executor, open(fn_results, "a") as f:
+        futures = {
+            executor.submit(run_bootstrap_catalog, i, seeds[i]): i
+            for i in missing
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(
+                    "  catalog {} failed: {}".format(futures[future], e))
+                continue
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            logger.info(
+                "  catalog {} done, {} iterations".format(
+                    result["catalog"], result["n_iterations"]))
+
+    results = read_bootstrap_results(fn_results)
+    if not results:
+        raise RuntimeError(
+            "No catalog of the bootstrap could be inverted, see the log.")
+    return bootstrap_results_frame(results)
+
+
+def bootstrap_results_frame(results):
+    """
+    Results of bootstrap_inversion as a DataFrame with one row per
+    catalog, indexed by catalog.
+    """
+    rows = []
+    for result in results:
+        row = {
+            key: value for key, value in result.items()
+            if key not in ("final_parameters", "root_entropy")
+        }
+        row.update(result["final_parameters"])
+        rows.append(row)
+    if not rows:
+        return pd.DataFrame()
+    return pd.DataFrame(rows).drop_duplicates(
+        "catalog", keep="last").set_index("catalog").sort_index()
+
+
+def bootstrap_summary(results, quantiles=(0.025, 0.5, 0.975)):
+    """
+    Mean, standard deviation and quantiles of the parameters in results
+    of bootstrap_inversion, one column per parameter.
+    """
+    parameters = results[[
+        column for column in results.columns
+        if column not in ("seed", "n_events", "n_target_events",
+                          "n_iterations")
+    ]].dropna(axis=1, how="all")
+    summary = pd.concat([
+        parameters.mean().to_frame("mean").T,
+        parameters.std().to_frame("std").T,
+        parameters.quantile(list(quantiles)),
+    ])
+    return summary
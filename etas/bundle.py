@@ -0,0 +1,191 @@
+##############################################################################
+# binary bundle of the tables of an ETAS inversion
+#
+# a bundle is a directory with one .npy file per array and a json manifest.
+# tables consist of parts, which are either numpy arrays or DataFrames (one
+# file for the index and one per column). the manifest describes the tables
+# and contains the size and sha256 checksum of every file. arrays are
+# memory-mapped copy-on-write when they are read, such that only the pages
+# which are used are read from disk, and modifying them does not change
+# the files.
+##############################################################################
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+BUNDLE_MANIFEST = "manifest.json"
+BUNDLE_VERSION = 1
+# bytes read at once when calculating checksums
+CHECKSUM_BLOCK_SIZE = 2 ** 24
+
+
+def file_checksum(fn):
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def column_array(values):
+    # object columns (e.g. string ids) are stored as fixed width strings,
+    # such that they can be memory-mapped
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = values.astype(str)
+    return values
+
+
+def write_bundle(directory, tables):
+    """
+    Writes tables to directory, replacing tables of the same name.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the bundle, created if needed.
+    tables : dict
+        Maps the name of each table to a dict of parts, each part is a
+        numpy array or a DataFrame.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory) or {
+        "version": BUNDLE_VERSION, "tables": {}, "files": {}}
+
+    for table, parts in tables.items():
+        description = {}
+        arrays = {}
+        for part, value in parts.items():
+            name = "{}.{}".format(table, part)
+            if isinstance(value, pd.DataFrame):
+                description[part] = {
+                    "type": "frame",
+                    "index": value.index.name,
+                    "columns": [str(column) for column in value.columns],
+                }
+                arrays[name + ".index"] = column_array(value.index)
+                for i, column in enumerate(value.columns):
+                    arrays["{}.{}".format(name, i)] = column_array(
+                        value[column])
+            else:
+                description[part] = {"type": "array"}
+                arrays[name] = column_array(value)
+
+        for name, values in arrays.items():
+            fn = os.path.join(directory, name + ".npy")
+            # files are written under a temporary name first, the
+            # previous bundle stays readable until the manifest is replaced
+            with open(fn + ".tmp", "wb") as f:
+                np.save(f, values)
+            os.replace(fn + ".tmp", fn)
+            manifest["files"][name + ".npy"] = {
+                "bytes": os.path.getsize(fn),
+                "sha256": file_checksum(fn),
+            }
+        manifest["tables"][table] = description
+
+    fn_manifest = os.path.join(directory, BUNDLE_MANIFEST)
+    with open(fn_manifest + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(fn_manifest + ".tmp", fn_manifest)
+
+
+def read_manifest(directory):
+    fn_manifest = os.path.join(directory, BUNDLE_MANIFEST)
+    if not os.path.exists(fn_manifest):
+        return None
+    with open(fn_manifest, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != BUNDLE_VERSION:
+        raise ValueError(
+            "Bundle {} has version {}, expected {}.".format(
+                directory, manifest.get("version"), BUNDLE_VERSION))
+    return manifest
+
+
+class Bundle:
+    """
+    Tables stored with write_bundle.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the bundle.
+    verify : bool, default False
+        If True, the checksums of the files of a table are verified when
+        the table is read. This reads the whole files.
+    """
+
+    def __init__(self, directory, verify=False):
+        self.directory = directory
+        self.verify = verify
+        self.manifest = read_manifest(directory)
+        if self.manifest is None:
+            raise FileNotFoundError(
+                "No bundle in {}.".format(directory))
+
+    def __contains__(self, table):
+        return table in self.manifest["tables"]
+
+    def files(self, table):
+        """Names of the files of table."""
+        names = []
+        for part, description in self.manifest["tables"][table].items():
+            name = "{}.{}".format(table, part)
+            if description["type"] == "frame":
+                names.append(name + ".index.npy")
+                names += [
+                    "{}.{}.npy".format(name, i)
+                    for i in range(len(description["columns"]))
+                ]
+            else:
+                names.append(name + ".npy")
+        return names
+
+    def check(self, table):
+        """
+        Raises a ValueError if a file of table differs from the manifest.
+        """
+        for name in self.files(table):
+            expected = self.manifest["files"][name]
+            fn = os.path.join(self.directory, name)
+            if (
+                os.path.getsize(fn) != expected["bytes"]
+                or file_checksum(fn) != expected["sha256"]
+            ):
+                raise ValueError(
+                    "{} does not match the manifest of bundle {}.".format(
+                        name, self.directory))
+
+    def array(self, name):
+        return np.load(
+            os.path.join(self.directory, name + ".npy"), mmap_mode="c")
+
+    def read(self, table):
+        """
+        Parts of table as a dict. Arrays are memory-mapped, DataFrames are
+        created from memory-mapped columns.
+        """
+        if self.verify:
+            self.check(table)
+        parts = {}
+        for part, description in self.manifest["tables"][table].items():
+            name = "{}.{}".format(table, part)
+            if description["type"] == "frame":
+                index = pd.Index(
+                    self.array(name + ".index"), name=description["index"])
+                parts[part] = pd.DataFrame(
+                    {
+                        column: self.array("{}.{}".format(name, i))
+                        for i, column in enumerate(description["columns"])
+                    },
+                    index=index,
+                    columns=description["columns"],
+                )
+            else:
+                parts[part] = self.array(name)
+        return parts
@@ -0,0 +1,152 @@
+##############################################################################
+# content-addressed on-disk cache for the pairs of the ETAS inversion
+#
+# an entry is identified by the hash of the filtered catalog and of the
+# settings which affect the pairs. entries are stored as pickle files, and
+# the least recently used entries are removed when the cache exceeds its
+# size limit. an entry can own a directory named after its key in each of
+# data_dirs (e.g. the files of PairChunks). these directories count towards
+# the size of the entry and are removed with it, and an entry whose
+# directories are missing is not used.
+##############################################################################
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CACHE_SUFFIX = ".pairs.pkl"
+
+
+def cache_key(catalog, settings):
+    """
+    Hash of a catalog (values, index, columns and dtypes) and a dict of
+    settings.
+    """
+    h = hashlib.sha256()
+    h.update(
+        json.dumps(
+            [list(map(str, catalog.columns)),
+             list(map(str, catalog.dtypes))]
+        ).encode()
+    )
+    h.update(pd.util.hash_pandas_object(catalog, index=True).to_numpy())
+    h.update(
+        json.dumps(settings, sort_keys=True, default=json_default).encode())
+    return h.hexdigest()
+
+
+def json_default(value):
+    # arrays are converted to lists, str would abbreviate long arrays
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key + CACHE_SUFFIX)
+
+
+def entry_directories(key, data_dirs):
+    return [os.path.join(data_dir, key) for data_dir in data_dirs]
+
+
+def directory_size(directory):
+    size = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def load_cache_entry(cache_dir, key, data_dirs=()):
+    """
+    Returns the cached entry for key, or None if there is none, or if one
+    of its directories in data_dirs is missing. Loading an entry marks it
+    as recently used.
+    """
+    fn = cache_path(cache_dir, key)
+    if not os.path.exists(fn):
+        return None
+    missing = [
+        directory for directory in entry_directories(key, data_dirs)
+        if not os.path.isdir(directory)
+    ]
+    if missing:
+        logger.warning(
+            "    cache entry {} is incomplete, {} is missing".format(
+                fn, missing[0]))
+        return None
+    try:
+        with open(fn, "rb") as f:
+            entry = pickle.load(f)
+    except Exception as e:
+        logger.warning(
+            "    could not read cache entry {}: {}".format(fn, e))
+        return None
+    os.utime(fn)
+    return entry
+
+
+def store_cache_entry(cache_dir, key, entry, size_limit=None, data_dirs=()):
+    """
+    Stores entry under key, and removes least recently used entries until
+    the total size of the cache, including the directories of the entries
+    in data_dirs, is at most size_limit bytes. The new entry is never
+    removed.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fn = cache_path(cache_dir, key)
+    # write to a temporary file first, such that concurrent readers never
+    # see an incomplete entry
+    fn_tmp = "{}.{}.tmp".format(fn, os.getpid())
+    with open(fn_tmp, "wb") as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(fn_tmp, fn)
+
+    if size_limit is not None:
+        evict_cache_entries(cache_dir, size_limit, keep=fn,
+                            data_dirs=data_dirs)
+
+
+def evict_cache_entries(cache_dir, size_limit, keep=None, data_dirs=()):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(CACHE_SUFFIX):
+            continue
+        fn = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(fn)
+        except FileNotFoundError:
+            continue
+        directories = entry_directories(
+            name[:-len(CACHE_SUFFIX)], data_dirs)
+        size = stat.st_size + sum(
+            directory_size(directory) for directory in directories)
+        entries.append((stat.st_mtime, size, fn, directories))
+
+    total_size = sum(entry[1] for entry in entries)
+    for _, size, fn, directories in sorted(entries):
+        if total_size <= size_limit:
+            break
+        if fn == keep:
+            continue
+        # the pickle is removed first, such that the entry is not used
+        # while its directories are removed
+        try:
+            os.remove(fn)
+        except FileNotFoundError:
+            pass
+        for directory in directories:
+            shutil.rmtree(directory, ignore_errors=True)
+        logger.debug("    removed cache entry {}".format(fn))
+        total_size -= size
@@ -1,16 +1,15 @@
 import sys
-from etas.inversion import ETASParameterCalculation, read_shape_coords, polygon_surface, round_half_up, parameter_dict2array, haversine
+from etas.inversion import ETASParameterCalculation, read_shape_coords, round_half_up, parameter_dict2array, haversine
 from etas.simulation import simulate_aftershock_time
+from etas.geometry import Region
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Polygon
 from joblib import Parallel, delayed
 from tabulate import tabulate
 import numpy as np
 from scipy.special import expi
 import json
 from scipy.integrate  import quad
-from shapely.geometry import Polygon, Point, LineString
+from shapely.geometry import Point, LineString
 import matplotlib.pyplot as plt
 
 
@@ -184,16 +183,9 @@ class ETASLikelihoodCalculation(ETASParameterCalculation):
                 "  Coordinates of region: {}".format(list(self.shape_coords))
             )
 
-            poly = Polygon(self.shape_coords)
-            self.area = polygon_surface(poly)
-            gdf = gpd.GeoDataFrame(
-                filtered_catalog,
-                geometry=gpd.points_from_xy(
-                    filtered_catalog.latitude, filtered_catalog.longitude
-                ),
-            )
-            filtered_catalog = gdf[gdf.intersects(poly)].copy()
-            filtered_catalog.drop("geometry", axis=1, inplace=True)
+            region = Region(self.shape_coords)
+            self.area = region.area
+            filtered_catalog = region.filter(filtered_catalog).copy()
         else:
             self.area = 6.3781e3**2 * 4 * np.pi
         self.logger.info("Region has {} square km".format(self.area))
@@ -0,0 +1,170 @@
+##############################################################################
+# regions in latitude / longitude
+#
+# a region holds a prepared polygon, its area and a raster of the cells of
+# its bounding box which are inside, outside or on the boundary of the
+# polygon. points are tested on numpy arrays of latitudes and longitudes,
+# only points in boundary cells are tested against the polygon. as
+# everywhere in this package, polygons have coordinates [latitude,
+# longitude], and points on the boundary are in the region.
+##############################################################################
+
+from functools import lru_cache
+
+import numpy as np
+import pyproj
+import shapely
+import shapely.ops as ops
+from shapely.geometry import Polygon
+from shapely.geometry.base import BaseGeometry
+
+# number of cells of the raster along latitude and longitude
+REGION_RASTER_SIZE = 256
+# cells are enlarged by this fraction of their size when they are
+# classified, such that points on the edge of a cell are never decided by
+# the wrong cell due to rounding
+REGION_RASTER_MARGIN = 1e-9
+
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+
+@lru_cache(maxsize=64)
+def area_transformer(lat_1, lat_2):
+    """
+    Transformer from WGS84 to the Albers equal area projection with
+    standard parallels lat_1 and lat_2.
+    """
+    proj_wgs84 = pyproj.CRS('EPSG:4326')
+    proj_aea = pyproj.CRS(proj="aea", lat_1=lat_1, lat_2=lat_2)
+    return pyproj.Transformer.from_crs(proj_wgs84, proj_aea)
+
+
+def polygon_surface(polygon):
+    transformer = area_transformer(polygon.bounds[0], polygon.bounds[2])
+    geom_area = ops.transform(transformer.transform, polygon)
+
+    return geom_area.area / 1e6
+
+
+def rectangle_surface(lat1, lat2, lon1, lon2):
+    vertices = [[lat1, lon1], [lat2, lon1], [lat2, lon2], [lat1, lon2]]
+    return polygon_surface(Polygon(vertices))
+
+
+class Region:
+    """
+    Polygon in latitude / longitude for fast tests of many points.
+
+    Parameters
+    ----------
+    polygon : Polygon or array-like
+        Polygon, or coordinates of its boundary ([[lat1, lon1], ...]).
+    raster_size : int, default REGION_RASTER_SIZE
+        Number of cells of the raster along latitude and longitude.
+    """
+
+    def __init__(self, polygon, raster_size=REGION_RASTER_SIZE):
+        if not isinstance(polygon, BaseGeometry):
+            polygon = Polygon(polygon)
+        self.polygon = polygon
+        shapely.prepare(self.polygon)
+        self.raster_size = raster_size
+        self._area = None
+        self._raster = None
+
+    def __getstate__(self):
+        # the raster is calculated again when needed
+        state = self.__dict__.copy()
+        state["_raster"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        shapely.prepare(self.polygon)
+
+    @property
+    def bounds(self):
+        """min_lat, min_lon, max_lat, max_lon"""
+        return self.polygon.bounds
+
+    @property
+    def area(self):
+        """Area of the region in square km."""
+        if self._area is None:
+            self._area = polygon_surface(self.polygon)
+        return self._area
+
+    @property
+    def raster(self):
+        """
+        Classification of the cells of the bounding box as OUTSIDE,
+        INSIDE or BOUNDARY, with one row per latitude cell.
+        """
+        if self._raster is None:
+            min_lat, min_lon, max_lat, max_lon = self.bounds
+            lat_edges = np.linspace(min_lat, max_lat, self.raster_size + 1)
+            lon_edges = np.linspace(min_lon, max_lon, self.raster_size + 1)
+            margin_lat = REGION_RASTER_MARGIN * (max_lat - min_lat)
+            margin_lon = REGION_RASTER_MARGIN * (max_lon - min_lon)
+            lat_0, lon_0 = np.meshgrid(
+                lat_edges[:-1], lon_edges[:-1], indexing="ij")
+            lat_1, lon_1 = np.meshgrid(
+                lat_edges[1:], lon_edges[1:], indexing="ij")
+            cells = shapely.box(
+                lat_0 - margin_lat, lon_0 - margin_lon,
+                lat_1 + margin_lat, lon_1 + margin_lon,
+            )
+            raster = np.full(cells.shape, BOUNDARY, dtype=np.int8)
+            raster[~shapely.intersects(self.polygon, cells)] = OUTSIDE
+            raster[shapely.contains(self.polygon, cells)] = INSIDE
+            self._raster = raster
+        return self._raster
+
+    def contains(self, latitude, longitude):
+        """
+        Boolean array, True for points in the region (including its
+        boundary). Same as intersects of the points with the polygon.
+        """
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        min_lat, min_lon, max_lat, max_lon = self.bounds
+        inside = np.zeros(latitude.shape, dtype=bool)
+        in_box = np.flatnonzero(
+            (latitude >= min_lat) & (latitude <= max_lat)
+            & (longitude >= min_lon) & (longitude <= max_lon))
+        if len(in_box) == 0:
+            return inside
+
+        n = self.raster_size
+        if self._raster is None and len(in_box) < n * n:
+            # the raster only pays off for more points than cells
+            inside[in_box] = shapely.intersects_xy(
+                self.polygon, latitude[in_box], longitude[in_box])
+            return inside
+
+        lat_cell = np.clip(
+            ((latitude[in_box] - min_lat) / (max_lat - min_lat) * n
+             ).astype(int), 0, n - 1)
+        lon_cell = np.clip(
+            ((longitude[in_box] - min_lon) / (max_lon - min_lon) * n
+             ).astype(int), 0, n - 1)
+        cell = self.raster[lat_cell, lon_cell]
+
+        inside[in_box[cell == INSIDE]] = True
+        boundary = in_box[cell == BOUNDARY]
+        inside[boundary] = shapely.intersects_xy(
+            self.polygon, latitude[boundary], longitude[boundary])
+        return inside
+
+    def filter(self, frame):
+        """Rows of frame whose latitude and longitude are in the region."""
+        return frame[self.contains(frame["latitude"], frame["longitude"])]
+
+
+def as_region(polygon):
+    """Region of polygon, or polygon itself if it is a Region."""
+    if polygon is None or isinstance(polygon, Region):
+        return polygon
+    return Region(polygon)
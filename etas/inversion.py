@@ -10,27 +10,37 @@
 # Seismological Research Letters 2021; doi: https://doi.org/10.1785/0220200231
 ##############################################################################
 
+import copy
 import datetime as dt
+import functools
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 import pprint
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 
-import geopandas as gpd
 import numpy as np
 import pandas as pd
-import pyproj
-import shapely.ops as ops
-from scipy.optimize import NonlinearConstraint, linprog, minimize
-from scipy.spatial import ConvexHull
+from scipy.optimize import NonlinearConstraint, brentq, linprog, minimize
+from scipy.sparse import csr_matrix
+from scipy.spatial import ConvexHull, cKDTree
 from scipy.special import exp1
 from scipy.special import gamma as gamma_func
 from scipy.special import gammaincc, gammaln
-from shapely.geometry import Polygon
 
+from etas.bundle import Bundle, column_array, write_bundle
+from etas.cache import cache_key, load_cache_entry, store_cache_entry
+from etas.geometry import Region, polygon_surface, rectangle_surface  # noqa
 from etas.mc_b_est import (estimate_beta_positive, estimate_beta_tinti,
                            round_half_up)
+from etas.model import FittedModel
+from etas.pairs import (WORKER_BLOCK_SIZE, PairChunks, PairChunkWriter,
+                        PairTable, block_slices, map_blocks, pair_csv_frame,
+                        worker_pool)
+from etas.pairs import PairChunk, shutdown_worker_pools  # noqa
 
 logger = logging.getLogger(__name__)
 
@@ -58,6 +68,60 @@ RANGES = (
     RHO_RANGE,
 )
 
+# nodes and weights of the Gauss-Legendre quadrature used in
+# upper_gamma_ext_da
+LEGENDRE_NODES, LEGENDRE_WEIGHTS = np.polynomial.legendre.leggauss(64)
+
+# decrease of the log likelihood which is accepted after an extrapolation
+# in accelerated EM. the E-step and M-step are not exactly consistent (the
+# M-step normalizes the time kernel over [0, inf)), so plain EM steps can
+# decrease the log likelihood slightly. same default as the SQUAREM package
+SQUAREM_LOG_LIKELIHOOD_TOLERANCE = 1
+
+# the block-coordinate M-step stops when no parameter changes by more than
+# this in a cycle over all blocks of parameters
+BLOCK_COORDINATE_TOLERANCE = 1e-6
+BLOCK_COORDINATE_MAX_CYCLES = 100
+# maximum change of a parameter in one block minimization. without it, the
+# first trial point of L-BFGS-B of the time block is often at the corner
+# of the ranges, where the gradient is not finite
+BLOCK_COORDINATE_MAX_STEP = 1
+
+# with background_density "neighbours", the background kernel is cut off
+# where it drops below this value
+BACKGROUND_KERNEL_CUTOFF = 1e-8
+
+# a of the productivity law of free_productivity is determined up to this
+# tolerance, in at most this many Newton or bisection steps
+PRODUCTIVITY_TOLERANCE = 1e-10
+PRODUCTIVITY_MAX_ITERATIONS = 100
+
+# in mini-batch EM, the batch grows after at most this many iterations with
+# the same batch size
+MINIBATCH_MAX_ITERATIONS = 5
+
+# step of the central differences in the observed information matrix
+INFORMATION_STEP = 1e-5
+
+# points of a three_dim catalog are in the region if they are at most this
+# far outside of its convex hull, relative to the coordinates of the hull.
+# in_hull (linprog) accepts points up to about 1e-8 outside, relative
+HULL_TOLERANCE = 1e-10
+
+# columnar catalog files, only the columns used in the inversion are read
+# from them. any other file is read as csv
+CATALOG_FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "feather",
+    ".npz": "npz",
+}
+# columns of the catalog used in the inversion, in addition to id
+CATALOG_COLUMNS = ["time", "latitude", "longitude", "magnitude"]
+CATALOG_COLUMNS_3D = ["time", "x", "y", "z", "magnitude"]
+OPTIONAL_CATALOG_COLUMNS = ["mc_current", "latitude", "longitude"]
+
 
 def coppersmith(mag, fault_type):
     """
@@ -130,35 +194,6 @@ def coppersmith(mag, fault_type):
     return {"SRL": SRL, "SSRL": SSRL, "RW": RW, "RA": RA, "AD": AD}
 
 
-def rectangle_surface(lat1, lat2, lon1, lon2):
-    vertices = [[lat1, lon1], [lat2, lon1], [lat2, lon2], [lat1, lon2]]
-    polygon = Polygon(vertices)
-
-    proj_wgs84 = pyproj.CRS('EPSG:4326')
-    proj_aea = pyproj.CRS(
-        proj="aea", lat_1=polygon.bounds[0], lat_2=polygon.bounds[2])
-
-    transformer = pyproj.Transformer.from_crs(
-        proj_wgs84, proj_aea)
-
-    geom_area = ops.transform(transformer.transform, polygon)
-
-    return geom_area.area / 1e6
-
-
-def polygon_surface(polygon):
-    proj_wgs84 = pyproj.CRS('EPSG:4326')
-    proj_aea = pyproj.CRS(
-        proj="aea", lat_1=polygon.bounds[0], lat_2=polygon.bounds[2])
-
-    transformer = pyproj.Transformer.from_crs(
-        proj_wgs84, proj_aea)
-
-    geom_area = ops.transform(transformer.transform, polygon)
-
-    return geom_area.area / 1e6
-
-
 def in_hull(points, x):
     n_points = len(points)
     c = np.zeros(n_points)
@@ -168,6 +203,23 @@ def in_hull(points, x):
     return lp.success
 
 
+def in_convex_hull(hull, x, tolerance=HULL_TOLERANCE):
+    """
+    Same as in_hull for all rows of x at once, for the ConvexHull hull of
+    the points. A point is in the hull if it is on the inner side of the
+    planes of all facets. Points on the boundary, up to tolerance times
+    the largest absolute coordinate of the hull, are in the hull.
+    """
+    x = np.asarray(x, dtype=float)
+    tolerance = tolerance * np.max(np.abs(hull.points))
+    inside = np.ones(len(x), dtype=bool)
+    # equations are unit normals and offsets, normal @ x + offset <= 0
+    # inside the hull
+    for equation in hull.equations:
+        inside &= x @ equation[:-1] + equation[-1] <= tolerance
+    return inside
+
+
 def hav(theta):
     return np.square(np.sin(theta / 2))
 
@@ -194,6 +246,93 @@ def haversine(lat_rad_1,
     return d
 
 
+def unit_sphere_coordinates(lat_rad, lon_rad):
+    """
+    Translates latitude and longitude (in radians) to cartesian coordinates
+    on the unit sphere.
+    """
+    cos_lat = np.cos(lat_rad)
+    return np.column_stack([
+        cos_lat * np.cos(lon_rad),
+        cos_lat * np.sin(lon_rad),
+        np.sin(lat_rad),
+    ])
+
+
+def gaussian_kernel_matrix(points, radius, distance_squared, bw_sq):
+    """
+    Sparse symmetric matrix of the Gaussian kernel exp(-r^2 / (2 * bw_sq))
+    between all pairs of points which are closer to each other than
+    radius, found with a KD-tree over the points. The diagonal is one.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        Array of shape (n_points, k) with the coordinates of the points.
+    radius : float
+        Search radius, in the units of the coordinates.
+    distance_squared : callable
+        distance_squared(i, j) returns the squared distances r^2 between
+        the points at positions i and j, in the units of bw_sq.
+    bw_sq : float
+        Squared bandwidth of the kernel.
+    """
+    n_points = len(points)
+    i, j = cKDTree(points).query_pairs(radius, output_type="ndarray").T
+    weights = np.exp(distance_squared(i, j) * (-1 / 2 / bw_sq))
+    diagonal = np.arange(n_points)
+    return csr_matrix(
+        (
+            np.concatenate([weights, weights, np.ones(n_points)]),
+            (np.concatenate([i, j, diagonal]),
+             np.concatenate([j, i, diagonal])),
+        ),
+        shape=(n_points, n_points),
+    )
+
+
+def neighbour_pairs(source_points, target_points, radius, chunksize=10000):
+    """
+    Finds all pairs of source and target points which are closer to each
+    other than the radius of the source, using a KD-tree over the targets.
+    Sources are queried in chunks, to limit the memory needed for
+    intermediate results.
+
+    Parameters
+    ----------
+    source_points : np.ndarray
+        Array of shape (n_sources, k) with the coordinates of the sources.
+    target_points : np.ndarray
+        Array of shape (n_targets, k) with the coordinates of the targets.
+    radius : np.ndarray
+        Search radius for each source, in the units of the coordinates.
+    chunksize : int, optional
+        Number of sources which are queried at once.
+
+    Yields
+    ------
+    source_idx, target_idx : np.ndarray
+        Positions of the sources and targets of the pairs of one chunk of
+        sources, sorted by source position and then by target position.
+    """
+    tree = cKDTree(target_points)
+
+    for start in range(0, len(source_points), chunksize):
+        stop = min(start + chunksize, len(source_points))
+        neighbours = tree.query_ball_point(
+            source_points[start:stop], r=radius[start:stop])
+        counts = np.fromiter(
+            (len(n) for n in neighbours), dtype=np.int64,
+            count=stop - start)
+        target_idx = np.fromiter(
+            itertools.chain.from_iterable(neighbours), dtype=np.int64,
+            count=counts.sum())
+        source_idx = np.repeat(np.arange(start, stop), counts)
+
+        order = np.lexsort((target_idx, source_idx))
+        yield source_idx[order], target_idx[order]
+
+
 def branching_integral(alpha_minus_beta, dm_max=None):
     if dm_max is None:
         assert alpha_minus_beta < 0, (
@@ -312,8 +451,10 @@ def parameter_dict2array(parameters):
     return np.array([parameters.get(key, None) for key in order])
 
 
-def create_initial_values(ranges=RANGES):
-    return [np.random.uniform(*r) for r in ranges]
+def create_initial_values(ranges=RANGES, rng=None):
+    if rng is None:
+        rng = np.random
+    return [rng.uniform(*r) for r in ranges]
 
 
 def triggering_kernel(metrics, params):
@@ -357,6 +498,72 @@ def triggering_kernel(metrics, params):
     return res
 
 
+def pair_triggering_kernel(
+        pairs, params, source_kappa=None, out=None, executor=None):
+    """
+    Same as triggering_kernel, for all pairs of a PairTable. Factors which
+    are constant per source are calculated once per source. The result is
+    written to out if given, the buffer "tmp" of pairs is used as scratch
+    space. With executor, blocks of pairs are evaluated in parallel.
+    """
+    theta, mc = params
+
+    (
+        log10_mu,
+        log10_iota,
+        log10_k0,
+        a,
+        log10_c,
+        omega,
+        log10_tau,
+        log10_d,
+        gamma,
+        rho,
+    ) = theta
+
+    c = np.power(10, log10_c)
+    tau = np.power(10, log10_tau)
+    d = np.power(10, log10_d)
+    m = pairs.sources["source_magnitude"].to_numpy()
+    aftershock_number = (
+        source_kappa if source_kappa is not None
+        else np.power(10, log10_k0) * np.exp(a * (m - mc))
+    )
+    spatial_scale = d * np.exp(gamma * (m - mc))
+
+    if out is None:
+        out = np.empty(len(pairs))
+    tmp_pairs = pairs.buffer("tmp")
+    time_distance_pairs = pairs["time_distance"]
+    spatial_distance_squared_pairs = pairs["spatial_distance_squared"]
+
+    def kernel(block):
+        result = out[block]
+        tmp = tmp_pairs[block]
+        time_distance = time_distance_pairs[block]
+        source_idx = pairs.source_idx[block]
+
+        # time decay
+        np.add(time_distance, c, out=result)
+        np.power(result, -(1 + omega), out=result)
+        np.divide(time_distance, -tau, out=tmp)
+        np.exp(tmp, out=tmp)
+        result *= tmp
+
+        # space decay. mode="clip" avoids buffering of the output of take,
+        # indices are always valid
+        np.take(spatial_scale, source_idx, out=tmp, mode="clip")
+        tmp += spatial_distance_squared_pairs[block]
+        np.power(tmp, -(1 + rho), out=tmp)
+        result *= tmp
+
+        np.take(aftershock_number, source_idx, out=tmp, mode="clip")
+        result *= tmp
+
+    map_blocks(kernel, block_slices(len(pairs), executor), executor)
+    return out
+
+
 def responsibility_factor(theta, beta, delta_mc):
     (
         log10_mu,
@@ -436,193 +643,1180 @@ def expected_aftershocks(event, params, no_start=False, no_end=False):
     return number_factor * area_factor * time_factor
 
 
-def ll_aftershock_term(l_hat, g):
-    mask = g != 0
-    term = -1 * gammaln(l_hat + 1) - g
-    term = term + l_hat * np.where(mask, np.log(g), -300)
-    return term
+def time_kernel_tail(time_distance, log10_c, omega, log10_tau):
+    """
+    Fraction of the mass of the time kernel which lies beyond the given
+    time distance (in days).
+    """
+    c = np.power(10, log10_c)
+    tau = np.power(10, log10_tau)
+    return upper_gamma_ext(-omega, (time_distance + c) / tau) \
+        / upper_gamma_ext(-omega, c / tau)
 
 
-def neg_log_likelihood(theta, Pij, source_events, mc_min):
-    assert Pij.index.names == ("source_id", "target_id"), logger.error(
-        'Pij must have multiindex with names "source_id", "target_id"'
-    )
-    assert source_events.index.name == "source_id", logger.error(
-        'source_events must have index with name "source_id"'
+def space_kernel_tail(spatial_distance_squared, log10_d, gamma, rho, m, mc):
+    """
+    Fraction of the mass of the space kernel of a source of magnitude m
+    which lies beyond the given squared distance.
+    """
+    d = np.power(10, log10_d)
+    return np.power(
+        1 + spatial_distance_squared / (d * np.exp(gamma * (m - mc))), -rho)
+
+
+def kernel_pruning_ranges(theta, magnitudes, mc, tolerance, max_time=None):
+    """
+    Calculates the maximum time lag and the maximum squared distance per
+    source magnitude, such that the triggering kernel has at most a
+    fraction of tolerance / 2 of its mass beyond each of them, and thus
+    at most a fraction of tolerance outside of both.
+
+    Parameters
+    ----------
+    theta : np.ndarray
+        ETAS parameters, including log10_mu and log10_iota.
+    magnitudes : np.ndarray
+        Magnitudes of the sources.
+    mc : float
+        Reference magnitude of the productivity and space kernel.
+    tolerance : float
+        Maximum fraction of kernel mass which is discarded per source.
+    max_time : float, optional
+        Longest time lag which can occur (in days). If the time kernel has
+        less than tolerance / 2 of its mass beyond max_time, the time lag
+        is not limited.
+
+    Returns
+    -------
+    max_time_lag : float
+        Maximum time lag in days, np.inf if it is not limited.
+    max_distance_squared : np.ndarray
+        Maximum squared distance for each source.
+    """
+    (
+        log10_mu,
+        log10_iota,
+        log10_k0,
+        a,
+        log10_c,
+        omega,
+        log10_tau,
+        log10_d,
+        gamma,
+        rho,
+    ) = theta
+
+    def log_tail_excess(log10_t):
+        return np.log(time_kernel_tail(
+            np.power(10, log10_t), log10_c, omega, log10_tau)) \
+            - np.log(tolerance / 2)
+
+    log10_t_max = np.log10(max_time) if max_time is not None else 12
+    if log_tail_excess(log10_t_max) > 0:
+        max_time_lag = np.inf
+    else:
+        max_time_lag = np.power(
+            10, brentq(log_tail_excess, log10_c - 10, log10_t_max))
+
+    d = np.power(10, log10_d)
+    max_distance_squared = d * np.exp(gamma * (magnitudes - mc)) * (
+        np.power(tolerance / 2, -1 / rho) - 1
     )
 
-    log10_k0, a, log10_c, omega, log10_tau, log10_d, gamma, rho = theta
+    return max_time_lag, max_distance_squared
+
 
+def aftershock_time_integral(theta, time_to_start, time_to_end):
+    """
+    Time factor of expected_aftershocks for log10_c, omega, log10_tau
+    (theta), the Omori kernel integrated from the start to the end of the
+    time window, for each source.
+    """
+    log10_c, omega, log10_tau = theta
     c = np.power(10, log10_c)
     tau = np.power(10, log10_tau)
-    d = np.power(10, log10_d)
 
-    source_events["G"] = expected_aftershocks(
-        [
-            source_events["source_magnitude"],
-            source_events["pos_source_to_start_time_distance"],
-            source_events["source_to_end_time_distance"],
-        ],
-        [theta, mc_min],
+    time_fraction = upper_gamma_ext(-omega, (time_to_start + c) / tau) \
+        - upper_gamma_ext(-omega, (time_to_end + c) / tau)
+    return np.exp(c / tau) * np.power(tau, -omega) * time_fraction
+
+
+def upper_gamma_ext_da(a, x):
+    """
+    Derivative of upper_gamma_ext(a, x) with respect to a, i.e. the
+    integral of t^(a - 1) * log(t) * exp(-t) from x to infinity.
+
+    There is no closed form for it, the integral is evaluated with
+    Gauss-Legendre quadrature after substituting t = exp(v), on
+    [log(x), log(x + 50)]. Beyond that, the integrand is negligible.
+    """
+    x = np.asarray(x, dtype=float)
+    lower = np.log(x)
+    half_width = (np.log(x + 50) - lower) / 2
+    res = np.zeros_like(x)
+    for node, weight in zip(LEGENDRE_NODES, LEGENDRE_WEIGHTS):
+        v = lower + half_width * (node + 1)
+        res = res + weight * v * np.exp(a * v - np.exp(v))
+    return half_width * res
+
+
+def quantize(values, tolerance=None):
+    """
+    Assigns values to bins. If tolerance is None, only identical values
+    share a bin. Otherwise, bins have a relative width of tolerance,
+    and zeros have a bin of their own.
+
+    Returns
+    -------
+    bin_idx : np.ndarray
+        Bin of each value.
+    keys : np.ndarray
+        Key of each bin, which is the value itself if tolerance is None.
+    """
+    if tolerance is None:
+        keys = values
+    else:
+        with np.errstate(divide="ignore"):
+            keys = np.floor(np.log(values) / np.log1p(tolerance))
+    keys, bin_idx = np.unique(keys, return_inverse=True)
+    return bin_idx, keys
+
+
+def compression_bins(Pij, tolerance=None):
+    """
+    Groups sources and pairs of a PairTable for the calculation of
+    compressed sufficient statistics of the log likelihood.
+
+    Pairs are grouped by time distance, and separately by source magnitude
+    and squared spatial distance. Sources are grouped by magnitude and
+    time distance to the start and end of the time window.
+    If tolerance is None, only identical values are grouped, and the
+    statistics are exact. Otherwise, distances within a relative
+    tolerance are grouped.
+
+    The bins only depend on the pairs, not on the parameters, and can be
+    reused in each iteration.
+    """
+    source_group, group_magnitude = quantize(
+        Pij.sources["source_magnitude"].to_numpy())
+
+    time_bin, time_keys = quantize(Pij["time_distance"], tolerance)
+    spatial_bin, spatial_keys = quantize(
+        Pij["spatial_distance_squared"], tolerance)
+    space_keys, space_bin = np.unique(
+        source_group[Pij.source_idx].astype(np.int64) * len(spatial_keys)
+        + spatial_bin,
+        return_inverse=True,
     )
 
-    aftershock_term = ll_aftershock_term(
-        source_events["l_hat"],
-        source_events["G"],
-    ).sum()
+    time_to_start = Pij.sources[
+        "pos_source_to_start_time_distance"].to_numpy()
+    time_to_end = Pij.sources["source_to_end_time_distance"].to_numpy()
+    start_bin, start_keys = quantize(time_to_start, tolerance)
+    end_bin, end_keys = quantize(time_to_end, tolerance)
+    source_keys, source_bin = np.unique(
+        (source_group.astype(np.int64) * len(start_keys) + start_bin)
+        * len(end_keys) + end_bin,
+        return_inverse=True,
+    )
+    source_count = np.bincount(source_bin)
+
+    bins = {
+        "tolerance": tolerance,
+        "time_bin": time_bin.astype(np.int32),
+        "space_bin": space_bin.astype(np.int32),
+        "space_group": space_keys // len(spatial_keys),
+        "group_magnitude": group_magnitude,
+        "source_bin": source_bin,
+        "source_count": source_count,
+        "source_magnitude": group_magnitude[
+            source_keys // len(start_keys) // len(end_keys)],
+    }
+    if tolerance is None:
+        bins["time_distance"] = time_keys
+        bins["spatial_distance_squared"] = \
+            spatial_keys[space_keys % len(spatial_keys)]
+        bins["source_time_to_start"] = \
+            start_keys[source_keys // len(end_keys) % len(start_keys)]
+        bins["source_time_to_end"] = end_keys[source_keys % len(end_keys)]
+    else:
+        # unweighted means. weighted means are used for pairs, unless
+        # their bin has no weight
+        bins["time_distance"] = np.bincount(
+            time_bin, weights=Pij["time_distance"]
+        ) / np.bincount(time_bin)
+        bins["spatial_distance_squared"] = np.bincount(
+            space_bin, weights=Pij["spatial_distance_squared"]
+        ) / np.bincount(space_bin)
+        bins["source_time_to_start"] = np.bincount(
+            source_bin, weights=time_to_start) / source_count
+        bins["source_time_to_end"] = np.bincount(
+            source_bin, weights=time_to_end) / source_count
+    return bins
+
+
+def sufficient_statistics(Pij, source_events, bins=None):
+    """
+    Sufficient statistics of sources and pairs for the log likelihood.
+    The weight of a pair is Pij * zeta_plus_1, the weight of a source is
+    its number of aftershocks l_hat.
+
+    Without bins, the statistics contain all sources and pairs, and pairs
+    are grouped by source. With bins from compression_bins, the weights
+    are aggregated per bin. If bins were quantized, the time and spatial
+    distance of a bin of pairs are the weighted means of its pairs.
+    """
+    weights = Pij["Pij"] * Pij["zeta_plus_1"]
+    l_hat = source_events["l_hat"].to_numpy()
+    log_factorial_l_hat = np.sum(gammaln(l_hat + 1))
+
+    if bins is None:
+        return {
+            "time_distance": Pij["time_distance"],
+            "time_weight": weights,
+            "spatial_distance_squared": Pij["spatial_distance_squared"],
+            "space_weight": weights,
+            "space_group": Pij.source_idx,
+            "group_magnitude": Pij.sources["source_magnitude"].to_numpy(),
+            "group_weight": Pij.sum_by_source(weights),
+            "source_magnitude": source_events["source_magnitude"].to_numpy(),
+            "source_time_to_start": source_events[
+                "pos_source_to_start_time_distance"].to_numpy(),
+            "source_time_to_end": source_events[
+                "source_to_end_time_distance"].to_numpy(),
+            "source_count": np.ones(len(source_events)),
+            "source_l_hat": l_hat,
+            "log_factorial_l_hat": log_factorial_l_hat,
+        }
 
-    # space time distribution term
-    Pij["likelihood_term"] = (
-        (
-            omega * np.log(tau)
-            - np.log(upper_gamma_ext(-omega, c / tau))
-            + np.log(rho)
-            + rho * np.log(d * np.exp(gamma
-                           * (Pij["source_magnitude"] - mc_min)))
+    time_weight = np.bincount(bins["time_bin"], weights=weights)
+    space_weight = np.bincount(bins["space_bin"], weights=weights)
+    time_distance = bins["time_distance"]
+    spatial_distance_squared = bins["spatial_distance_squared"]
+    if bins["tolerance"] is not None:
+        time_distance = np.divide(
+            np.bincount(
+                bins["time_bin"], weights=weights * Pij["time_distance"]),
+            time_weight,
+            out=time_distance.copy(),
+            where=time_weight > 0,
         )
-        - (
-            (1 + rho)
-            * np.log(
-                Pij["spatial_distance_squared"]
-                + (d * np.exp(gamma * (Pij["source_magnitude"] - mc_min)))
-            )
+        spatial_distance_squared = np.divide(
+            np.bincount(
+                bins["space_bin"],
+                weights=weights * Pij["spatial_distance_squared"]),
+            space_weight,
+            out=spatial_distance_squared.copy(),
+            where=space_weight > 0,
         )
-        - (1 + omega) * np.log(Pij["time_distance"] + c)
-        - (Pij["time_distance"] + c) / tau
-        - np.log(np.pi)
-    )
-    distribution_term = Pij["Pij"].mul(
-        Pij["zeta_plus_1"]).mul(Pij["likelihood_term"]).sum()
 
-    total = aftershock_term + distribution_term
+    return {
+        "time_distance": time_distance,
+        "time_weight": time_weight,
+        "spatial_distance_squared": spatial_distance_squared,
+        "space_weight": space_weight,
+        "space_group": bins["space_group"],
+        "group_magnitude": bins["group_magnitude"],
+        "group_weight": np.bincount(
+            bins["space_group"],
+            weights=space_weight,
+            minlength=len(bins["group_magnitude"]),
+        ),
+        "source_magnitude": bins["source_magnitude"],
+        "source_time_to_start": bins["source_time_to_start"],
+        "source_time_to_end": bins["source_time_to_end"],
+        "source_count": bins["source_count"],
+        "source_l_hat": np.bincount(bins["source_bin"], weights=l_hat),
+        "log_factorial_l_hat": log_factorial_l_hat,
+    }
+
+
+def chunked_sufficient_statistics(Pij, source_events, memory_budget=None):
+    """
+    Same as sufficient_statistics without bins, for pairs stored on disk
+    (PairChunks). Statistics of the pairs are not kept in memory, calling
+    statistics["pair_blocks"] yields them for one block of pairs at a time,
+    reading the pairs in chunks of memory_budget bytes. Weights of the
+    pairs are calculated once and written to a temporary file.
+    """
+    l_hat = source_events["l_hat"].to_numpy()
+    source_magnitude = Pij.sources["source_magnitude"].to_numpy()
+    zeta_plus_1 = Pij.targets["zeta_plus_1"].to_numpy()
+
+    pairs = Pij.copy()
+    pairs["weight"] = Pij.disk_buffer("weight")
+    group_weights = []
+    for chunk in Pij.chunks(["Pij"], memory_budget):
+        weights = chunk["Pij"] * zeta_plus_1[chunk.target_idx]
+        pairs["weight"][chunk.start:chunk.stop] = weights
+        for _, block, space_group, block_sources in chunk.blocks():
+            group_weights.append(np.bincount(
+                space_group,
+                weights=weights[block],
+                minlength=len(block_sources),
+            ))
+    columns = ["time_distance", "spatial_distance_squared", "weight"]
+
+    def pair_blocks():
+        for chunk in pairs.chunks(columns, memory_budget):
+            for number, block, space_group, block_sources in chunk.blocks():
+                yield {
+                    "time_distance": chunk["time_distance"][block],
+                    "time_weight": chunk["weight"][block],
+                    "spatial_distance_squared":
+                        chunk["spatial_distance_squared"][block],
+                    "space_weight": chunk["weight"][block],
+                    "space_group": space_group,
+                    "group_magnitude": source_magnitude[block_sources],
+                    "group_weight": group_weights[number],
+                }
+
+    return {
+        "pair_blocks": pair_blocks,
+        "source_magnitude": source_events["source_magnitude"].to_numpy(),
+        "source_time_to_start": source_events[
+            "pos_source_to_start_time_distance"].to_numpy(),
+        "source_time_to_end": source_events[
+            "source_to_end_time_distance"].to_numpy(),
+        "source_count": np.ones(len(source_events)),
+        "source_l_hat": l_hat,
+        "log_factorial_l_hat": np.sum(gammaln(l_hat + 1)),
+    }
+
+
+def distribution_term_by_block(
+        theta, statistics, mc_min, executor=None, term=None):
+    """
+    Same as distribution_term_with_gradient, or as term if given (e.g.
+    time_term_with_gradient). For statistics from
+    chunked_sufficient_statistics or split_statistics, the terms of the
+    blocks of pairs are evaluated by the workers of executor if given, and
+    are summed in the order of the blocks.
+    """
+    if term is None:
+        term = distribution_term_with_gradient
+    if "pair_blocks" not in statistics:
+        return term(theta, statistics, mc_min)
 
-    return -1 * total
+    def block_term(block_statistics):
+        return term(theta, block_statistics, mc_min)
 
+    value = 0
+    gradient = np.zeros(len(theta))
+    for block_value, block_gradient in map_blocks(
+            block_term, statistics["pair_blocks"](), executor):
+        value += block_value
+        gradient += block_gradient
+    return value, gradient
 
-def expected_aftershocks_free_prod(
-        event, params, no_start=False, no_end=False):
-    theta, mc = params
 
-    log10_c, omega, log10_tau, log10_d, gamma, rho = theta
+def split_statistics(statistics, block_size=WORKER_BLOCK_SIZE):
+    """
+    Splits statistics from sufficient_statistics or
+    chunked_sufficient_statistics into blocks of sources and pairs, which
+    can be evaluated in parallel by aftershock_term_by_block and
+    distribution_term_by_block. Blocks of the spatial statistics contain
+    whole groups. The blocks only depend on the number of sources, pairs
+    and groups.
+    """
+    split = dict(statistics)
+    n_sources = len(statistics["source_magnitude"])
+    split["source_blocks"] = [
+        slice(start, min(start + block_size, n_sources))
+        for start in range(0, n_sources, block_size)
+    ]
+    if "pair_blocks" in statistics:
+        return split
+
+    # time and spatial statistics are split separately, spatial statistics
+    # are sorted by group
+    n_time = len(statistics["time_distance"])
+    n_space = len(statistics["spatial_distance_squared"])
+    n_groups = len(statistics["group_magnitude"])
+    n_blocks = max(1, -(-max(n_time, n_space) // block_size))
+    time_bounds = np.linspace(0, n_time, n_blocks + 1).astype(int)
+    group_ptr = np.searchsorted(
+        statistics["space_group"], np.arange(n_groups + 1))
+    group_bounds = np.searchsorted(
+        group_ptr, np.linspace(0, n_space, n_blocks + 1))
+    group_bounds[-1] = n_groups
+
+    blocks = []
+    for i in range(n_blocks):
+        time_block = slice(time_bounds[i], time_bounds[i + 1])
+        first_group, last_group = group_bounds[i], group_bounds[i + 1]
+        space_block = slice(group_ptr[first_group], group_ptr[last_group])
+        blocks.append({
+            "time_distance": statistics["time_distance"][time_block],
+            "time_weight": statistics["time_weight"][time_block],
+            "spatial_distance_squared":
+                statistics["spatial_distance_squared"][space_block],
+            "space_weight": statistics["space_weight"][space_block],
+            "space_group":
+                statistics["space_group"][space_block] - first_group,
+            "group_magnitude":
+                statistics["group_magnitude"][first_group:last_group],
+            "group_weight":
+                statistics["group_weight"][first_group:last_group],
+        })
+    split["pair_blocks"] = lambda: blocks
+    return split
+
+
+def time_term_with_gradient(theta, statistics, mc_min=None):
+    """
+    Time part of distribution_term_with_gradient, and its gradient with
+    respect to log10_c, omega, log10_tau. Only uses the time statistics
+    and the group weights, mc_min is not needed.
+    """
+    log10_c, omega, log10_tau = theta
+    c = np.power(10, log10_c)
+    tau = np.power(10, log10_tau)
+
+    normalization, dnormalization = time_normalization_with_gradient(theta)
+
+    time_weight = statistics["time_weight"]
+    time_plus_c = statistics["time_distance"] + c
+    sum_weights = np.sum(statistics["group_weight"])
+    sum_log_time = np.sum(time_weight * np.log(time_plus_c))
+    sum_time = np.sum(time_weight * time_plus_c)
+    sum_inverse_time = np.sum(time_weight / time_plus_c)
+
+    value = (
+        sum_weights * normalization
+        - (1 + omega) * sum_log_time
+        - sum_time / tau
+    )
+
+    gradient = sum_weights * dnormalization + np.array([
+        # log10_c
+        -np.log(10) * c * (
+            (1 + omega) * sum_inverse_time + sum_weights / tau),
+        # omega
+        -sum_log_time,
+        # log10_tau
+        np.log(10) * sum_time / tau,
+    ])
+
+    return value, gradient
+
+
+def time_normalization_with_gradient(theta):
+    """
+    Logarithm of the normalization of the time kernel over [0, inf),
+    omega * log(tau) - log(upper_gamma(-omega, c / tau)), and its gradient
+    with respect to log10_c, omega, log10_tau (theta).
+    """
+    log10_c, omega, log10_tau = theta
     c = np.power(10, log10_c)
     tau = np.power(10, log10_tau)
+
+    x_0 = c / tau
+    upper_gamma_0 = upper_gamma_ext(-omega, x_0)
+    h_0 = np.power(x_0, -omega - 1) * np.exp(-x_0)
+    dlog_upper_gamma_0_dc = -h_0 / tau / upper_gamma_0
+    dlog_upper_gamma_0_dtau = x_0 * h_0 / tau / upper_gamma_0
+    dlog_upper_gamma_0_domega = \
+        -upper_gamma_ext_da(-omega, x_0) / upper_gamma_0
+
+    value = omega * np.log(tau) - np.log(upper_gamma_0)
+    gradient = np.array([
+        # log10_c
+        -np.log(10) * c * dlog_upper_gamma_0_dc,
+        # omega
+        np.log(tau) - dlog_upper_gamma_0_domega,
+        # log10_tau
+        np.log(10) * tau * (omega / tau - dlog_upper_gamma_0_dtau),
+    ])
+
+    return value, gradient
+
+
+def space_term_with_gradient(theta, statistics, mc_min):
+    """
+    Space part of distribution_term_with_gradient, and its gradient with
+    respect to log10_d, gamma, rho. Only uses the spatial statistics and
+    the groups.
+    """
+    log10_d, gamma, rho = theta
     d = np.power(10, log10_d)
 
-    if no_start:
-        if no_end:
-            event_magnitude, event_kappa = event
-        else:
-            event_magnitude, event_kappa, event_time_to_end = event
-    else:
-        if no_end:
-            event_magnitude, event_kappa, event_time_to_start = event
-        else:
-            event_magnitude,
-            event_kappa,
-            event_time_to_start,
-            event_time_to_end = event
+    m_diff = statistics["group_magnitude"] - mc_min
+    group_weight = statistics["group_weight"]
+    log_spatial_scale = np.log(d) + gamma * m_diff
+    spatial_scale = np.exp(log_spatial_scale)
+    sum_weights = np.sum(group_weight)
+
+    space_weight = statistics["space_weight"]
+    space_group = statistics["space_group"]
+    space_plus_scale = statistics["spatial_distance_squared"] \
+        + spatial_scale[space_group]
+    sum_log_space = np.sum(space_weight * np.log(space_plus_scale))
+    # share of the spatial scale in the denominator of the space kernel
+    scale_share_by_group = np.bincount(
+        space_group,
+        weights=space_weight * spatial_scale[space_group] / space_plus_scale,
+        minlength=len(m_diff),
+    )
+    sum_log_scale = np.sum(group_weight * log_spatial_scale)
 
-    number_factor = event_kappa
-    area_factor = (
-        np.pi * np.power(d * np.exp(gamma
-                         * (event_magnitude - mc)), -1 * rho) / rho
+    value = (
+        sum_weights * (np.log(rho) - np.log(np.pi))
+        + rho * sum_log_scale
+        - (1 + rho) * sum_log_space
     )
 
-    time_factor = np.exp(c / tau) * np.power(tau,
-                                             - omega)  # * gamma_func(-omega)
+    gradient = np.array([
+        # log10_d
+        np.log(10) * (
+            rho * sum_weights
+            - (1 + rho) * np.sum(scale_share_by_group)
+        ),
+        # gamma
+        rho * np.sum(group_weight * m_diff)
+        - (1 + rho) * np.sum(scale_share_by_group * m_diff),
+        # rho
+        sum_weights / rho + sum_log_scale - sum_log_space,
+    ])
 
-    if no_start:
-        time_fraction = upper_gamma_ext(-omega, c / tau)
-    else:
-        time_fraction = upper_gamma_ext(-omega,
-                                        (event_time_to_start + c) / tau)
-    if not no_end:
-        time_fraction = time_fraction - upper_gamma_ext(
-            -omega, (event_time_to_end + c) / tau
-        )
+    return value, gradient
 
-    time_factor = time_factor * time_fraction
 
-    return number_factor * area_factor * time_factor
+def distribution_term_with_gradient(theta, statistics, mc_min):
+    """
+    Space-time distribution term of the log likelihood, and its gradient
+    with respect to log10_c, omega, log10_tau, log10_d, gamma, rho,
+    evaluated on the statistics given by sufficient_statistics.
+    """
+    time_value, time_gradient = time_term_with_gradient(
+        theta[:3], statistics)
+    space_value, space_gradient = space_term_with_gradient(
+        theta[3:], statistics, mc_min)
 
+    return time_value + space_value, np.concatenate(
+        [time_gradient, space_gradient])
 
-def neg_log_likelihood_free_prod(
-    theta,
-    n_hat,
-    Pij,
-    source_events,
-    timewindow_length,
-    timewindow_start,
-    area,
-    beta,
-    mc_min,
-):
-    assert Pij.index.names == (
-        "source_id",
-        "target_id",
-    ), "Pij must have multiindex with names 'source_id', 'target_id'"
-    assert (
-        source_events.index.name == "source_id"
-    ), "source_events must have index with name 'source_id'"
 
-    log10_c, omega, log10_tau, log10_d, gamma, rho = theta
+def aftershock_time_factor(theta, statistics):
+    """
+    Factor of the expected number of aftershocks of each source which
+    depends on log10_c, omega, log10_tau (theta), and the derivatives of
+    its logarithm with respect to them (one row per parameter). Sources
+    are given by their statistics from sufficient_statistics.
+    """
+    log10_c, omega, log10_tau = theta
     c = np.power(10, log10_c)
     tau = np.power(10, log10_tau)
+
+    x_start = (statistics["source_time_to_start"] + c) / tau
+    x_end = (statistics["source_time_to_end"] + c) / tau
+    time_fraction = upper_gamma_ext(-omega, x_start) \
+        - upper_gamma_ext(-omega, x_end)
+    time_factor = np.exp(c / tau) * np.power(tau, -omega) * time_fraction
+
+    h_start = np.power(x_start, -omega - 1) * np.exp(-x_start)
+    h_end = np.power(x_end, -omega - 1) * np.exp(-x_end)
+    dtime_fraction = np.array([
+        -(h_start - h_end) / tau,
+        -(
+            upper_gamma_ext_da(-omega, x_start)
+            - upper_gamma_ext_da(-omega, x_end)
+        ),
+        (x_start * h_start - x_end * h_end) / tau,
+    ])
+    dlog_time_fraction = np.divide(
+        dtime_fraction,
+        time_fraction,
+        out=np.zeros_like(dtime_fraction),
+        where=time_fraction > 0,
+    )
+    dlog_time_factor = np.array([
+        np.log(10) * c * (1 / tau + dlog_time_fraction[0]),
+        -np.log(tau) + dlog_time_fraction[1],
+        np.log(10) * tau * (
+            -(c / np.square(tau) + omega / tau) + dlog_time_fraction[2]),
+    ])
+
+    return time_factor, dlog_time_factor
+
+
+def source_expected_aftershocks(theta, statistics, mc_min):
+    """
+    Expected number of aftershocks of each source, same as
+    expected_aftershocks, for theta = log10_k0, a, ..., rho. The time
+    factor is taken from statistics["source_time_factor"] if given.
+    """
+    log10_k0, a, log10_c, omega, log10_tau, log10_d, gamma, rho = theta
     d = np.power(10, log10_d)
+    m_diff = statistics["source_magnitude"] - mc_min
 
-    source_events["G"] = expected_aftershocks_free_prod(
-        [
-            source_events["source_magnitude"],
-            source_events["source_kappa"],
-            source_events["pos_source_to_start_time_distance"],
-            source_events["source_to_end_time_distance"],
-        ],
-        [theta, mc_min],
+    if "source_time_factor" in statistics:
+        time_factor = statistics["source_time_factor"]
+    else:
+        time_factor, _ = aftershock_time_factor(theta[2:5], statistics)
+
+    return (
+        np.power(10, log10_k0) * np.exp(a * m_diff)
+        * np.pi * np.power(d * np.exp(gamma * m_diff), -1 * rho) / rho
+        * time_factor
     )
 
-    # space time distribution term
-    Pij["likelihood_term"] = (
-        (
-            omega * np.log(tau)
-            - np.log(upper_gamma_ext(-omega, c / tau))
-            + np.log(rho)
-            + rho * np.log(d * np.exp(gamma
-                           * (Pij["source_magnitude"] - mc_min)))
-        )
-        - (
-            (1 + rho)
-            * np.log(
-                Pij["spatial_distance_squared"]
-                + (d * np.exp(gamma * (Pij["source_magnitude"] - mc_min)))
+
+def aftershock_term_with_gradient(theta, statistics, mc_min):
+    """
+    Aftershock term of the log likelihood, the Poisson log likelihood of
+    l_hat with mean G summed over sources, and its gradient with respect
+    to log10_k0, a, log10_c, omega, log10_tau, log10_d, gamma, rho.
+    Sources are given by their statistics from sufficient_statistics. The
+    time factor and its derivatives are taken from statistics if given
+    (see aftershock_time_factor).
+    """
+    log10_k0, a, log10_c, omega, log10_tau, log10_d, gamma, rho = theta
+    d = np.power(10, log10_d)
+
+    if "source_time_factor" in statistics:
+        time_factor = statistics["source_time_factor"]
+        dlog_time_factor = statistics["source_dlog_time_factor"]
+    else:
+        time_factor, dlog_time_factor = aftershock_time_factor(
+            theta[2:5], statistics)
+    statistics = dict(statistics, source_time_factor=time_factor)
+
+    m_diff = statistics["source_magnitude"] - mc_min
+    G = source_expected_aftershocks(theta, statistics, mc_min)
+    count = statistics["source_count"]
+    l_hat = statistics["source_l_hat"]
+
+    # l_hat * log(G) - G - log(l_hat!), summed over sources
+    aftershock_term = (
+        -statistics["log_factorial_l_hat"]
+        - np.sum(count * G)
+        + np.sum(l_hat * np.where(G > 0, np.log(G), -300))
+    )
+
+    # the aftershock term is -G + l_hat * log(G) per source, its
+    # derivative is (l_hat - G) * dlog(G)
+    u = np.where(G > 0, l_hat - count * G, 0)
+    sum_u = np.sum(u)
+    sum_u_m_diff = np.sum(u * m_diff)
+    sum_u_dlog_time_factor = np.sum(u * dlog_time_factor, axis=1)
+
+    aftershock_gradient = np.array([
+        # log10_k0
+        np.log(10) * sum_u,
+        # a
+        sum_u_m_diff,
+        # log10_c, omega, log10_tau
+        *sum_u_dlog_time_factor,
+        # log10_d
+        -rho * np.log(10) * sum_u,
+        # gamma
+        -rho * sum_u_m_diff,
+        # rho
+        -np.sum(u * (np.log(d) + gamma * m_diff)) - sum_u / rho,
+    ])
+
+    return aftershock_term, aftershock_gradient
+
+
+def aftershock_term_by_block(theta, statistics, mc_min, executor=None):
+    """
+    Same as aftershock_term_with_gradient. For statistics from
+    split_statistics, the terms of the blocks of sources are evaluated by
+    the workers of executor if given, and are summed in the order of the
+    blocks.
+    """
+    if "source_blocks" not in statistics:
+        return aftershock_term_with_gradient(theta, statistics, mc_min)
+
+    def block_term(block):
+        block_statistics = {
+            key: statistics[key][block]
+            for key in (
+                "source_magnitude",
+                "source_time_to_start",
+                "source_time_to_end",
+                "source_count",
+                "source_l_hat",
             )
-        )
-        - (1 + omega) * np.log(Pij["time_distance"] + c)
-        - (Pij["time_distance"] + c) / tau
-        - np.log(np.pi)
+        }
+        block_statistics["log_factorial_l_hat"] = 0
+        if "source_time_factor" in statistics:
+            block_statistics["source_time_factor"] = \
+                statistics["source_time_factor"][block]
+            block_statistics["source_dlog_time_factor"] = \
+                statistics["source_dlog_time_factor"][:, block]
+        return aftershock_term_with_gradient(theta, block_statistics, mc_min)
+
+    value = -statistics["log_factorial_l_hat"]
+    gradient = np.zeros(len(theta))
+    for block_value, block_gradient in map_blocks(
+            block_term, statistics["source_blocks"], executor):
+        value += block_value
+        gradient += block_gradient
+    return value, gradient
+
+
+def neg_log_likelihood_with_gradient(
+        theta, statistics, mc_min, executor=None):
+    """
+    Negative complete-data log likelihood (aftershock term of the sources
+    and space-time distribution term of the pairs, weighted by
+    Pij * zeta_plus_1) and its gradient with respect to log10_k0, a,
+    log10_c, omega, log10_tau, log10_d, gamma, rho.
+    Sources and pairs are given by their statistics from
+    sufficient_statistics. With statistics from split_statistics, blocks
+    are evaluated by the workers of executor.
+    """
+    aftershock_term, aftershock_gradient = aftershock_term_by_block(
+        theta, statistics, mc_min, executor)
+    distribution_term, distribution_gradient = distribution_term_by_block(
+        theta[2:], statistics, mc_min, executor)
+
+    total = aftershock_term + distribution_term
+    gradient = aftershock_gradient
+    gradient[2:] += distribution_gradient
+
+    return -1 * total, -1 * gradient
+
+
+def neg_log_likelihood_free_prod_with_gradient(
+        theta, statistics, mc_min, executor=None):
+    """
+    Negative complete-data log likelihood with free_productivity, where
+    only the space-time distribution term of the pairs depends on theta,
+    and its gradient with respect to log10_c, omega, log10_tau, log10_d,
+    gamma, rho. Pairs are given by their statistics from
+    sufficient_statistics.
+    """
+    distribution_term, distribution_gradient = distribution_term_by_block(
+        theta, statistics, mc_min, executor)
+
+    return -1 * distribution_term, -1 * distribution_gradient
+
+
+def with_time_factor(theta, statistics, executor=None):
+    """
+    Copy of statistics with the time factor of the aftershock term and its
+    derivatives (see aftershock_time_factor) for the parameters theta
+    (log10_k0, a, ..., rho). For statistics from split_statistics, the
+    blocks of sources are evaluated by the workers of executor.
+    """
+    def block_factor(block):
+        return aftershock_time_factor(theta[2:5], {
+            "source_time_to_start": statistics["source_time_to_start"][block],
+            "source_time_to_end": statistics["source_time_to_end"][block],
+        })
+
+    factors = map_blocks(
+        block_factor, statistics.get("source_blocks", [slice(None)]),
+        executor)
+    return dict(
+        statistics,
+        source_time_factor=np.concatenate([f for f, _ in factors]),
+        source_dlog_time_factor=np.concatenate(
+            [df for _, df in factors], axis=1),
+    )
+
+
+def profiled_log10_k0(theta, statistics, mc_min):
+    """
+    log10_k0 which maximizes the aftershock term for the other parameters
+    in theta (log10_k0, a, ..., rho). The expected number of aftershocks
+    is proportional to k0, the optimal k0 scales it to the sum of l_hat.
+    """
+    G = source_expected_aftershocks(theta, statistics, mc_min)
+    return theta[0] + np.log10(
+        np.sum(statistics["source_l_hat"])
+        / np.sum(statistics["source_count"] * G)
     )
-    distribution_term = Pij["Pij"].mul(
-        Pij["zeta_plus_1"]).mul(Pij["likelihood_term"]).sum()
 
-    total = distribution_term
 
-    return -1 * total
+def block_neg_log_likelihood_with_gradient(
+        x, theta, free, statistics, mc_min, executor=None,
+        profile_k0=False):
+    """
+    neg_log_likelihood_with_gradient (theta of length 8) or
+    neg_log_likelihood_free_prod_with_gradient (theta of length 6) as a
+    function of the parameters theta[free] = x only, the other parameters
+    keep their values in theta. Only the terms of the log likelihood which
+    depend on theta[free] are evaluated, such that the value differs from
+    the full negative log likelihood by a constant.
+
+    If profile_k0, log10_k0 is set to profiled_log10_k0 for each x. As the
+    derivative with respect to log10_k0 is then zero, the gradient is the
+    same as for fixed log10_k0. The time factor of the aftershock term is
+    taken from statistics if given (see with_time_factor), which is only
+    valid if no time parameter is free.
+    """
+    theta = np.array(theta, dtype=float)
+    theta[free] = x
+    # position of log10_c in theta
+    offset = len(theta) - 6
+
+    value = 0
+    gradient = np.zeros(len(theta))
+    if offset > 0:
+        if "source_time_factor" not in statistics:
+            statistics = with_time_factor(theta, statistics, executor)
+        if profile_k0:
+            theta[0] = profiled_log10_k0(theta, statistics, mc_min)
+        # the aftershock term depends on all parameters
+        value, gradient = aftershock_term_by_block(
+            theta, statistics, mc_min, executor)
+    for first, term in [
+        (offset, time_term_with_gradient),
+        (offset + 3, space_term_with_gradient),
+    ]:
+        if np.any((free >= first) & (free < first + 3)):
+            term_value, term_gradient = distribution_term_by_block(
+                theta[first:first + 3], statistics, mc_min, executor, term)
+            value += term_value
+            gradient[first:first + 3] += term_gradient
+
+    return -1 * value, -1 * gradient[free]
+
+
+def parameter_blocks(n_parameters, fixed=()):
+    """
+    Blocks of parameters which are optimized in turn by
+    block_coordinate_minimize: time parameters (log10_c, omega,
+    log10_tau), and space parameters (log10_d, gamma, rho) together with
+    a, which is strongly coupled to gamma * rho in the expected number of
+    aftershocks. log10_k0 is not part of a block, it is profiled. For
+    n_parameters=6 (free productivity), there is no a. Fixed parameters
+    (indices) are left out.
+    """
+    offset = n_parameters - 6
+    blocks = [
+        list(range(offset, offset + 3)),
+        [*range(1, offset), *range(offset + 3, offset + 6)],
+    ]
+    blocks = [
+        np.array([i for i in block if i not in fixed], dtype=int)
+        for block in blocks
+    ]
+    return [block for block in blocks if len(block) > 0]
+
+
+def block_coordinate_minimize(
+        theta_0, blocks, bounds, statistics, mc_min, executor=None,
+        alpha=None, profile_k0=False, tol=BLOCK_COORDINATE_TOLERANCE,
+        max_cycles=BLOCK_COORDINATE_MAX_CYCLES):
+    """
+    Minimizes the negative log likelihood over theta (without mu, see
+    block_neg_log_likelihood_with_gradient) by minimizing it over one
+    block of parameters at a time, until no parameter changes by more
+    than tol in a cycle over all blocks. Parameters which are not in a
+    block keep their value in theta_0, except log10_k0 if profile_k0. If
+    alpha is given, a - gamma * rho is constrained to alpha. In one block
+    minimization, parameters change by at most BLOCK_COORDINATE_MAX_STEP.
+
+    Returns the parameters, the number of function evaluations and the
+    number of cycles.
+    """
+    theta = np.array(theta_0, dtype=float)
+    nfev = 0
+    for cycle in range(1, max_cycles + 1):
+        theta_before = theta.copy()
+        for free in blocks:
+            block_statistics = statistics
+            if len(theta) == 8 and not np.any((free >= 2) & (free < 5)):
+                # the time factor of the aftershock term stays the same
+                block_statistics = with_time_factor(
+                    theta, statistics, executor)
+            constraints = ()
+            if alpha is not None and 1 in free:
+                def alpha_constant(x, free=free, theta=theta.copy()):
+                    theta[free] = x
+                    return theta[1] - theta[6] * theta[7] - alpha
+                constraints = [NonlinearConstraint(alpha_constant, 0, 0)]
+            res = minimize(
+                block_neg_log_likelihood_with_gradient,
+                x0=theta[free],
+                bounds=[
+                    (max(bounds[i][0], theta[i] - BLOCK_COORDINATE_MAX_STEP),
+                     min(bounds[i][1], theta[i] + BLOCK_COORDINATE_MAX_STEP))
+                    for i in free
+                ],
+                args=(theta.copy(), free, block_statistics, mc_min,
+                      executor, profile_k0),
+                jac=True,
+                tol=1e-12,
+                constraints=constraints,
+            )
+            theta[free] = res.x
+            if profile_k0:
+                theta[0] = np.clip(
+                    profiled_log10_k0(
+                        theta, with_time_factor(theta, statistics, executor),
+                        mc_min),
+                    *bounds[0])
+            nfev += res.nfev
+        if np.max(np.abs(theta - theta_before)) < tol:
+            break
+    return theta, nfev, cycle
+
+
+def central_difference_hessian(function, theta, step=INFORMATION_STEP):
+    """
+    Hessian of a function which returns its value and gradient, by central
+    differences of the gradient.
+    """
+    theta = np.array(theta, dtype=float)
+    hessian = np.empty((len(theta), len(theta)))
+    for i in range(len(theta)):
+        delta = np.zeros(len(theta))
+        delta[i] = step
+        _, gradient_plus = function(theta + delta)
+        _, gradient_minus = function(theta - delta)
+        hessian[i] = (gradient_plus - gradient_minus) / (2 * step)
+    return (hessian + hessian.T) / 2
+
+
+def distribution_term_hessian(theta, statistics, mc_min):
+    """
+    Hessian of distribution_term_with_gradient with respect to log10_c,
+    omega, log10_tau, log10_d, gamma, rho. The sums over pairs are
+    calculated analytically, only the normalization of the time kernel is
+    differentiated numerically.
+    """
+    log10_c, omega, log10_tau, log10_d, gamma, rho = theta
+    c = np.power(10, log10_c)
+    tau = np.power(10, log10_tau)
+    ln10 = np.log(10)
+    sum_weights = np.sum(statistics["group_weight"])
+    hessian = np.zeros((6, 6))
+
+    time_weight = statistics["time_weight"]
+    time_plus_c = statistics["time_distance"] + c
+    sum_inverse_time = np.sum(time_weight / time_plus_c)
+    sum_inverse_time_squared = np.sum(time_weight / np.square(time_plus_c))
+    sum_time = np.sum(time_weight * time_plus_c)
+
+    hessian[:3, :3] = sum_weights * central_difference_hessian(
+        time_normalization_with_gradient, theta[:3])
+    hessian[0, 0] += np.square(ln10) * c * (
+        -(1 + omega) * sum_inverse_time
+        - sum_weights / tau
+        + c * (1 + omega) * sum_inverse_time_squared
+    )
+    hessian[0, 1] += -ln10 * c * sum_inverse_time
+    hessian[0, 2] += np.square(ln10) * c * sum_weights / tau
+    hessian[2, 2] += -np.square(ln10) * sum_time / tau
+
+    # the space kernel depends on log10_d and gamma only through the
+    # logarithm of the spatial scale
+    m_diff = statistics["group_magnitude"] - mc_min
+    space_weight = statistics["space_weight"]
+    space_group = statistics["space_group"]
+    spatial_scale = np.power(10, log10_d) * np.exp(gamma * m_diff)
+    scale_share = spatial_scale[space_group] / (
+        statistics["spatial_distance_squared"] + spatial_scale[space_group])
+    share_variance = np.bincount(
+        space_group,
+        weights=space_weight * scale_share * (1 - scale_share),
+        minlength=len(m_diff),
+    )
+    share_complement = np.bincount(
+        space_group,
+        weights=space_weight * (1 - scale_share),
+        minlength=len(m_diff),
+    )
 
+    hessian[3, 3] = -(1 + rho) * np.square(ln10) * np.sum(share_variance)
+    hessian[3, 4] = -(1 + rho) * ln10 * np.sum(share_variance * m_diff)
+    hessian[4, 4] = -(1 + rho) * np.sum(share_variance * np.square(m_diff))
+    hessian[3, 5] = ln10 * np.sum(share_complement)
+    hessian[4, 5] = np.sum(share_complement * m_diff)
+    hessian[5, 5] = -sum_weights / np.square(rho)
 
-def prod_neg_log_lik(a, args):
-    sk, md, weights = args
-    k_0 = np.sum(weights * sk) / (weights * np.exp(a * md)).sum()
-    ll = (weights * md * (sk - k_0 * np.exp(a * md))).sum()
-    return np.abs(ll)
+    return np.triu(hessian) + np.triu(hessian, 1).T
 
 
-def calc_a_k0_from_kappa(kappa, m_diff, weights=1):
-    res = minimize(
-        prod_neg_log_lik,
-        x0=1.5,
-        args=[kappa, m_diff, weights],
-        bounds=[(0, 5)]
+def aftershock_term_hessian(theta, statistics, mc_min):
+    """
+    Hessian of aftershock_term_with_gradient with respect to log10_k0, a,
+    log10_c, omega, log10_tau, log10_d, gamma, rho. Only the second
+    derivatives of the time factor are calculated numerically.
+    """
+    log10_k0, a, log10_c, omega, log10_tau, log10_d, gamma, rho = theta
+    time_factor, dlog_time_factor = aftershock_time_factor(
+        theta[2:5], statistics)
+    statistics = dict(statistics, source_time_factor=time_factor)
+
+    m_diff = statistics["source_magnitude"] - mc_min
+    G = source_expected_aftershocks(theta, statistics, mc_min)
+    count = statistics["source_count"]
+    u = np.where(G > 0, statistics["source_l_hat"] - count * G, 0)
+    countG = np.where(G > 0, count * G, 0)
+
+    # the aftershock term is -G + l_hat * log(G) per source, its second
+    # derivative is -G * dlog(G) dlog(G)^T + (l_hat - G) * d2log(G)
+    dlog_G = np.array([
+        np.full(len(G), np.log(10)),
+        m_diff,
+        *dlog_time_factor,
+        np.full(len(G), -rho * np.log(10)),
+        -rho * m_diff,
+        -np.log(10) * log10_d - gamma * m_diff - 1 / rho,
+    ])
+    hessian = -1 * (dlog_G * countG) @ dlog_G.T
+
+    hessian[2:5, 2:5] += central_difference_hessian(
+        lambda x: (None, np.sum(
+            u * aftershock_time_factor(x, statistics)[1], axis=1)),
+        theta[2:5],
     )
-    a = res.x[0]
+    hessian[5, 7] += -np.log(10) * np.sum(u)
+    hessian[7, 5] += -np.log(10) * np.sum(u)
+    hessian[6, 7] += -np.sum(u * m_diff)
+    hessian[7, 6] += -np.sum(u * m_diff)
+    hessian[7, 7] += np.sum(u) / np.square(rho)
+
+    return hessian
+
+
+def complete_data_information(theta, statistics, mc_min):
+    """
+    Negative Hessian of the complete-data log likelihood (the objective of
+    the M-step) with respect to log10_k0, a, log10_c, omega, log10_tau,
+    log10_d, gamma, rho (theta), for statistics from
+    sufficient_statistics.
+    """
+    hessian = aftershock_term_hessian(theta, statistics, mc_min)
+    hessian[2:, 2:] += distribution_term_hessian(
+        theta[2:], statistics, mc_min)
+    return -1 * hessian
+
+
+def complete_data_score_covariance(
+        theta, Pij, p_background, zeta_plus_1, mc_min,
+        block_size=WORKER_BLOCK_SIZE):
+    """
+    Covariance of the score of the complete-data log likelihood with
+    respect to log10_mu, log10_k0, a, ..., rho, given the observed events.
+
+    Pij are the pairs after an expectation step for theta (log10_mu,
+    log10_iota, log10_k0, ..., rho), p_background and zeta_plus_1 are the
+    background probabilities and observation factors of their targets.
+    Every target is either background or triggered by exactly one of its
+    sources, independently of the other targets. Its contribution to the
+    score is that of the event which triggered it, times its observation
+    factor.
+
+    The probabilities of the expectation step follow the triggering
+    kernel, whose time part is not normalized over the time window of the
+    source as in the complete-data log likelihood. The covariance is
+    therefore taken between the scores of the triggering kernel and of
+    the complete-data log likelihood, and symmetrized. Both are the same
+    except for the time parameters.
+    """
+    log10_k0, a, log10_c, omega, log10_tau, log10_d, gamma, rho = theta[2:]
+    c = np.power(10, log10_c)
+    tau = np.power(10, log10_tau)
+    ln10 = np.log(10)
+    n_targets = len(Pij.targets)
+
+    m_diff = Pij.sources["source_magnitude"].to_numpy() - mc_min
+    log_spatial_scale = np.log(10) * log10_d + gamma * m_diff
+    _, dlog_time_factor = aftershock_time_factor(
+        theta[4:7],
+        {
+            "source_time_to_start": Pij.sources[
+                "pos_source_to_start_time_distance"].to_numpy(),
+            "source_time_to_end": Pij.sources[
+                "source_to_end_time_distance"].to_numpy(),
+        },
+    )
+    _, dnormalization = time_normalization_with_gradient(theta[4:7])
+    pair_zeta_plus_1 = Pij.targets["zeta_plus_1"].to_numpy()
+
+    # scores of the background events
+    mean_by_target = np.zeros((9, n_targets))
+    mean_by_target[0] = p_background * zeta_plus_1 * ln10
+    kernel_mean_by_target = mean_by_target.copy()
+    second_moment = np.zeros((9, 9))
+    second_moment[0, 0] = np.sum(
+        p_background * np.square(zeta_plus_1 * ln10))
+
+    source_idx = Pij.source_idx
+    target_idx = Pij.target_idx
+    for start in range(0, len(Pij), block_size):
+        block = slice(start, min(start + block_size, len(Pij)))
+        i = source_idx[block]
+        j = target_idx[block]
+        time_plus_c = Pij["time_distance"][block] + c
+        log_space_plus_scale = np.log(
+            Pij["spatial_distance_squared"][block]
+            + np.exp(log_spatial_scale[i]))
+        scale_share = np.exp(log_spatial_scale[i] - log_space_plus_scale)
+
+        # score of the number of aftershocks of the source and of the
+        # space-time density of the pair
+        kernel_score = np.zeros((9, len(i)))
+        kernel_score[1] = ln10
+        kernel_score[2] = m_diff[i]
+        kernel_score[3] = -ln10 * c * (1 + omega) / time_plus_c
+        kernel_score[4] = -np.log(time_plus_c)
+        kernel_score[5] = ln10 * (time_plus_c - c) / tau
+        kernel_score[6] = -(1 + rho) * ln10 * scale_share
+        kernel_score[7] = -(1 + rho) * m_diff[i] * scale_share
+        kernel_score[8] = -log_space_plus_scale
+        kernel_score *= pair_zeta_plus_1[j]
+        score = kernel_score.copy()
+        score[3:6] += pair_zeta_plus_1[j] * (
+            dnormalization[:, None] + dlog_time_factor[:, i]
+            + np.array([-ln10 * c / tau, 0, ln10 * c / tau])[:, None])
+
+        p = Pij["Pij"][block]
+        second_moment += (kernel_score * p) @ score.T
+        for k in range(9):
+            mean_by_target[k] += np.bincount(
+                j, weights=p * score[k], minlength=n_targets)
+            kernel_mean_by_target[k] += np.bincount(
+                j, weights=p * kernel_score[k], minlength=n_targets)
+
+    covariance = second_moment - kernel_mean_by_target @ mean_by_target.T
+    return (covariance + covariance.T) / 2
+
+
+def calc_a_k0_from_kappa(kappa, m_diff, weights=1, a_range=(0, 5)):
+    """
+    Fits the productivity law k0 * exp(a * m_diff) to kappa. For a given
+    a, the optimal k0 scales the law to the sum of kappa. a is the root of
+    sum(weights * m_diff * (kappa - k0 * exp(a * m_diff))), i.e. the mean
+    of m_diff weighted by weights * exp(a * m_diff) equals the mean
+    weighted by weights * kappa.
+    The first mean increases with a (its derivative is the variance), the
+    root is found with Newton steps which fall back to bisection when
+    they leave the bracket. If there is no root in a_range, the closest
+    bound is returned.
+    """
+    kappa = np.asarray(kappa, dtype=float)
+    m_diff = np.asarray(m_diff, dtype=float)
+    weights = np.broadcast_to(np.asarray(weights, dtype=float), m_diff.shape)
+    target = np.sum(weights * kappa * m_diff) / np.sum(weights * kappa)
+
+    low, high = a_range
+    a = np.clip(1.5, low, high)
+    for _ in range(PRODUCTIVITY_MAX_ITERATIONS):
+        # shifted to avoid overflow, the shift cancels in the means
+        law = weights * np.exp(a * (m_diff - np.max(m_diff)))
+        mean = np.sum(law * m_diff) / np.sum(law)
+        variance = np.sum(law * np.square(m_diff - mean)) / np.sum(law)
+        if mean < target:
+            low = a
+        else:
+            high = a
+        a_new = a - (mean - target) / variance if variance > 0 else np.nan
+        if not low < a_new < high:
+            a_new = (low + high) / 2
+        converged = abs(a_new - a) < PRODUCTIVITY_TOLERANCE
+        a = a_new
+        if converged:
+            break
+
     log10_k0 = np.log10(np.sum(kappa * weights)
                         / (np.exp(a * m_diff) * weights).sum())
     return a, log10_k0
@@ -638,10 +1832,148 @@ def read_shape_coords(shape_coords):
         else:
             from numpy import array  # noqa
 
-            coordinates = np.array(eval(shape_coords))
+            coordinates = np.array(eval(shape_coords))
+    else:
+        coordinates = np.array(shape_coords)
+    return coordinates
+
+
+def catalog_format(fn_catalog):
+    """parquet, feather, npz or csv, from the extension of fn_catalog."""
+    extension = os.path.splitext(str(fn_catalog))[1].lower()
+    return CATALOG_FORMATS.get(extension, "csv")
+
+
+def read_catalog(fn_catalog, three_dim=False, columns=()):
+    """
+    Reads a catalog from a parquet, feather, npz or csv file.
+
+    Of parquet, feather and npz files, only id, time, magnitude, the
+    coordinates (latitude and longitude, or x, y and z if three_dim),
+    mc_current (if present) and the given columns are read. time is
+    stored either as datetime or as int64 nanoseconds since the epoch.
+    csv files are read with all columns, time is parsed from ISO 8601
+    strings.
+
+    Parameters
+    ----------
+    fn_catalog : str
+        Path of the catalog.
+    three_dim : bool, default False
+        If True, x, y and z are read instead of latitude and longitude.
+    columns : list of str, optional
+        Other numeric columns which are needed, e.g. the column of
+        bg_term. They must be in the file.
+
+    Returns
+    -------
+    catalog : pd.DataFrame
+        Catalog indexed by id, with time as datetime64[ns].
+    """
+    file_format = catalog_format(fn_catalog)
+    if file_format == "csv":
+        catalog = pd.read_csv(
+            fn_catalog,
+            index_col=0,
+            dtype={"url": str, "alert": str},
+        )
+        try:
+            catalog["time"] = pd.to_datetime(
+                catalog["time"], format="ISO8601")
+        except ValueError:
+            catalog["time"] = pd.to_datetime(catalog["time"])
+        return catalog
+
+    required = CATALOG_COLUMNS_3D if three_dim else CATALOG_COLUMNS
+    required = required + [
+        column for column in columns if column not in required]
+    if file_format == "npz":
+        with np.load(fn_catalog) as data:
+            names = data.files
+    elif file_format == "parquet":
+        import pyarrow.parquet as pq
+
+        names = pq.read_schema(fn_catalog).names
+    else:
+        import pyarrow.ipc as ipc
+
+        with ipc.open_file(fn_catalog) as reader:
+            names = reader.schema.names
+
+    missing = [column for column in required if column not in names]
+    if missing:
+        raise ValueError(
+            "Catalog {} has no column(s) {}.".format(fn_catalog, missing))
+    columns = ["id"] if "id" in names else []
+    columns += required + [
+        column for column in OPTIONAL_CATALOG_COLUMNS
+        if column in names and column not in required
+    ]
+
+    if file_format == "npz":
+        with np.load(fn_catalog) as data:
+            catalog = pd.DataFrame({column: data[column]
+                                    for column in columns})
+    elif file_format == "parquet":
+        catalog = pd.read_parquet(fn_catalog, columns=columns)
+    else:
+        catalog = pd.read_feather(fn_catalog, columns=columns)
+
+    if "id" in columns:
+        catalog = catalog.set_index("id")
+    else:
+        catalog.index.name = "id"
+    if not pd.api.types.is_datetime64_any_dtype(catalog["time"]):
+        catalog["time"] = pd.to_datetime(
+            catalog["time"].to_numpy(np.int64), unit="ns")
+    for column in catalog.columns.drop("time"):
+        catalog[column] = catalog[column].astype(np.float64)
+    return catalog
+
+
+def write_catalog(catalog, fn_catalog, three_dim=False, columns=()):
+    """
+    Writes the columns of catalog used in the inversion, and the given
+    columns (e.g. the column of bg_term), to a parquet, feather or npz
+    file which can be read with read_catalog. time is stored as int64
+    nanoseconds since the epoch, the other columns as float64. String ids
+    are stored as fixed width strings, such that npz files can be read
+    without pickle.
+    """
+    file_format = catalog_format(fn_catalog)
+    if file_format == "csv":
+        raise ValueError(
+            "{} is not a parquet, feather or npz file.".format(fn_catalog))
+    required = CATALOG_COLUMNS_3D if three_dim else CATALOG_COLUMNS
+    required = required + [
+        column for column in columns if column not in required]
+    columns = required + [
+        column for column in OPTIONAL_CATALOG_COLUMNS
+        if column in catalog.columns and column not in required
+    ]
+    data = {"id": column_array(catalog.index)}
+    data["time"] = pd.to_datetime(catalog["time"]).to_numpy(
+        "datetime64[ns]").view(np.int64)
+    for column in columns[1:]:
+        data[column] = catalog[column].to_numpy(np.float64)
+
+    if file_format == "npz":
+        np.savez(fn_catalog, **data)
+    elif file_format == "parquet":
+        pd.DataFrame(data).to_parquet(fn_catalog, index=False)
     else:
-        coordinates = np.array(shape_coords)
-    return coordinates
+        pd.DataFrame(data).to_feather(fn_catalog)
+
+
+def read_stored_events(result, table):
+    """
+    source_events or target_events (table) of a result of store_results,
+    given by the content of its parameters json.
+    """
+    if "fn_bundle" in result:
+        return Bundle(result["fn_bundle"]).read(table)["frame"]
+    fn = result["fn_src"] if table == "source_events" else result["fn_ip"]
+    return pd.read_csv(fn, index_col=0)
 
 
 def calc_diff_to_before(a, b):
@@ -663,6 +1995,73 @@ def calc_diff_to_before(a, b):
     )
 
 
+# columns of a pair table which are constant per source or per target
+class AlphaConstraint:
+    """
+    Constraint a - rho * gamma = alpha, zero if it is satisfied. A class
+    instead of a closure, such that constraints can be pickled.
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+
+    def __call__(self, x):
+        return x[1] - x[6] * x[7] - self.alpha
+
+
+class FixedParameterConstraint:
+    """
+    Constraint x[positions] = values, zero if it is satisfied.
+    """
+
+    def __init__(self, positions, values):
+        self.positions = np.asarray(positions, dtype=int)
+        self.values = np.asarray(values, dtype=float)
+
+    def __call__(self, x):
+        return np.asarray(x)[self.positions] - self.values
+
+
+# calculation shared with the worker processes of invert_multistart.
+# with fork, the pairs are inherited and not copied
+multistart_calculation = None
+
+
+def init_multistart_worker(calculation):
+    global multistart_calculation
+    multistart_calculation = calculation
+
+
+def run_multistart_chain(theta_0):
+    """
+    Runs the EM algorithm on a copy of the shared calculation, starting
+    from theta_0. The pairs are not copied.
+    """
+    calculation = copy.copy(multistart_calculation)
+    calculation.source_events = calculation.source_events.copy()
+    calculation.target_events = calculation.target_events.copy()
+    calculation.theta_0 = theta_0
+    calculation.theta = None
+    calculation.inversion_done = False
+    calculation.initialize_em_state()
+
+    theta = calculation.invert()
+
+    em_state = {}
+    if calculation.free_productivity:
+        em_state["source_kappa"] = calculation.source_events["source_kappa"]
+    if calculation.free_background:
+        em_state["P_background"] = calculation.target_events["P_background"]
+    return {
+        "initial_values": theta_0,
+        "final_parameters": theta,
+        "log_likelihood": calculation.log_likelihood(
+            parameter_dict2array(theta)),
+        "n_iterations": calculation.i,
+        "em_state": em_state,
+    }
+
+
 class ETASParameterCalculation:
     def __init__(self, metadata: dict):
         """
@@ -682,6 +2081,10 @@ class ETASParameterCalculation:
                     id needs to contain a unique identifier for each event
                     time contains datetime of event occurrence
                     see example_catalog.csv for an example
+                    Parquet (.parquet), feather (.feather) and npz (.npz)
+                    files are read with the required columns and the
+                    column of bg_term only, see read_catalog and
+                    write_catalog.
                     Either 'fn_catalog' or 'catalog' need to be defined.
             - catalog: Dataframe with a catalog, same requirements as for the
                     csv above apply.
@@ -742,6 +2145,181 @@ class ETASParameterCalculation:
             - bw_sq: optional, squared bandwidth of Gaussian kernel used for
                     free_background/free_productivity mode
                 default: 2
+            - background_density: optional, how the background density of
+                    free_background is estimated. "pairs" sums the kernel
+                    over the pairs of the triggering kernel (earlier
+                    events within the Coppersmith radius), targets without
+                    pairs get no background rate. "neighbours" sums the
+                    kernel over all target events up to the distance at
+                    which it drops below BACKGROUND_KERNEL_CUTOFF. The
+                    kernel weights are calculated once, with a KD-tree
+                    over the target events.
+                default: "pairs"
+            - pruning_tolerance: optional, if given, pairs of events are
+                    additionally pruned in time and space based on the
+                    triggering kernel defined by theta_0: per source, at
+                    most this fraction of the kernel mass is discarded.
+                    The discarded mass is reported after calculating the
+                    distances. Pairs are not pruned if theta_0 is neither
+                    given nor taken from warm_start, random initial values
+                    would discard arbitrary pairs.
+                default: None
+            - float32_distances: optional, if True, time and space
+                    distances between events are stored in single
+                    precision to reduce memory usage.
+                default: False
+            - compress_pairs: optional, if True, the likelihood in the
+                    M-step is evaluated on aggregates of sources and pairs.
+                    Pairs are grouped by source magnitude, time distance
+                    and spatial distance, sources by magnitude and time
+                    distance to start and end of the time window. Without
+                    compression_tolerance, only identical values are
+                    grouped, and the result is exact.
+                default: False
+            - compression_tolerance: optional, relative width of the bins
+                    of time distances and squared spatial distances in
+                    which sources and pairs are grouped if compress_pairs
+                    is True.
+                default: None
+            - accelerate_em: optional, if True, the EM iterations are
+                    accelerated with SQUAREM (Varadhan and Roland, 2008).
+                    Extrapolated parameters are kept within RANGES and
+                    fixed_parameters, and a plain EM step is taken
+                    whenever the log likelihood decreases. Not available
+                    with free_productivity, free_background or bg_term.
+                default: False
+            - pair_cache_dir: optional, directory of an on-disk cache for
+                    the pairs and the source and target events. Entries
+                    are identified by the filtered catalog and the
+                    settings which affect the pairs, and are reused by
+                    prepare().
+                default: None (no cache)
+            - pair_cache_size_limit: optional, maximum size of the cache
+                    in bytes, including the files of the pairs in
+                    pair_chunk_dir. Least recently used entries are
+                    removed together with their files.
+                default: 5 GB
+            - warm_start: optional, path to the parameters json of a
+                    previous result, as written by store_results. Its
+                    final parameters are used as theta_0, its beta is used
+                    unless beta is given, and with free_productivity or
+                    free_background, source_kappa and P_background of its
+                    events are used as initial values. New events get the
+                    values of the fitted productivity law, or the mean
+                    background probability.
+                default: None
+            - pair_chunk_dir: optional, directory in which the pairs are
+                    stored as memory-mapped .npy files, sorted by target,
+                    instead of in memory. The expectation step and the
+                    likelihood of the M-step process the pairs in chunks
+                    of pair_memory_budget bytes. Not available with
+                    compress_pairs.
+                default: None (pairs in memory)
+            - pair_memory_budget: optional, approximate memory in bytes
+                    for one chunk of pairs if pair_chunk_dir is given. The
+                    results do not depend on it.
+                default: 1 GB
+            - n_workers: optional, number of threads which evaluate the
+                    expectation step and the likelihood of the M-step in
+                    parallel. With 1, no threads are used, as with None.
+                    The expectation step sums the pairs of each source
+                    and target in the same order with and without
+                    threads, its results are the same for all values.
+                    With threads, the M-step adds the likelihood of
+                    blocks of fixed size in the order of the blocks: its
+                    results are bitwise identical for all values of 2 or
+                    more, and can differ in the last digits from those
+                    with None or 1, which are identical to each other.
+                    The threads of a number of workers are kept until
+                    shutdown_worker_pools is called, or until the
+                    interpreter exits.
+                default: None (no threads)
+            - sparsify_threshold: optional, pairs whose Pij is below this
+                    value in sparsify_iterations consecutive EM iterations
+                    are left out of the following expectation steps and
+                    M-steps. Every sparsify_check_interval iterations,
+                    the triggering kernel of the left out pairs is
+                    evaluated at the current parameters, and divided by
+                    the total rate of their target in the expectation
+                    step. As the left out pairs would only add to the
+                    total rate, the sum is an upper bound of their Pij.
+                    It is stored per iteration as dropped_pair_bounds
+                    (None in iterations without a check). All pairs are
+                    used again if the bound exceeds sparsify_tolerance
+                    times the number of target events, if the
+                    parameters change by more than sparsify_reset in an
+                    iteration, and in the last expectation step. Not
+                    available with free_background with
+                    background_density "pairs", or with pair_chunk_dir.
+                default: None (all pairs are used)
+            - sparsify_iterations: optional, see sparsify_threshold.
+                default: 3
+            - sparsify_tolerance: optional, see sparsify_threshold.
+                default: 0.001
+            - sparsify_check_interval: optional, see sparsify_threshold.
+                    The check costs one evaluation of the kernel for the
+                    left out pairs.
+                default: 1
+            - sparsify_reset: optional, see sparsify_threshold. The change
+                    of parameters is measured as in the convergence
+                    criterion of the EM algorithm.
+                default: 0.1
+            - m_step: optional, "joint" minimizes the likelihood over all
+                    parameters at once, "block_coordinate" minimizes it
+                    alternately over the productivity, time and space
+                    parameters, evaluating only the terms and pair
+                    statistics which depend on the parameters of the
+                    block, until the parameters change by less than
+                    BLOCK_COORDINATE_TOLERANCE. Fixed parameters are left
+                    out of the blocks, with a constrained alpha, the
+                    productivity and space parameters form one block.
+                default: "joint"
+            - minibatch_size: optional, number of target events of the
+                    first mini-batch. If given, the inversion starts with
+                    EM iterations on random subsets of the target events.
+                    The subset stays the same until the batch grows, and
+                    each batch contains the previous one.
+                    n_hat, i_hat, l_hat and the weights of the pairs in
+                    the M-step are scaled by the number of target events
+                    divided by the batch size, which makes them unbiased
+                    estimates of their values for all target events. The
+                    batch size is multiplied by minibatch_growth when the
+                    parameters change by less than minibatch_tolerance in
+                    an iteration, or after MINIBATCH_MAX_ITERATIONS
+                    iterations. When the batch would contain all target
+                    events, the EM algorithm continues with all of them
+                    until convergence. Not available with
+                    free_productivity, free_background or pair_chunk_dir.
+                    Each mini-batch iteration is cheaper than a full one,
+                    but the M-step still evaluates the terms of all
+                    source events, and the full iterations at the end are
+                    needed anyway. Mini-batches only pay off when full
+                    iterations are expensive (many pairs per target event)
+                    and many of them are needed, e.g. 29% less run time
+                    for 4659 target events with 6.8 million pairs and 38
+                    EM iterations. On the example catalogs (at most 2350
+                    target events with about 110 pairs each, about 10
+                    iterations) the inversion is up to 70% slower, see
+                    benchmark_minibatch and benchmark_minibatch_simulated
+                    in benchmark_inversion.py.
+                default: None (no mini-batches)
+            - minibatch_growth: optional, see minibatch_size. Must be
+                    greater than 1, the batch grows by at least one target
+                    event.
+                default: 2
+            - minibatch_tolerance: optional, see minibatch_size. The change
+                    of parameters is measured as in the convergence
+                    criterion of the EM algorithm.
+                default: 0.05
+            - minibatch_seed: optional, seed of the random mini-batches.
+                default: None
+            - estimate_uncertainty: optional, if True, standard errors and
+                    the covariance matrix of the parameters are calculated
+                    from the observed information matrix at the end of the
+                    inversion, see calculate_parameter_uncertainty. Not
+                    available with free_productivity, free_background,
+                    bg_term or pair_chunk_dir.
+                default: False
             - name: optional, give the model a name
             - id: optional, give the model an ID
         """
@@ -759,6 +2337,11 @@ class ETASParameterCalculation:
         )
         if self.inner_shape_coords is not None:
             self.logger.debug("  using inner shape coords!")
+        self.inner_region = (
+            Region(self.inner_shape_coords)
+            if self.inner_shape_coords is not None
+            else None
+        )
         self.fn_catalog = metadata.get("fn_catalog", None)
         self.catalog = metadata.get("catalog", None)
 
@@ -791,8 +2374,61 @@ class ETASParameterCalculation:
         self.calculation_date = dt.datetime.now()
 
         self.free_background = metadata.get("free_background", False)
+        self.background_density = metadata.get("background_density", "pairs")
+        self.background_weights = None
+        self.time_integral_cache = None
+        self.primary_source_positions = None
         self.free_productivity = metadata.get("free_productivity", False)
         self.bg_term = metadata.get("bg_term", None)
+        self.pruning_tolerance = metadata.get("pruning_tolerance", None)
+        self.pruned_kernel_mass = None
+        # True if theta_0 was drawn randomly in prepare()
+        self.random_theta_0 = False
+        self.float32_distances = metadata.get("float32_distances", False)
+        self.compress_pairs = metadata.get("compress_pairs", False)
+        self.compression_tolerance = metadata.get(
+            "compression_tolerance", None)
+        self.compression_bins = None
+        self.accelerate_em = metadata.get("accelerate_em", False)
+        self.pair_cache_dir = metadata.get("pair_cache_dir", None)
+        self.pair_cache_size_limit = metadata.get(
+            "pair_cache_size_limit", 5 * 1024 ** 3)
+        self.warm_start = metadata.get("warm_start", None)
+        self.warm_start_result = None
+        self.pair_chunk_dir = metadata.get("pair_chunk_dir", None)
+        self.pair_memory_budget = metadata.get(
+            "pair_memory_budget", 1024 ** 3)
+        self.n_workers = metadata.get("n_workers", None)
+        self.sparsify_threshold = metadata.get("sparsify_threshold", None)
+        self.sparsify_iterations = metadata.get("sparsify_iterations", 3)
+        self.sparsify_tolerance = metadata.get("sparsify_tolerance", 0.001)
+        self.sparsify_check_interval = metadata.get(
+            "sparsify_check_interval", 1)
+        self.sparsify_reset = metadata.get("sparsify_reset", 0.1)
+        self.m_step = metadata.get("m_step", "joint")
+        self.minibatch_size = metadata.get("minibatch_size", None)
+        self.minibatch_growth = metadata.get("minibatch_growth", 2)
+        self.minibatch_tolerance = metadata.get("minibatch_tolerance", 0.05)
+        self.minibatch_seed = metadata.get("minibatch_seed", None)
+        self.minibatch_sizes = None
+        if self.minibatch_size is not None and self.minibatch_size < 1:
+            raise ValueError(
+                "minibatch_size must be at least 1, not {}.".format(
+                    self.minibatch_size))
+        if self.minibatch_growth <= 1:
+            raise ValueError(
+                "minibatch_growth must be greater than 1, not {}.".format(
+                    self.minibatch_growth))
+        self.estimate_uncertainty = metadata.get(
+            "estimate_uncertainty", False)
+        self.standard_errors = None
+        self.parameter_covariance = None
+        self.active_pairs = None
+        self.pair_below_threshold = None
+        self.sparse_distances = None
+        self.dropped_distances = None
+        self.active_pair_counts = None
+        self.dropped_pair_bounds = None
 
         self.logger.info(
             "  Time Window: \n      {} (aux start)\n      {} "
@@ -813,21 +2449,20 @@ class ETASParameterCalculation:
         self.inversion_done = False
 
         if not isinstance(self.catalog, pd.DataFrame):
-            self.catalog = pd.read_csv(
-                self.fn_catalog,
-                index_col=0,
-                parse_dates=["time"],
-                dtype={"url": str, "alert": str},
-            )
-            self.catalog["time"] = pd.to_datetime(
-                self.catalog["time"], format="ISO8601"
-            )
+            self.catalog = read_catalog(
+                self.fn_catalog, self.three_dim, self.catalog_columns())
 
+        # pairs which are read from a bundle when first accessed, see
+        # load_calculation
+        self.lazy_pairs = {}
         self.distances = None
         self.source_events = None
         self.target_events = None
 
         self.area = None
+        # the region of shape_coords can be set before prepare(), e.g. to
+        # reuse it for many catalogs of the same region
+        self.region = None
         self.__theta_0 = None
         self.theta_0 = metadata.get("theta_0")
         self.__fixed_parameters = None
@@ -839,12 +2474,32 @@ class ETASParameterCalculation:
         self.n_hat = None
         self.i_hat = None
         self.i = metadata.get("n_iterations")
+        self.multistart_results = None
+
+    def catalog_columns(self):
+        """
+        Columns which are read from columnar catalog files in addition to
+        those of read_catalog.
+        """
+        return [self.bg_term] if self.bg_term is not None else []
 
     @classmethod
-    def load_calculation(cls, metadata: dict):
+    def load_calculation(cls, metadata: dict, verify_bundle=False):
+        """
+        Loads a calculation stored with store_results. metadata is the
+        content of its parameters json.
+
+        If the results were stored as a bundle, the tables are read from
+        it, with memory-mapped arrays, and pij and distances are only read
+        when they are first accessed. With verify_bundle, the checksums of
+        the files of each table are verified when it is read.
+        """
         obj = cls.__new__(cls)
 
         obj.logger = logging.getLogger(__name__)
+        obj.lazy_pairs = {}
+        obj.pij = None
+        obj.distances = None
         obj.name = metadata["name"]
         obj.id = metadata["id"]
 
@@ -853,6 +2508,7 @@ class ETASParameterCalculation:
             "  model is named {}, has ID {}".format(obj.name, obj.id))
 
         obj.shape_coords = read_shape_coords(metadata["shape_coords"])
+        obj.region = None
 
         obj.fn_catalog = metadata["fn_catalog"]
 
@@ -873,8 +2529,52 @@ class ETASParameterCalculation:
         obj.calculation_date = metadata["calculation_date"]
 
         obj.free_background = metadata["free_background"]
+        obj.background_density = metadata.get("background_density", "pairs")
+        obj.background_weights = None
+        obj.time_integral_cache = None
+        obj.primary_source_positions = None
         obj.free_productivity = metadata["free_productivity"]
         obj.bg_term = metadata["bg_term"]
+        obj.pruning_tolerance = metadata.get("pruning_tolerance", None)
+        obj.pruned_kernel_mass = metadata.get("pruned_kernel_mass", None)
+        obj.random_theta_0 = False
+        obj.float32_distances = metadata.get("float32_distances", False)
+        obj.compress_pairs = metadata.get("compress_pairs", False)
+        obj.compression_tolerance = metadata.get(
+            "compression_tolerance", None)
+        obj.compression_bins = None
+        obj.accelerate_em = metadata.get("accelerate_em", False)
+        obj.pair_cache_dir = metadata.get("pair_cache_dir", None)
+        obj.pair_cache_size_limit = metadata.get(
+            "pair_cache_size_limit", 5 * 1024 ** 3)
+        obj.warm_start = metadata.get("warm_start", None)
+        obj.warm_start_result = None
+        obj.pair_chunk_dir = metadata.get("pair_chunk_dir", None)
+        obj.pair_memory_budget = metadata.get(
+            "pair_memory_budget", 1024 ** 3)
+        obj.n_workers = metadata.get("n_workers", None)
+        obj.sparsify_threshold = metadata.get("sparsify_threshold", None)
+        obj.sparsify_iterations = metadata.get("sparsify_iterations", 3)
+        obj.sparsify_tolerance = metadata.get("sparsify_tolerance", 0.001)
+        obj.sparsify_check_interval = metadata.get(
+            "sparsify_check_interval", 1)
+        obj.sparsify_reset = metadata.get("sparsify_reset", 0.1)
+        obj.m_step = metadata.get("m_step", "joint")
+        obj.minibatch_size = metadata.get("minibatch_size", None)
+        obj.minibatch_growth = metadata.get("minibatch_growth", 2)
+        obj.minibatch_tolerance = metadata.get("minibatch_tolerance", 0.05)
+        obj.minibatch_seed = metadata.get("minibatch_seed", None)
+        obj.minibatch_sizes = metadata.get("minibatch_sizes")
+        obj.estimate_uncertainty = metadata.get(
+            "estimate_uncertainty", False)
+        obj.standard_errors = metadata.get("standard_errors")
+        obj.parameter_covariance = metadata.get("parameter_covariance")
+        obj.active_pairs = None
+        obj.pair_below_threshold = None
+        obj.sparse_distances = None
+        obj.dropped_distances = None
+        obj.active_pair_counts = metadata.get("active_pair_counts")
+        obj.dropped_pair_bounds = metadata.get("dropped_pair_bounds")
 
         obj.logger.info(
             "  Time Window: \n      {} (aux start)\n      {} "
@@ -897,15 +2597,16 @@ class ETASParameterCalculation:
         else:
             obj.oef_setting = None
 
-        if obj.fn_catalog is not None:
-            obj.catalog = pd.read_csv(
-                obj.fn_catalog,
-                index_col=0,
-                parse_dates=["time"],
-                dtype={"url": str, "alert": str},
-            )
-            obj.catalog["time"] = pd.to_datetime(
-                obj.catalog["time"], format="ISO8601")
+        bundle = None
+        if "fn_bundle" in metadata:
+            bundle = Bundle(metadata["fn_bundle"], verify=verify_bundle)
+
+        if bundle is not None and "catalog" in bundle:
+            # the catalog in the bundle is already filtered
+            obj.catalog = None
+        elif obj.fn_catalog is not None:
+            obj.catalog = read_catalog(
+                obj.fn_catalog, obj.three_dim, obj.catalog_columns())
         else:
             obj.catalog = None
             if not obj.oef_setting:
@@ -920,10 +2621,22 @@ class ETASParameterCalculation:
         obj.n_hat = metadata["n_hat"]
         obj.i_hat = metadata["i_hat"]
         obj.i = metadata["n_iterations"]
+        obj.multistart_results = metadata.get("multistart_results")
 
         if obj.catalog is not None:
             obj.catalog = obj.filter_catalog(obj.catalog)
 
+        if bundle is not None:
+            if "catalog" in bundle:
+                obj.catalog = bundle.read("catalog")["frame"]
+            obj.source_events = bundle.read("source_events")["frame"]
+            obj.target_events = bundle.read("target_events")["frame"]
+            for table in ("pij", "distances"):
+                if table in bundle:
+                    obj.lazy_pairs[table] = functools.partial(
+                        PairTable.from_bundle, bundle, table)
+            return obj
+
         if "fn_src" in metadata:
             obj.source_events = pd.read_csv(
                 metadata["fn_src"],
@@ -946,28 +2659,34 @@ class ETASParameterCalculation:
                                     Only ok to proceed in specific use cases.")
 
         if "fn_pij" in metadata:
-            obj.pij = pd.read_csv(
+            obj.pij = PairTable.from_frame(pd.read_csv(
                 metadata["fn_pij"],
                 index_col=["source_id", "target_id"],
                 parse_dates=["target_time"],
-            )
+            ))
         else:
             if not obj.oef_setting:
                 obj.logger.warning("Pij could not be loaded.")
 
         if "fn_dist" in metadata:
-            obj.distances = pd.read_csv(
+            obj.distances = PairTable.from_frame(pd.read_csv(
                 metadata["fn_dist"],
                 index_col=["source_id", "target_id"],
                 parse_dates=["target_time"],
-            )
+            ))
         else:
             if not obj.oef_setting:
                 obj.logger.warning("Distances could not be loaded.")
 
         return obj
 
-    def prepare(self):
+    def prepare(self, previous_distances=None):
+        """
+        Filters the catalog, calculates the pairs of potentially related
+        events and prepares source and target events for the inversion.
+        Pairs of a previous PairTable (previous_distances) are reused, see
+        calculate_distances.
+        """
         if self.preparation_done:
             self.logger.warning("Preparation already done, aborting...")
             pass
@@ -976,18 +2695,78 @@ class ETASParameterCalculation:
         self.logger.info("  filtering catalog...")
         self.catalog = self.filter_catalog(self.catalog)
 
+        if self.warm_start is not None:
+            self.logger.info(
+                "  warm start from {}".format(self.warm_start))
+            with open(self.warm_start, "r") as f:
+                self.warm_start_result = json.load(f)
+            self.theta_0 = self.warm_start_result["final_parameters"]
+            if self.beta is None:
+                self.beta = self.warm_start_result["beta"]
+
         if self.__theta_0 is not None:
             self.logger.info("  using input initial values for theta")
         else:
             self.logger.info("  randomly chosing initial values for theta")
             self.__theta_0 = create_initial_values()
-
-        self.logger.info("  calculating distances...")
-        self.distances = self.calculate_distances()
-
-        self.logger.info("  preparing source and target events..")
-        self.target_events = self.prepare_target_events()
-        self.source_events = self.prepare_source_events()
+            self.random_theta_0 = True
+
+        key = None
+        cached = None
+        # with pair_chunk_dir, the files of the pairs of an entry are in
+        # pair_chunk_dir/<key>
+        cache_data_dirs = (
+            [self.pair_chunk_dir] if self.pair_chunk_dir is not None else [])
+        if self.pair_cache_dir is not None:
+            key = cache_key(self.catalog, self.pair_cache_settings())
+            cached = load_cache_entry(
+                self.pair_cache_dir, key, cache_data_dirs)
+
+        if cached is not None:
+            self.logger.info(
+                "  using cached distances and events ({})".format(key))
+            # calculate_distances rounds the magnitudes of the catalog and
+            # can change the area, these are restored as well
+            self.catalog = cached["catalog"]
+            self.area = cached["area"]
+            self.pruned_kernel_mass = cached["pruned_kernel_mass"]
+            self.distances = cached["distances"]
+            self.target_events = cached["target_events"]
+            self.source_events = cached["source_events"]
+        else:
+            self.logger.info("  calculating distances...")
+            chunk_dir = None
+            if key is not None and self.pair_chunk_dir is not None:
+                # cached pairs on disk are not overwritten by pairs of
+                # another catalog
+                chunk_dir = os.path.join(self.pair_chunk_dir, key)
+            self.distances = self.calculate_distances(
+                previous_distances, chunk_dir)
+
+            self.logger.info("  preparing source and target events..")
+            self.target_events = self.prepare_target_events()
+            self.source_events = self.prepare_source_events()
+            self.distances = self.distances.align(
+                self.source_events.index, self.target_events.index)
+
+            if key is not None:
+                self.logger.info(
+                    "  storing distances and events in cache ({})".format(
+                        key))
+                store_cache_entry(
+                    self.pair_cache_dir,
+                    key,
+                    {
+                        "catalog": self.catalog,
+                        "area": self.area,
+                        "pruned_kernel_mass": self.pruned_kernel_mass,
+                        "distances": self.distances,
+                        "target_events": self.target_events,
+                        "source_events": self.source_events,
+                    },
+                    self.pair_cache_size_limit,
+                    cache_data_dirs,
+                )
 
         if isinstance(self.beta, float):
             self.b_positive = False
@@ -1016,17 +2795,7 @@ class ETASParameterCalculation:
             self.logger.info(
                 "  beta of primary catalog is {}".format(self.beta))
 
-        if self.free_productivity:
-            self.source_events["source_kappa"] = np.exp(
-                self.theta_0["a"]
-                * (
-                    self.source_events["source_magnitude"]
-                    - self.m_ref
-                    - self.delta_m / 2
-                )
-            )
-        if self.free_background:
-            self.target_events["P_background"] = 0.1
+        self.initialize_em_state()
 
         if self.fixed_parameters:
             self.constraints = []
@@ -1040,10 +2809,8 @@ class ETASParameterCalculation:
 
                 starting_index = 3
 
-                def alpha_constant(x):
-                    return x[1] - x[6] * x[7] - self.alpha
-                self.constraints.append(
-                    NonlinearConstraint(alpha_constant, 0, 0))
+                self.constraints.append(NonlinearConstraint(
+                    AlphaConstraint(self.alpha), 0, 0))
                 self.logger.info(
                     "  Alpha has been constrained to {}".format(self.alpha)
                 )
@@ -1054,15 +2821,15 @@ class ETASParameterCalculation:
                 if a is not None
             ]
             if len(idx_fixed) > 0:
-                def param_constant(x):
-                    return np.array(
-                        [x[k] for k in idx_fixed]
-                    ) - np.array(
+                self.constraints.append(NonlinearConstraint(
+                    FixedParameterConstraint(
+                        idx_fixed,
                         [self.__fixed_parameters[starting_index:][k]
-                         for k in idx_fixed]
-                    )
-                self.constraints.append(
-                    NonlinearConstraint(param_constant, 0, 0))
+                         for k in idx_fixed],
+                    ),
+                    0,
+                    0,
+                ))
 
             self.logger.info(
                 "  {} other constraints have been set up".format(
@@ -1071,6 +2838,133 @@ class ETASParameterCalculation:
 
         self.preparation_done = True
 
+    def pair_cache_settings(self):
+        """
+        Settings which, together with the filtered catalog, determine the
+        pairs and the source and target events.
+        """
+        settings = {
+            "inner_shape_coords": self.inner_shape_coords,
+            "auxiliary_start": self.auxiliary_start,
+            "timewindow_start": self.timewindow_start,
+            "timewindow_end": self.timewindow_end,
+            "mc": self.mc,
+            "m_ref": self.m_ref,
+            "delta_m": self.delta_m,
+            "coppersmith_multiplier": self.coppersmith_multiplier,
+            "earth_radius": self.earth_radius,
+            "three_dim": self.three_dim,
+            "space_unit_in_meters": self.space_unit_in_meters,
+            "b_positive": self.b_positive,
+            "bg_term": self.bg_term,
+            "float32_distances": self.float32_distances,
+            "pruning_tolerance": self.pruning_tolerance,
+            "area": self.area,
+            "pair_chunk_dir": self.pair_chunk_dir,
+        }
+        if self.pruning_tolerance is not None and not self.random_theta_0:
+            # pruned ranges depend on the initial values
+            settings["theta_0"] = self.__theta_0
+        return settings
+
+    def initialize_em_state(self):
+        """
+        Initial values of the EM state which is not part of theta.
+        """
+        self.time_integral_cache = None
+        self.primary_source_positions = None
+        if self.free_productivity:
+            self.source_events["source_kappa"] = np.exp(
+                self.theta_0["a"]
+                * (
+                    self.source_events["source_magnitude"]
+                    - self.m_ref
+                    - self.delta_m / 2
+                )
+            )
+        if self.free_background:
+            self.target_events["P_background"] = 0.1
+        if self.sparsify_threshold is not None and (
+                self.free_background and self.background_density == "pairs"
+                or isinstance(self.distances, PairChunks)):
+            self.logger.warning(
+                "  sparsify_threshold is not available with free_background "
+                "with background_density \"pairs\", or with pair_chunk_dir, "
+                "using all pairs.")
+            self.sparsify_threshold = None
+        if self.sparsify_threshold is not None:
+            self.restore_pairs()
+            self.active_pair_counts = []
+            self.dropped_pair_bounds = []
+
+        if self.warm_start_result is not None:
+            self.apply_warm_start()
+
+    def apply_warm_start(self):
+        """
+        Initial values of source_kappa and P_background from the result
+        given by warm_start. Events which are not part of that result get
+        the source_kappa of the fitted productivity law and the mean
+        P_background.
+        """
+        if self.free_productivity:
+            previous = read_stored_events(
+                self.warm_start_result, "source_events")["source_kappa"]
+            theta = self.theta_0
+            expected_kappa = np.power(10, theta["log10_k0"]) * np.exp(
+                theta["a"]
+                * (
+                    self.source_events["source_magnitude"]
+                    - self.m_ref
+                    + self.delta_m / 2
+                )
+            )
+            self.source_events["source_kappa"] = previous.reindex(
+                self.source_events.index).fillna(expected_kappa)
+            self.logger.info(
+                "  warm start: {} of {} sources have a previous "
+                "source_kappa".format(
+                    self.source_events.index.isin(previous.index).sum(),
+                    len(self.source_events),
+                )
+            )
+        if self.free_background:
+            previous = read_stored_events(
+                self.warm_start_result, "target_events")["P_background"]
+            self.target_events["P_background"] = previous.reindex(
+                self.target_events.index).fillna(previous.mean())
+            self.logger.info(
+                "  warm start: {} of {} targets have a previous "
+                "P_background".format(
+                    self.target_events.index.isin(previous.index).sum(),
+                    len(self.target_events),
+                )
+            )
+
+    @property
+    def pij(self):
+        """Pairs with Pij, read from the bundle on first access."""
+        if self.__pij is None and "pij" in self.lazy_pairs:
+            self.__pij = self.lazy_pairs.pop("pij")()
+        return self.__pij
+
+    @pij.setter
+    def pij(self, pij):
+        self.lazy_pairs.pop("pij", None)
+        self.__pij = pij
+
+    @property
+    def distances(self):
+        """Pairs with distances, read from the bundle on first access."""
+        if self.__distances is None and "distances" in self.lazy_pairs:
+            self.__distances = self.lazy_pairs.pop("distances")()
+        return self.__distances
+
+    @distances.setter
+    def distances(self, distances):
+        self.lazy_pairs.pop("distances", None)
+        self.__distances = distances
+
     @property
     def theta_0(self):
         """getter"""
@@ -1107,77 +3001,625 @@ class ETASParameterCalculation:
     def theta(self, t):
         self.__theta = parameter_dict2array(t) if t is not None else None
 
-    def invert(self):
-        """
-        Invert the ETAS (or flETAS) parameters.
+    def invert(self):
+        """
+        Invert the ETAS (or flETAS) parameters.
+        """
+
+        if self.inversion_done:
+            self.logger.warning("Inversion already done, aborting...")
+            return self.theta
+
+        self.logger.info("START INVERSION")
+        accelerate = self.accelerate_em
+        if accelerate and (
+                self.free_productivity
+                or self.free_background
+                or self.bg_term is not None):
+            self.logger.warning(
+                "  accelerate_em is not available with free_productivity, "
+                "free_background or bg_term, using plain EM.")
+            accelerate = False
+        if self.compress_pairs and isinstance(self.distances, PairChunks):
+            self.logger.warning(
+                "  compress_pairs is not available with pair_chunk_dir, "
+                "using all pairs.")
+
+        theta_old = self.__theta_0[:]
+        if self.minibatch_size is not None:
+            if self.free_productivity or self.free_background \
+                    or isinstance(self.distances, PairChunks):
+                self.logger.warning(
+                    "  minibatch_size is not available with "
+                    "free_productivity, free_background or pair_chunk_dir, "
+                    "using all target events.")
+            else:
+                theta_old = self.minibatch_em(theta_old)
+        if accelerate:
+            theta_old, i = self.accelerated_em(theta_old)
+        else:
+            diff_to_before = 100
+            i = 0
+            while diff_to_before >= 0.001:
+                self.logger.info("  iteration {}".format(i))
+                diff_to_before = self.em_step(theta_old)
+                theta_old = self.__theta[:]
+                i += 1
+
+        self.logger.info(
+            "  stopping here. converged after " "{} iterations.".format(i))
+        self.i = i
+        if self.warm_start_result is not None \
+                and self.warm_start_result.get("n_iterations") is not None:
+            self.logger.info(
+                "  warm start saved {} iterations ({} in {})".format(
+                    self.warm_start_result["n_iterations"] - i,
+                    self.warm_start_result["n_iterations"],
+                    self.warm_start,
+                )
+            )
+
+        if self.sparse_distances is not None:
+            self.restore_pairs()
+
+        self.logger.info("    last expectation step")
+        (
+            self.pij,
+            self.target_events,
+            self.source_events,
+            self.n_hat,
+            self.i_hat,
+        ) = self.expectation_step(theta_old, self.m_ref - self.delta_m / 2)
+        self.logger.info("    n_hat: {}".format(self.n_hat))
+
+        if self.estimate_uncertainty:
+            self.calculate_parameter_uncertainty()
+
+        self.inversion_done = True
+
+        return self.theta
+
+    def calculate_parameter_uncertainty(self):
+        """
+        Standard errors and covariance matrix of the parameters from the
+        observed information matrix at the final parameters, which is the
+        information of the complete-data log likelihood minus the
+        covariance of its score given the observed events (Louis, 1982).
+        Both are calculated from one expectation step at the final
+        parameters.
+
+        Fixed parameters have no uncertainty. With a constrained alpha, a
+        is a function of gamma and rho, and its uncertainty follows from
+        theirs. Sets and returns standard_errors and parameter_covariance,
+        dicts by parameter name.
+        """
+        if self.free_productivity or self.free_background \
+                or self.bg_term is not None \
+                or isinstance(self.distances, PairChunks):
+            self.logger.warning(
+                "  parameter uncertainty is not available with "
+                "free_productivity, free_background, bg_term or "
+                "pair_chunk_dir.")
+            return None, None
+
+        self.logger.info("    calculating observed information")
+        calc_start = dt.datetime.now()
+        mc_min = self.m_ref - self.delta_m / 2
+        theta = np.array(self.__theta[-10:], dtype=float)
+        names = [
+            name for name in parameter_array2dict(self.__theta[-10:])
+            if name != "log10_iota"
+        ]
+
+        Pij, target_events, source_events, _, _ = self.expectation_step(
+            theta, mc_min)
+        statistics = sufficient_statistics(Pij, source_events)
+
+        information = np.zeros((9, 9))
+        information[0, 0] = np.square(np.log(10)) * np.power(
+            10, theta[0]) * self.area * self.timewindow_length
+        information[1:, 1:] = complete_data_information(
+            theta[2:], statistics, mc_min)
+        information -= complete_data_score_covariance(
+            theta,
+            Pij,
+            target_events["P_background"].to_numpy(),
+            target_events["zeta_plus_1"].to_numpy(),
+            mc_min,
+        )
+
+        # jacobian of all parameters with respect to the free parameters
+        free = list(range(9))
+        if self.__fixed_parameters is not None:
+            fixed_theta = self.__fixed_parameters[-10:][2:]
+            free = [0] + [
+                i + 1 for i, f in enumerate(fixed_theta) if f is None]
+        if self.alpha is not None:
+            free = [i for i in free if i != 2]
+        jacobian = np.eye(9)[:, free]
+        if self.alpha is not None:
+            # a = alpha + gamma * rho
+            for i, other in ((7, 8), (8, 7)):
+                if i in free:
+                    jacobian[2, free.index(i)] = theta[other + 1]
+        free_information = jacobian.T @ information @ jacobian
+        if self.alpha is not None and 7 in free and 8 in free:
+            # second derivative of a, times the observed score of a
+            _, neg_gradient = neg_log_likelihood_with_gradient(
+                theta[2:], statistics, mc_min)
+            free_information[free.index(7), free.index(8)] += \
+                neg_gradient[1]
+            free_information[free.index(8), free.index(7)] += \
+                neg_gradient[1]
+
+        try:
+            covariance = jacobian @ np.linalg.inv(free_information) \
+                @ jacobian.T
+        except np.linalg.LinAlgError:
+            self.logger.warning(
+                "    observed information matrix is singular, no "
+                "parameter uncertainty.")
+            return None, None
+        variance = np.diag(covariance)
+        if np.any(variance < 0):
+            self.logger.warning(
+                "    observed information matrix is not positive "
+                "definite, standard errors are not reliable.")
+
+        self.standard_errors = dict(
+            zip(names, np.sqrt(np.clip(variance, 0, None)).tolist()))
+        self.parameter_covariance = {
+            name: dict(zip(names, row))
+            for name, row in zip(names, covariance.tolist())
+        }
+        self.logger.info(
+            "    standard errors: {}".format(self.standard_errors))
+        self.logger.debug(
+            "    observed information took {}".format(
+                dt.datetime.now() - calc_start))
+
+        return self.standard_errors, self.parameter_covariance
+
+    def minibatch_em(self, theta_0):
+        """
+        EM iterations on random mini-batches of the target events, see
+        minibatch_size. Returns the parameters of the last iteration, from
+        which the EM algorithm continues with all target events.
+        """
+        rng = np.random.default_rng(self.minibatch_seed)
+        mc_min = self.m_ref - self.delta_m / 2
+        n_targets = len(self.target_events)
+        # batches are the first batch_size target events of this order
+        order = rng.permutation(n_targets)
+        batch_size = self.minibatch_size
+        iterations_at_size = 0
+        self.minibatch_sizes = []
+
+        theta_old = theta_0
+        while batch_size < n_targets:
+            self.logger.info(
+                "  mini-batch iteration, {} of {} target events".format(
+                    batch_size, n_targets))
+            batch = np.sort(order[:batch_size])
+            # the target events are kept, they are needed for the full
+            # iterations
+            (
+                self.pij,
+                _,
+                self.source_events,
+                n_hat,
+                i_hat,
+            ) = self.expectation_step(
+                theta_old, mc_min, self.target_events.iloc[batch])
+
+            # unbiased estimates for all target events
+            scale = n_targets / batch_size
+            self.n_hat = n_hat * scale
+            self.i_hat = i_hat * scale
+            self.source_events["l_hat"] *= scale
+            self.pij["Pij"] *= scale
+            # bins of the previous batch do not match
+            self.compression_bins = None
+
+            self.__theta = self.optimize_parameters(theta_old)
+            diff_to_before = calc_diff_to_before(theta_old, self.__theta)
+            self.logger.info(
+                "    difference to previous: {}".format(diff_to_before))
+            self.minibatch_sizes.append(int(batch_size))
+            theta_old = self.__theta[:]
+
+            iterations_at_size += 1
+            if diff_to_before < self.minibatch_tolerance \
+                    or iterations_at_size >= MINIBATCH_MAX_ITERATIONS:
+                # the batch grows by at least one event
+                batch_size = max(
+                    batch_size + 1,
+                    int(np.ceil(batch_size * self.minibatch_growth)))
+                iterations_at_size = 0
+
+        self.compression_bins = None
+        return theta_old
+
+    def update_expectation(self, theta):
+        """
+        Runs the expectation step for parameters theta and keeps its
+        results.
+        """
+        self.logger.debug("    expectation step")
+        (
+            self.pij,
+            self.target_events,
+            self.source_events,
+            self.n_hat,
+            self.i_hat,
+        ) = self.expectation_step(theta, self.m_ref - self.delta_m / 2)
+
+        self.logger.debug("      n_hat: {}".format(self.n_hat))
+        self.logger.debug("      i_hat: {}".format(self.i_hat))
+
+    def em_step(self, theta_old, expectation_done=False):
+        """
+        One iteration of the EM algorithm, starting from theta_old.
+        The new parameters are stored in theta.
+
+        Parameters
+        ----------
+        theta_old : np.ndarray
+            Parameters at the start of the iteration.
+        expectation_done : bool
+            If True, the results of the expectation step for theta_old
+            are already available.
+
+        Returns
+        -------
+        diff_to_before : float
+            Difference between old and new parameters.
+        """
+        if not expectation_done:
+            self.update_expectation(theta_old)
+        if self.sparsify_threshold is not None:
+            self.update_active_pairs(theta_old)
+
+        self.logger.debug("    optimizing parameters")
+        self.__theta = self.optimize_parameters(theta_old)
+        if self.free_productivity:
+            self.calc_a_k0_from_kappa()
+
+        self.logger.info("    new parameters:")
+        self.logger.info(
+            pprint.pformat(parameter_array2dict(self.__theta), indent=4)
+        )
+
+        diff_to_before = calc_diff_to_before(theta_old, self.__theta)
+        self.logger.info(
+            "    difference to previous: {}".format(diff_to_before))
+        if self.sparse_distances is not None \
+                and diff_to_before > self.sparsify_reset:
+            self.logger.info("    parameters changed, using all pairs again")
+            self.restore_pairs()
+
+        try:
+            br = branching_ratio(theta_old, self.beta)
+            self.logger.debug("    branching ratio: {}".format(br))
+        except BaseException:
+            self.logger.debug("    branching ratio not calculated")
+        if self.free_productivity:
+            self.logger.debug("    updating source kappa")
+            self.update_source_kappa()
+
+        return diff_to_before
+
+    def update_active_pairs(self, theta):
+        """
+        Checks the bound of the Pij of the left out pairs at theta (see
+        sparsify_threshold), and if it is too large, repeats the
+        expectation step for theta with all pairs. Then counts for each
+        pair used in the expectation step the consecutive iterations in
+        which its Pij was below sparsify_threshold, and leaves out pairs
+        for which this happened sparsify_iterations times.
+        """
+        if self.active_pairs is None:
+            self.restore_pairs()
+            self.active_pair_counts = []
+            self.dropped_pair_bounds = []
+
+        bound = None
+        if self.dropped_distances is not None and len(
+                self.active_pair_counts) % self.sparsify_check_interval == 0:
+            bound = self.dropped_pair_bound(theta)
+            if bound > self.sparsify_tolerance * len(self.target_events):
+                self.logger.info(
+                    "    Pij of left out pairs is up to {}, using all "
+                    "pairs again".format(bound))
+                self.restore_pairs()
+                self.update_expectation(theta)
+
+        active = np.flatnonzero(self.active_pairs)
+        Pij = self.pij["Pij"]
+        below = self.pair_below_threshold[active] + 1
+        below[Pij >= self.sparsify_threshold] = 0
+        self.pair_below_threshold[active] = below
+
+        drop = below >= self.sparsify_iterations
+        if np.any(drop):
+            self.active_pairs[active[drop]] = False
+            self.sparse_distances = self.distances[self.active_pairs]
+            self.dropped_distances = self.distances[~self.active_pairs]
+
+        n_active = len(active) - np.count_nonzero(drop)
+        self.active_pair_counts.append(n_active)
+        self.dropped_pair_bounds.append(bound)
+        self.logger.info(
+            "    active pairs: {} of {}, bound of Pij of left out pairs: "
+            "{}".format(n_active, len(self.distances), bound))
+
+    def dropped_pair_bound(self, theta):
+        """
+        Upper bound of the sum of Pij of the pairs which are left out, for
+        parameters theta. Requires the results of the expectation step for
+        theta.
+        """
+        pairs = self.dropped_distances.align(
+            self.source_events.index, self.target_events.index)
+        executor = worker_pool(self.n_workers)
+        source_kappa = (
+            self.source_events["source_kappa"].fillna(0).to_numpy()
+            if self.free_productivity
+            else None
+        )
+        gij = pair_triggering_kernel(
+            pairs,
+            [theta, self.m_ref - self.delta_m / 2],
+            source_kappa,
+            out=pairs.buffer("gij"),
+            executor=executor,
+        )
+        # the total rates of the expectation step do not contain the left
+        # out pairs, with them, each Pij would be smaller
+        tot_rates = self.pij.targets["tot_rates"].to_numpy()
+        return float(np.nansum(gij / tot_rates[pairs.target_idx]))
+
+    def restore_pairs(self):
+        """
+        Uses all pairs again in the following expectation steps.
+        """
+        self.active_pairs = np.ones(len(self.distances), dtype=bool)
+        self.pair_below_threshold = np.zeros(
+            len(self.distances), dtype=np.int32)
+        self.sparse_distances = None
+        self.dropped_distances = None
+
+    def log_likelihood(self, theta):
+        """
+        Log likelihood of the target events given parameters theta.
+        Requires the results of the expectation step for theta.
+
+        Rates and the expected number of events are corrected for
+        incompleteness with the same factors as in the expectation step.
+        Triggering is integrated over the whole space, as in the M-step.
+        The integral of the induced rate of bg_term is estimated by i_hat.
+        """
+        mc_min = self.m_ref - self.delta_m / 2
+        if self.free_productivity:
+            G = self.free_productivity_expected_aftershocks(theta)
+        else:
+            G = expected_aftershocks(
+                [
+                    self.source_events["source_magnitude"],
+                    self.source_events["pos_source_to_start_time_distance"],
+                    self.source_events["source_to_end_time_distance"],
+                ],
+                [theta[2:], mc_min],
+            )
+        tot_rates = self.pij.targets["tot_rates"].to_numpy()
+        zeta_plus_1 = self.target_events["zeta_plus_1"].to_numpy()
+        xi_plus_1 = self.pij.sources["xi_plus_1"].to_numpy()
+
+        # with free_background, targets without pairs have a rate of zero
+        with np.errstate(divide="ignore"):
+            log_rates = np.where(tot_rates > 0, np.log(tot_rates), -300)
+        ll = (
+            np.sum(zeta_plus_1 * log_rates)
+            - np.power(10, theta[0]) * self.area * self.timewindow_length
+            - np.sum(xi_plus_1 * np.nan_to_num(G))
+        )
+        if self.bg_term is not None:
+            ll -= self.i_hat
+        return ll
+
+    def invert_multistart(self, n_starts, n_processes=None, seed=None):
         """
+        Inverts the ETAS parameters from several initial values in parallel,
+        and keeps the solution with the highest log likelihood.
 
-        if self.inversion_done:
-            self.logger.warning("Inversion already done, aborting...")
-            return self.theta
+        The first initial values are theta_0, the others are drawn at
+        random from RANGES. The pairs are calculated once in prepare() and
+        shared with the worker processes, which run one EM chain per start.
+        The expectation step of the best solution is repeated afterwards.
 
-        self.logger.info("START INVERSION")
-        diff_to_before = 100
-        i = 0
-        theta_old = self.__theta_0[:]
+        Worker processes are started with fork, such that they inherit
+        the calculation. Where fork is not available (e.g. Windows), the
+        calculation, including the pairs, is pickled for each worker.
 
-        while diff_to_before >= 0.001:
-            self.logger.info("  iteration {}".format(i))
+        Parameters
+        ----------
+        n_starts : int
+            Number of initial values.
+        n_processes : int, optional
+            Number of worker processes, defaults to the number of CPUs.
+        seed : int, optional
+            Seed for drawing the initial values.
+
+        Returns
+        -------
+        theta : dict
+            Parameters with the highest log likelihood.
+        results : list of dict
+            For each start, the initial values, the final parameters,
+            the log likelihood and the number of iterations.
+        """
+        if self.inversion_done:
+            self.logger.warning("Inversion already done, aborting...")
+            return self.theta, self.multistart_results
+
+        rng = np.random.default_rng(seed)
+        starts = [self.__theta_0]
+        while len(starts) < n_starts:
+            start = create_initial_values(rng=rng)
+            if self.__fixed_parameters is not None:
+                fixed_theta = self.__fixed_parameters[-len(start):]
+                start = [s if f is None else f
+                         for s, f in zip(start, fixed_theta)]
+            starts.append(np.array(start, dtype=object))
+
+        if self.compress_pairs and self.compression_bins is None \
+                and not isinstance(self.distances, PairChunks):
+            # bins only depend on the pairs, calculate them once for all
+            # starts
+            self.compression_bins = compression_bins(
+                self.distances, self.compression_tolerance)
 
-            self.logger.debug("    expectation step")
-            (
-                self.pij,
-                self.target_events,
-                self.source_events,
-                self.n_hat,
-                self.i_hat,
-            ) = self.expectation_step(theta_old, self.m_ref - self.delta_m / 2)
+        self.logger.info(
+            "START MULTISTART INVERSION, {} starts".format(n_starts))
+        if "fork" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("fork")
+        else:
+            mp_context = None
+            self.logger.warning(
+                "  fork is not available, the calculation is copied to "
+                "each worker process.")
+        with ProcessPoolExecutor(
+            max_workers=n_processes,
+            mp_context=mp_context,
+            initializer=init_multistart_worker,
+            initargs=(self,),
+        ) as executor:
+            results = list(executor.map(
+                run_multistart_chain,
+                [parameter_array2dict(start) for start in starts],
+            ))
+
+        log_likelihoods = np.array(
+            [result["log_likelihood"] for result in results], dtype=float)
+        best = int(np.nanargmax(log_likelihoods))
+        self.logger.info(
+            "  log likelihoods: {}, best start: {}".format(
+                log_likelihoods, best))
 
-            self.logger.debug("      n_hat: {}".format(self.n_hat))
-            self.logger.debug("      i_hat: {}".format(self.i_hat))
+        self.theta_0 = results[best]["initial_values"]
+        self.theta = results[best]["final_parameters"]
+        self.i = results[best]["n_iterations"]
+        for column, values in results[best]["em_state"].items():
+            events = (self.source_events if column == "source_kappa"
+                      else self.target_events)
+            events[column] = values
 
-            self.logger.debug("    optimizing parameters")
-            self.__theta = self.optimize_parameters(theta_old)
-            if self.free_productivity:
-                self.calc_a_k0_from_kappa()
+        self.logger.info("    last expectation step")
+        self.update_expectation(self.__theta)
+        self.inversion_done = True
 
-            self.logger.info("    new parameters:")
-            self.logger.info(
-                pprint.pformat(parameter_array2dict(self.__theta), indent=4)
-            )
+        self.multistart_results = [
+            {k: v for k, v in result.items() if k != "em_state"}
+            for result in results
+        ]
+        return self.theta, self.multistart_results
 
-            diff_to_before = calc_diff_to_before(theta_old, self.__theta)
-            self.logger.info(
-                "    difference to previous: {}".format(diff_to_before))
+    def extrapolation_bounds(self, theta):
+        """
+        Keeps extrapolated parameters theta within RANGES and
+        fixed_parameters.
+        """
+        theta = theta.copy()
+        for k, (low, high) in enumerate(RANGES):
+            if theta[k] is not None:
+                theta[k] = min(max(theta[k], low), high)
+        if self.__fixed_parameters is not None:
+            # alpha, if given, is the first of the fixed parameters
+            fixed_theta = self.__fixed_parameters[-len(theta):]
+            for k, fixed in enumerate(fixed_theta):
+                if fixed is not None and theta[k] is not None:
+                    theta[k] = fixed
+        if self.alpha is not None:
+            # alpha = a - rho * gamma
+            theta[3] = self.alpha + theta[8] * theta[9]
+        return theta
+
+    def accelerated_em(self, theta_0):
+        """
+        EM iterations accelerated with SQUAREM (Varadhan and Roland, 2008,
+        scheme S3).
+
+        Two EM steps theta_0 -> theta_1 -> theta_2 are extrapolated to
+        theta_0 + 2 * alpha * r + alpha ** 2 * v, with r = theta_1 - theta_0
+        and v = theta_2 - 2 * theta_1 + theta_0, and an EM step is taken
+        from there. If the log likelihood of the extrapolated parameters
+        is lower than the one of theta_0 by more than
+        SQUAREM_LOG_LIKELIHOOD_TOLERANCE, theta_2 is used instead.
+        Convergence is tested after each EM step, as in plain EM.
+
+        Returns
+        -------
+        theta : np.ndarray
+            Converged parameters.
+        i : int
+            Number of EM steps.
+        """
+        free = [k for k, t in enumerate(theta_0) if t is not None]
+        step_max = 1
+        i = 0
 
-            try:
-                br = branching_ratio(theta_old, self.beta)
-                self.logger.debug("    branching ratio: {}".format(br))
-            except BaseException:
-                self.logger.debug("    branching ratio not calculated")
-            theta_old = self.__theta[:]
-            if self.free_productivity:
-                self.logger.debug("    updating source kappa")
-                self.update_source_kappa()
+        while True:
+            self.logger.info("  iteration {}".format(i))
+            self.update_expectation(theta_0)
+            ll_0 = self.log_likelihood(theta_0)
+            diff_to_before = self.em_step(theta_0, expectation_done=True)
+            theta_1 = self.__theta[:]
             i += 1
+            if diff_to_before < 0.001:
+                return theta_1, i
 
-        self.logger.info(
-            "  stopping here. converged after " "{} iterations.".format(i))
-        self.i = i
+            self.logger.info("  iteration {}".format(i))
+            diff_to_before = self.em_step(theta_1)
+            theta_2 = self.__theta[:]
+            i += 1
+            if diff_to_before < 0.001:
+                return theta_2, i
 
-        self.logger.info("    last expectation step")
-        (
-            self.pij,
-            self.target_events,
-            self.source_events,
-            self.n_hat,
-            self.i_hat,
-        ) = self.expectation_step(theta_old, self.m_ref - self.delta_m / 2)
-        self.logger.info("    n_hat: {}".format(self.n_hat))
+            x_0, x_1, x_2 = (
+                np.array([t[k] for k in free], dtype=float)
+                for t in (theta_0, theta_1, theta_2)
+            )
+            r = x_1 - x_0
+            v = x_2 - x_1 - r
+            sum_v = np.sum(np.square(v))
+            alpha = np.sqrt(np.sum(np.square(r)) / sum_v) if sum_v > 0 \
+                else step_max
+            alpha = min(max(alpha, 1), step_max)
+            if alpha == step_max:
+                step_max *= 4
+
+            theta_x = theta_2.copy()
+            theta_x[free] = x_0 + 2 * alpha * r + alpha ** 2 * v
+            theta_x = self.extrapolation_bounds(theta_x)
 
-        self.inversion_done = True
+            self.logger.info(
+                "  iteration {}, extrapolated with step length {}".format(
+                    i, alpha))
+            self.update_expectation(theta_x)
+            ll_x = self.log_likelihood(theta_x)
+            if not ll_x >= ll_0 - SQUAREM_LOG_LIKELIHOOD_TOLERANCE:
+                self.logger.debug(
+                    "    log likelihood decreased from {} to {}, "
+                    "using plain EM step".format(ll_0, ll_x))
+                step_max = max(1, step_max / 4)
+                theta_0 = theta_2
+                continue
 
-        return self.theta
+            diff_to_before = self.em_step(theta_x, expectation_done=True)
+            theta_0 = self.__theta[:]
+            i += 1
+            if diff_to_before < 0.001:
+                return theta_0, i
 
     def filter_catalog(self, catalog):
         len_full_catalog = catalog.shape[0]
@@ -1204,28 +3646,18 @@ class ETASParameterCalculation:
             )
 
             if not self.three_dim:
-                poly = Polygon(self.shape_coords)
-                self.area = polygon_surface(poly)
-                gdf = gpd.GeoDataFrame(
-                    filtered_catalog,
-                    geometry=gpd.points_from_xy(
-                        filtered_catalog.latitude, filtered_catalog.longitude
-                    ),
-                )
-                filtered_catalog = gdf[gdf.intersects(poly)].copy()
-                filtered_catalog.drop("geometry", axis=1, inplace=True)
+                if self.region is None:
+                    self.region = Region(self.shape_coords)
+                self.area = self.region.area
+                filtered_catalog = self.region.filter(filtered_catalog).copy()
                 self.logger.info("Region has {} square km".format(self.area))
             else:
                 hull = ConvexHull(self.shape_coords)
                 self.area = hull.volume
                 # filter for events within convex hull
-                # this is probably very inefficient
-                in_hull_test = []
-                for i, row in filtered_catalog.iterrows():
-                    in_hull_test.append(
-                        in_hull(self.shape_coords, row[["x", "y", "z"]].values)
-                    )
-                filtered_catalog = filtered_catalog[in_hull_test].copy()
+                filtered_catalog = filtered_catalog[in_convex_hull(
+                    hull, filtered_catalog[["x", "y", "z"]].to_numpy()
+                )].copy()
                 self.logger.info("Volume is {} units cubed".format(self.area))
         else:
             self.area = 6.3781e3**2 * 4 * np.pi
@@ -1289,16 +3721,8 @@ class ETASParameterCalculation:
 
     def prepare_target_events(self):
         target_events = self.catalog.query("magnitude >= mc_current").copy()
-        if self.inner_shape_coords is not None:
-            inner_poly = Polygon(self.inner_shape_coords)
-            gdf = gpd.GeoDataFrame(
-                target_events,
-                geometry=gpd.points_from_xy(
-                    target_events.latitude, target_events.longitude
-                ),
-            )
-            target_events = gdf[gdf.intersects(inner_poly)].copy()
-            target_events.drop("geometry", axis=1, inplace=True)
+        if self.inner_region is not None:
+            target_events = self.inner_region.filter(target_events).copy()
         target_events.query("time > @ self.timewindow_start", inplace=True)
         target_events["mc_current_above_ref"] = \
             target_events["mc_current"] - self.m_ref
@@ -1348,25 +3772,53 @@ class ETASParameterCalculation:
         if self.bg_term is not None:
             iota_hat = self.i_hat / (self.area * self.timewindow_length)
 
+        # sources and pairs enter the likelihood only through weighted sums
+        if isinstance(self.pij, PairChunks):
+            statistics = chunked_sufficient_statistics(
+                self.pij, self.source_events, self.pair_memory_budget)
+        else:
+            # bins are calculated again if pairs were left out
+            if self.compress_pairs and (
+                    self.compression_bins is None
+                    or len(self.compression_bins["time_bin"])
+                    != len(self.pij)):
+                self.compression_bins = compression_bins(
+                    self.pij, self.compression_tolerance)
+                self.logger.debug(
+                    "    compressed {} sources to {} bins, {} pairs to {} "
+                    "time bins and {} space bins".format(
+                        len(self.source_events),
+                        len(self.compression_bins["source_count"]),
+                        len(self.pij),
+                        len(self.compression_bins["time_distance"]),
+                        len(self.compression_bins[
+                            "spatial_distance_squared"]),
+                    )
+                )
+            statistics = sufficient_statistics(
+                self.pij,
+                self.source_events,
+                self.compression_bins if self.compress_pairs else None,
+            )
+        executor = worker_pool(self.n_workers)
+        if executor is not None:
+            statistics = split_statistics(statistics)
+
+        if self.m_step == "block_coordinate":
+            return self.block_coordinate_step(
+                theta_0, ranges, statistics, executor, start_calc)
+
         if self.free_productivity:
             # select values from theta needed in free prod mode
             theta_0_without_mu = theta_0[4:]
             bounds = ranges[4:]
 
             res = minimize(
-                neg_log_likelihood_free_prod,
+                neg_log_likelihood_free_prod_with_gradient,
                 x0=theta_0_without_mu,
                 bounds=bounds,
-                args=(
-                    self.n_hat,
-                    self.pij,
-                    self.source_events,
-                    self.timewindow_length,
-                    self.timewindow_start,
-                    self.area,
-                    self.beta,
-                    self.m_ref - self.delta_m / 2,
-                ),
+                args=(statistics, self.m_ref - self.delta_m / 2, executor),
+                jac=True,
                 tol=1e-12,
                 constraints=self.constraints,
             )
@@ -1377,7 +3829,8 @@ class ETASParameterCalculation:
                     np.log10(mu_hat),
                     np.log10(iota_hat),
                     None,
-                    None * new_theta_without_mu,
+                    None,
+                    *new_theta_without_mu,
                 ]
             else:
                 new_theta = [np.log10(mu_hat), None, None,
@@ -1388,16 +3841,24 @@ class ETASParameterCalculation:
             bounds = ranges[2:]
 
             res = minimize(
-                neg_log_likelihood,
+                neg_log_likelihood_with_gradient,
                 x0=theta_0_without_mu,
                 bounds=bounds,
-                args=(self.pij, self.source_events,
-                      self.m_ref - self.delta_m / 2),
+                args=(statistics, self.m_ref - self.delta_m / 2, executor),
+                jac=True,
                 tol=1e-12,
                 constraints=self.constraints,
             )
 
             new_theta_without_mu = res.x
+            self.source_events["G"] = expected_aftershocks(
+                [
+                    self.source_events["source_magnitude"],
+                    self.source_events["pos_source_to_start_time_distance"],
+                    self.source_events["source_to_end_time_distance"],
+                ],
+                [new_theta_without_mu, self.m_ref - self.delta_m / 2],
+            )
             if self.bg_term is not None:
                 new_theta = [
                     np.log10(mu_hat),
@@ -1408,14 +3869,126 @@ class ETASParameterCalculation:
                 new_theta = [np.log10(mu_hat), None, *new_theta_without_mu]
 
         self.logger.debug(
-            "    optimization step took {}".format(
-                dt.datetime.now() - start_calc)
+            "    optimization step took {}, {} evaluations".format(
+                dt.datetime.now() - start_calc, res.nfev)
+        )
+
+        return np.array(new_theta)
+
+    def block_coordinate_step(
+            self, theta_0, ranges, statistics, executor, start_calc):
+        """
+        M-step with m_step="block_coordinate", see optimize_parameters.
+        """
+        mu_hat = self.n_hat / (self.area * self.timewindow_length)
+        first = 4 if self.free_productivity else 2
+        theta_start = np.array(theta_0[first:], dtype=float)
+        fixed = []
+        if self.__fixed_parameters is not None:
+            fixed_theta = self.__fixed_parameters[-len(RANGES):][first:]
+            fixed = [i for i, f in enumerate(fixed_theta) if f is not None]
+            theta_start[fixed] = fixed_theta[fixed].astype(float)
+        alpha = None if self.free_productivity else self.alpha
+
+        new_theta_without_mu, nfev, cycles = block_coordinate_minimize(
+            theta_start,
+            parameter_blocks(len(theta_start), fixed),
+            ranges[first:],
+            statistics,
+            self.m_ref - self.delta_m / 2,
+            executor,
+            alpha,
+            profile_k0=not self.free_productivity and 0 not in fixed,
+        )
+
+        if not self.free_productivity:
+            self.source_events["G"] = expected_aftershocks(
+                [
+                    self.source_events["source_magnitude"],
+                    self.source_events["pos_source_to_start_time_distance"],
+                    self.source_events["source_to_end_time_distance"],
+                ],
+                [new_theta_without_mu, self.m_ref - self.delta_m / 2],
+            )
+        log10_iota = None
+        if self.bg_term is not None:
+            log10_iota = np.log10(
+                self.i_hat / (self.area * self.timewindow_length))
+        new_theta = [
+            np.log10(mu_hat),
+            log10_iota,
+            *([None, None] if self.free_productivity else []),
+            *new_theta_without_mu,
+        ]
+
+        self.logger.debug(
+            "    optimization step took {}, {} evaluations in {} "
+            "cycles".format(dt.datetime.now() - start_calc, nfev, cycles)
         )
 
         return np.array(new_theta)
 
+    def fitted_model(self):
+        """
+        FittedModel with the parameters of this calculation and the source
+        and target events which are needed for simulations.
+        """
+        # xi_plus_1 is the aftershock productivity inflation factor, 1 if
+        # it is not used
+        source_events = self.source_events.copy()
+        if "xi_plus_1" not in source_events.columns:
+            source_events["xi_plus_1"] = 1
+
+        catalog = pd.merge(
+            source_events,
+            self.catalog[["latitude", "longitude", "time", "magnitude"]],
+            left_index=True,
+            right_index=True,
+            how="left",
+        )
+        assert len(catalog) == len(source_events), (
+            "lost/found some sources in the merge! "
+            f"{len(catalog)} -- "
+            f"{len(source_events)}"
+        )
+        np.testing.assert_allclose(
+            catalog.magnitude.min(),
+            self.m_ref,
+            err_msg="smallest magnitude in sources is "
+            f"{catalog.magnitude.min()} "
+            f"but I am supposed to simulate "
+            f"above {self.m_ref}",
+        )
+
+        region = Region(self.shape_coords)
+        target_events = self.target_events.query(
+            "magnitude>=@self.m_ref-@self.delta_m/2")
+        target_events = region.filter(target_events)[
+            ["latitude", "longitude", "P_background", "zeta_plus_1"]].copy()
+
+        return FittedModel(
+            theta=dict(self.theta),
+            beta=self.beta,
+            m_ref=self.m_ref,
+            delta_m=self.delta_m,
+            shape_coords=np.array(self.shape_coords),
+            auxiliary_start=self.auxiliary_start,
+            timewindow_end=self.timewindow_end,
+            catalog=catalog,
+            target_events=target_events,
+            calculation_date=self.calculation_date,
+        )
+
     def store_results(
-            self, data_path="", store_pij=False, store_distances=False):
+            self, data_path="", store_pij=False, store_distances=False,
+            bundle=False):
+        """
+        Stores the parameters and metadata as json, and the source and
+        target events (and optionally pij and distances) as csv files in
+        data_path. With bundle, the tables and the filtered catalog are
+        stored in a binary bundle (see etas.bundle) instead of csv files,
+        which load_calculation reads much faster.
+        """
         if data_path == "":
             data_path = os.getcwd() + "/"
 
@@ -1426,13 +3999,30 @@ class ETASParameterCalculation:
         fn_src = data_path + "sources_{}.csv".format(self.id)
         fn_dist = data_path + "distances_{}.csv".format(self.id)
         fn_pij = data_path + "pij_{}.csv".format(self.id)
+        fn_bundle = data_path + "bundle_{}".format(self.id)
+
+        if bundle:
+            tables = {
+                "catalog": {"frame": self.catalog},
+                "source_events": {"frame": self.source_events},
+                "target_events": {"frame": self.target_events},
+            }
+            for table, store, pairs in [
+                ("pij", store_pij, self.pij),
+                ("distances", store_distances, self.distances),
+            ]:
+                if store:
+                    if not isinstance(pairs, PairTable):
+                        pairs = PairTable.from_frame(pairs.to_frame())
+                    tables[table] = pairs.bundle_parts()
+            write_bundle(fn_bundle, tables)
+        else:
+            os.makedirs(os.path.dirname(fn_ip), exist_ok=True)
+            os.makedirs(os.path.dirname(fn_src), exist_ok=True)
+            self.target_events.to_csv(fn_ip)
+            self.source_events.to_csv(fn_src)
 
-        os.makedirs(os.path.dirname(fn_ip), exist_ok=True)
-        os.makedirs(os.path.dirname(fn_src), exist_ok=True)
-        self.target_events.to_csv(fn_ip)
-        self.source_events.to_csv(fn_src)
-
-        if self.fn_catalog is None:
+        if self.fn_catalog is None and not bundle:
             self.fn_catalog = data_path + "catalog_{}.csv".format(self.id)
             self.catalog.to_csv(self.fn_catalog)
 
@@ -1454,7 +4044,34 @@ class ETASParameterCalculation:
             "bw_sq": self.bw_sq,
             "free_productivity": self.free_productivity,
             "free_background": self.free_background,
+            "background_density": self.background_density,
             "bg_term": self.bg_term,
+            "pruning_tolerance": self.pruning_tolerance,
+            "pruned_kernel_mass": self.pruned_kernel_mass,
+            "float32_distances": self.float32_distances,
+            "compress_pairs": self.compress_pairs,
+            "compression_tolerance": self.compression_tolerance,
+            "accelerate_em": self.accelerate_em,
+            "pair_cache_dir": self.pair_cache_dir,
+            "pair_cache_size_limit": self.pair_cache_size_limit,
+            "warm_start": self.warm_start,
+            "pair_chunk_dir": self.pair_chunk_dir,
+            "pair_memory_budget": self.pair_memory_budget,
+            "n_workers": self.n_workers,
+            "sparsify_threshold": self.sparsify_threshold,
+            "sparsify_iterations": self.sparsify_iterations,
+            "sparsify_tolerance": self.sparsify_tolerance,
+            "sparsify_check_interval": self.sparsify_check_interval,
+            "sparsify_reset": self.sparsify_reset,
+            "active_pair_counts": self.active_pair_counts,
+            "dropped_pair_bounds": self.dropped_pair_bounds,
+            "m_step": self.m_step,
+            "minibatch_size": self.minibatch_size,
+            "minibatch_growth": self.minibatch_growth,
+            "minibatch_tolerance": self.minibatch_tolerance,
+            "minibatch_seed": self.minibatch_seed,
+            "minibatch_sizes": self.minibatch_sizes,
+            "estimate_uncertainty": self.estimate_uncertainty,
             "preparation_done": self.preparation_done,
             "inversion_done": self.inversion_done,
             "n_target_events": len(self.target_events),
@@ -1477,28 +4094,47 @@ class ETASParameterCalculation:
             "calculation_date": str(self.calculation_date),
             "initial_values": self.theta_0,
             "final_parameters": self.theta,
+            "standard_errors": self.standard_errors,
+            "parameter_covariance": self.parameter_covariance,
             "n_iterations": self.i,
-            "fn_ip": fn_ip,
-            "fn_src": fn_src,
+            "multistart_results": self.multistart_results,
         }
+        if bundle:
+            all_info["fn_bundle"] = fn_bundle
+        else:
+            all_info["fn_ip"] = fn_ip
+            all_info["fn_src"] = fn_src
 
-        if store_pij:
+        if store_pij and not bundle:
             os.makedirs(os.path.dirname(fn_pij), exist_ok=True)
-            self.pij.to_csv(fn_pij)
+            pair_csv_frame(self.pij).to_csv(fn_pij)
             all_info["fn_pij"] = fn_pij
 
-        if store_distances:
+        if store_distances and not bundle:
             os.makedirs(os.path.dirname(fn_dist), exist_ok=True)
-            self.distances.to_csv(fn_dist)
+            pair_csv_frame(self.distances).to_csv(fn_dist)
             all_info["fn_dist"] = fn_dist
 
         with open(fn_parameters, "w") as f:
             f.write(json.dumps(all_info))
 
-    def calculate_distances(self):
+    def calculate_distances(self, previous=None, chunk_dir=None):
         """
         Precalculates distances in time and space between events that are
         potentially related to each other.
+
+        Candidate pairs are found with a KD-tree over the target locations
+        (on the unit sphere, or in x/y/z if three_dim), queried with the
+        distance range of each source. The pairs are returned as a
+        PairTable, or if pair_chunk_dir is given, as PairChunks written to
+        chunk_dir (default: pair_chunk_dir).
+
+        If previous pairs are given, e.g. from an inversion before new
+        events were added to the catalog, they are reused, and only pairs
+        with new sources or new targets are searched. The previous pairs
+        need to be calculated with the same settings, and events which
+        are in both catalogs need to be unchanged. Columns depending on
+        the time window are recalculated.
         """
 
         calc_start = dt.datetime.now()
@@ -1517,16 +4153,9 @@ class ETASParameterCalculation:
 
         # all entries can be sources, but targets only after timewindow start
         targets = relevant.query("time>=@self.timewindow_start").copy()
-        if self.inner_shape_coords is not None:
-            inner_poly = Polygon(self.inner_shape_coords)
-            self.area = polygon_surface(inner_poly)
-            gdf = gpd.GeoDataFrame(
-                targets,
-                geometry=gpd.points_from_xy(
-                    targets.latitude, targets.longitude),
-            )
-            targets = gdf[gdf.intersects(inner_poly)].copy()
-            targets.drop("geometry", axis=1, inplace=True)
+        if self.inner_region is not None:
+            self.area = self.inner_region.area
+            targets = self.inner_region.filter(targets).copy()
 
         if self.mc == "positive":
             beta = estimate_beta_tinti(
@@ -1569,136 +4198,187 @@ class ETASParameterCalculation:
             a_max=None
         )
 
-        if not self.three_dim:
-            # translate target lat, lon to radians for spherical distance
-            # calculation
-            targets["target_lat_rad"] = np.radians(targets["latitude"])
-            targets["target_lon_rad"] = np.radians(targets["longitude"])
-        targets["target_time"] = targets["time"]
-        targets["target_id"] = targets.index
-        targets["target_time"] = targets["time"]
-        targets["target_completeness_above_ref"] = targets["mc_current"]
-        # columns that are needed later
-        targets["source_id"] = "i"
-        targets["source_magnitude"] = 0.0
-        targets["source_completeness_above_ref"] = 0.0
-        targets["time_distance"] = 0.0
-        targets["spatial_distance_squared"] = 0.0
-        targets["source_to_end_time_distance"] = 0.0
-        targets["pos_source_to_start_time_distance"] = 0.0
-
         targets = targets.sort_values(by="time")
 
-        # define index and columns that are later going to be needed
-        if pd.__version__ >= "0.24.0":
-            index = pd.MultiIndex(levels=[[], []],
-                                  names=["source_id", "target_id"],
-                                  codes=[[], []]
-                                  )
-        else:
-            index = pd.MultiIndex(levels=[[], []],
-                                  names=["source_id", "target_id"],
-                                  labels=[[], []]
-                                  )
-
-        columns = [
-            "target_time",
-            "source_magnitude",
-            "source_completeness_above_ref",
-            "target_completeness_above_ref",
-            "spatial_distance_squared",
-            "time_distance",
-            "source_to_end_time_distance",
-            "pos_source_to_start_time_distance",
-        ]
-        res_df = pd.DataFrame(index=index, columns=columns)
-
-        df_list = []
-
         logger.info("  number of sources: {}".format(len(relevant.index)))
         logger.info("  number of targets: {}".format(len(targets.index)))
 
+        # find pairs of events closer than distance_range
+        # using a spatial index over the targets
+        distance_range_squared = relevant["distance_range_squared"].to_numpy()
+        max_time_lag = None
+        if self.pruning_tolerance is not None:
+            distance_range_squared, max_time_lag = self.prune_ranges(
+                relevant["magnitude"].to_numpy(), distance_range_squared)
+
         if self.three_dim:
             logger.info("    assuming 3D Euclidian coordinates.")
+            source_points = relevant[["x", "y", "z"]].to_numpy(dtype=float)
+            target_points = targets[["x", "y", "z"]].to_numpy(dtype=float)
+            search_radius = np.sqrt(distance_range_squared)
         else:
             logger.info("    assuming 2D lat/long coordinates.")
-        for source in relevant.itertuples():
-            stime = source.time
-
-            # filter potential targets
-            if source.time < self.timewindow_start:
-                potential_targets = targets.copy()
+            # translate lat, lon to radians for spherical distance
+            # calculation
+            source_lat_rad = np.radians(relevant["latitude"].to_numpy())
+            source_lon_rad = np.radians(relevant["longitude"].to_numpy())
+            target_lat_rad = np.radians(targets["latitude"].to_numpy())
+            target_lon_rad = np.radians(targets["longitude"].to_numpy())
+            source_points = unit_sphere_coordinates(
+                source_lat_rad, source_lon_rad)
+            target_points = unit_sphere_coordinates(
+                target_lat_rad, target_lon_rad)
+            # chord length on the unit sphere corresponding to
+            # distance_range. slightly enlarged, exact distances are
+            # filtered below
+            search_radius = 2 * np.sin(np.minimum(
+                np.sqrt(distance_range_squared) / self.earth_radius, np.pi
+            ) / 2) * (1 + 1e-9) + 1e-12
+
+        source_times = relevant["time"].to_numpy()
+        target_times = targets["time"].to_numpy()
+
+        source_idx_list = []
+        target_idx_list = []
+        spatial_distance_squared_list = []
+        writer = None
+        if self.pair_chunk_dir is not None:
+            # pairs are written to disk as they are found
+            writer = PairChunkWriter(
+                chunk_dir or self.pair_chunk_dir, len(targets))
+
+        def add_pairs(source_idx, target_idx, spatial_distance_squared):
+            if writer is not None:
+                writer.append(source_idx, target_idx, spatial_distance_squared)
             else:
-                potential_targets = targets.query("time>@stime").copy()
-            targets = potential_targets.copy()
+                source_idx_list.append(source_idx)
+                target_idx_list.append(target_idx)
+                spatial_distance_squared_list.append(
+                    spatial_distance_squared)
+
+        # pairs are searched between these sets of sources and targets
+        all_sources = np.arange(len(relevant))
+        all_targets = np.arange(len(targets))
+        searches = [(all_sources, all_targets)]
+        if previous is not None:
+            reused = self.reuse_pairs(previous, relevant, targets)
+            if reused is not None:
+                source_idx, target_idx, spatial_distance_squared, \
+                    new_sources, new_targets = reused
+                add_pairs(source_idx, target_idx, spatial_distance_squared)
+                searches = [
+                    (all_sources, new_targets),
+                    (new_sources, np.setdiff1d(all_targets, new_targets)),
+                ]
 
-            if potential_targets.shape[0] == 0:
+        for search_sources, search_targets in searches:
+            if len(search_sources) == 0 or len(search_targets) == 0:
                 continue
-
-            # calculate spatial distance from source to target event
-            if self.three_dim:
-                sx = source.x
-                sy = source.y
-                sz = source.z
-
-                potential_targets["spatial_distance_squared"] = (
-                    np.square((sx - potential_targets["x"]))
-                    + np.square((sy - potential_targets["y"]))
-                    + np.square((sz - potential_targets["z"]))
-                )
-            else:
-                slatrad = np.radians(source.latitude)
-                slonrad = np.radians(source.longitude)
+            for source_idx, target_idx in neighbour_pairs(
+                    source_points[search_sources],
+                    target_points[search_targets],
+                    search_radius[search_sources]):
+                source_idx = search_sources[source_idx]
+                target_idx = search_targets[target_idx]
+
+                # only events after the source can be targets
+                later = target_times[target_idx] > source_times[source_idx]
+                if max_time_lag is not None:
+                    later &= target_times[target_idx] \
+                        <= source_times[source_idx] + max_time_lag
+                source_idx = source_idx[later]
+                target_idx = target_idx[later]
 
                 # calculate spatial distance from source to target event
-                potential_targets["spatial_distance_squared"] = np.square(
-                    haversine(
-                        slatrad,
-                        potential_targets["target_lat_rad"],
-                        slonrad,
-                        potential_targets["target_lon_rad"],
-                        self.earth_radius,
+                if self.three_dim:
+                    spatial_distance_squared = np.sum(
+                        np.square(
+                            source_points[source_idx]
+                            - target_points[target_idx]),
+                        axis=1,
+                    )
+                else:
+                    spatial_distance_squared = np.square(
+                        haversine(
+                            source_lat_rad[source_idx],
+                            target_lat_rad[target_idx],
+                            source_lon_rad[source_idx],
+                            target_lon_rad[target_idx],
+                            self.earth_radius,
+                        )
                     )
-                )
-
-            # filter for only small enough distances
-            drs = source.distance_range_squared  # noqa
-            potential_targets.query(
-                "spatial_distance_squared <= @drs", inplace=True)
-
-            # get source id and info of target events
-            potential_targets["source_id"] = source.Index
-            potential_targets["source_magnitude"] = source.magnitude
-            potential_targets["source_completeness_above_ref"] = \
-                source.mc_current
 
-            # calculate time distance from source to target event
-            potential_targets["time_distance"] = to_days(
-                potential_targets["target_time"] - stime
-            )
+                # filter for only small enough distances
+                close = spatial_distance_squared \
+                    <= distance_range_squared[source_idx]
+                add_pairs(
+                    source_idx[close],
+                    target_idx[close],
+                    spatial_distance_squared[close],
+                )
 
-            # calculate time distance from source event to timewindow
+        sources = pd.DataFrame({
+            "source_magnitude": relevant["magnitude"],
+            "source_completeness_above_ref":
+                relevant["mc_current"] - self.m_ref,
+            # time distance from source event to timewindow
             # boundaries for integration later
-            potential_targets["source_to_end_time_distance"] = (
-                source.source_to_end_time_distance
+            "source_to_end_time_distance":
+                relevant["source_to_end_time_distance"],
+            "pos_source_to_start_time_distance":
+                relevant["pos_source_to_start_time_distance"],
+        })
+        targets = pd.DataFrame({
+            "target_time": targets["time"],
+            "target_completeness_above_ref":
+                targets["mc_current"] - self.m_ref,
+        })
+
+        distance_dtype = np.float32 if self.float32_distances else float
+        if writer is not None:
+            res = writer.finish(
+                sources, targets, source_times, target_times, distance_dtype)
+            logger.debug(
+                "  took {} to prepare the data".format(
+                    dt.datetime.now() - calc_start)
             )
-            potential_targets["pos_source_to_start_time_distance"] = (
-                source.pos_source_to_start_time_distance
+            return res
+
+        source_idx = np.concatenate(
+            source_idx_list + [np.empty(0, dtype=np.int64)])
+        target_idx = np.concatenate(
+            target_idx_list + [np.empty(0, dtype=np.int64)])
+        spatial_distance_squared = np.concatenate(
+            spatial_distance_squared_list + [np.empty(0)])
+        if len(searches) > 1:
+            # same order of pairs as without previous pairs. reused pairs
+            # are already sorted, a stable sort of the combined key only
+            # needs to merge them with the new pairs
+            order = np.argsort(
+                source_idx.astype(np.int64) * len(targets) + target_idx,
+                kind="stable",
             )
-
-            # append to resulting dataframe
-            df_list.append(potential_targets)
-
-        res_df = (
-            pd.concat(df_list)[["source_id", "target_id"] + columns]
-            .reset_index()
-            .set_index(["source_id", "target_id"])
-        )
-        res_df["source_completeness_above_ref"] = (
-            res_df["source_completeness_above_ref"] - self.m_ref
-        )
-        res_df["target_completeness_above_ref"] = (
-            res_df["target_completeness_above_ref"] - self.m_ref
+            source_idx = source_idx[order]
+            target_idx = target_idx[order]
+            spatial_distance_squared = spatial_distance_squared[order]
+
+        # calculate time distance from source to target event
+        time_distance = (
+            target_times[target_idx] - source_times[source_idx]
+        ) / np.timedelta64(1, "D")
+
+        res = PairTable(
+            source_idx,
+            target_idx,
+            sources,
+            targets,
+            {
+                "spatial_distance_squared":
+                    spatial_distance_squared.astype(
+                        distance_dtype, copy=False),
+                "time_distance": time_distance.astype(
+                    distance_dtype, copy=False),
+            },
         )
 
         logger.debug(
@@ -1706,9 +4386,153 @@ class ETASParameterCalculation:
                 dt.datetime.now() - calc_start)
         )
 
-        return res_df
+        return res
+
+    def reuse_pairs(self, previous, relevant, targets):
+        """
+        Finds the pairs of a previous PairTable between events which are
+        still sources and targets.
+
+        Returns
+        -------
+        source_idx, target_idx : np.ndarray
+            Positions of source and target of the reused pairs in relevant
+            and targets.
+        spatial_distance_squared : np.ndarray
+            Squared spatial distance of the reused pairs.
+        new_sources, new_targets : np.ndarray
+            Positions of the sources and targets which are not in the
+            previous pairs.
+        Returns None if events of the previous pairs have changed.
+        """
+        source_pos = relevant.index.get_indexer(previous.source_ids)
+        target_pos = targets.index.get_indexer(previous.target_ids)
+        is_source = source_pos >= 0
+        is_target = target_pos >= 0
+
+        # magnitudes are compared with a tolerance, pairs stored as csv
+        # do not keep the last digits
+        unchanged = np.allclose(
+            previous.sources["source_magnitude"].to_numpy()[is_source],
+            relevant["magnitude"].to_numpy()[source_pos[is_source]],
+            rtol=0, atol=1e-9,
+        ) and np.allclose(
+            previous.sources[
+                "source_completeness_above_ref"].to_numpy()[is_source],
+            (relevant["mc_current"] - self.m_ref).to_numpy()[
+                source_pos[is_source]],
+            rtol=0, atol=1e-9,
+        ) and np.array_equal(
+            pd.to_datetime(
+                previous.targets["target_time"]).to_numpy()[is_target],
+            targets["time"].to_numpy()[target_pos[is_target]],
+        )
+        if not unchanged:
+            logger.warning(
+                "    events of the previous pairs have changed, "
+                "calculating all pairs.")
+            return None
+
+        keep = is_source[previous.source_idx] & is_target[previous.target_idx]
+        new_sources = np.setdiff1d(
+            np.arange(len(relevant)), source_pos[is_source])
+        new_targets = np.setdiff1d(
+            np.arange(len(targets)), target_pos[is_target])
+        logger.info(
+            "    reusing {} pairs, {} new sources, {} new targets".format(
+                keep.sum(), len(new_sources), len(new_targets)))
+
+        return (
+            source_pos[previous.source_idx[keep]],
+            target_pos[previous.target_idx[keep]],
+            previous["spatial_distance_squared"][keep].astype(float),
+            new_sources,
+            new_targets,
+        )
+
+    def prune_ranges(self, magnitudes, distance_range_squared):
+        """
+        Restricts the distance range of the sources and the time lag
+        between sources and targets, such that at most a fraction of
+        pruning_tolerance of the triggering kernel (defined by theta_0) is
+        discarded for each source. The expected number of aftershocks in
+        the discarded part of the kernels is stored in pruned_kernel_mass.
+
+        Returns
+        -------
+        distance_range_squared : np.ndarray
+            Pruned squared distance range of each source.
+        max_time_lag : np.timedelta64 or None
+            Maximum time lag between source and target, None if the time
+            lag is not limited.
+        """
+        # without initial values of the user (or of warm_start), pruning
+        # would depend on random values and discard arbitrary pairs
+        if self.__theta_0 is None or self.random_theta_0:
+            logger.warning(
+                "    theta_0 is neither given nor taken from warm_start, "
+                "pairs are not pruned.")
+            return distance_range_squared, None
+
+        mc_min = self.m_ref - self.delta_m / 2
+        log10_c, omega, log10_tau, log10_d, gamma, rho = self.__theta_0[4:]
+        max_time_lag, max_distance_squared = kernel_pruning_ranges(
+            self.__theta_0,
+            magnitudes,
+            mc_min,
+            self.pruning_tolerance,
+            max_time=to_days(self.timewindow_end - self.auxiliary_start),
+        )
+        pruned_range_squared = np.minimum(
+            distance_range_squared, max_distance_squared)
+
+        # fraction of kernel mass discarded in addition to what is
+        # beyond the coppersmith distance range
+        time_tail = time_kernel_tail(
+            max_time_lag, log10_c, omega, log10_tau) \
+            if max_time_lag < np.inf else 0
+        discarded_fraction = 1 - (1 - time_tail) * (1 - space_kernel_tail(
+            pruned_range_squared, log10_d, gamma, rho, magnitudes, mc_min)
+        ) - space_kernel_tail(
+            distance_range_squared, log10_d, gamma, rho, magnitudes, mc_min)
+        self.pruned_kernel_mass = float(np.sum(
+            expected_aftershocks(
+                magnitudes, [self.__theta_0[2:], mc_min],
+                no_start=True, no_end=True,
+            ) * discarded_fraction
+        ))
+
+        logger.info(
+            "    pruning pairs with tolerance {}: max time lag {} days, "
+            "max discarded fraction of kernel mass {}, "
+            "expected number of discarded aftershocks {}".format(
+                self.pruning_tolerance,
+                max_time_lag,
+                np.max(discarded_fraction, initial=0),
+                self.pruned_kernel_mass,
+            )
+        )
+
+        if max_time_lag == np.inf:
+            return pruned_range_squared, None
+        return pruned_range_squared, np.timedelta64(
+            int(max_time_lag * 24 * 60 * 60 * 1e9), "ns")
+
+    def expectation_step(self, theta, mc_min, target_events=None):
+        """
+        Expectation step for parameters theta. If target_events is given
+        (a subset of the target events, e.g. a mini-batch), only these
+        targets and their pairs are used.
+
+        The arrays of the returned pairs are not shared with later calls.
+        With PairChunks, Pij is the memory-mapped file of
+        chunked_expectation_step, which the next call overwrites.
+        """
+        if isinstance(self.distances, PairChunks):
+            return self.chunked_expectation_step(theta, mc_min)
+        if target_events is None:
+            target_events = self.target_events
 
-    def expectation_step(self, theta, mc_min):
         calc_start = dt.datetime.now()
         log10_mu = theta[0]
         mu = np.power(10, log10_mu)
@@ -1717,134 +4541,304 @@ class ETASParameterCalculation:
             log10_iota = theta[1]
             iota = np.power(10, log10_iota)
 
+        # pairs left out by sparsify_threshold are not evaluated
+        pairs = (
+            self.distances if self.sparse_distances is None
+            else self.sparse_distances
+        ).align(self.source_events.index, target_events.index)
+        source_idx = pairs.source_idx
+        target_idx = pairs.target_idx
+        # with n_workers, operations on pairs are done per block
+        executor = worker_pool(self.n_workers)
+        blocks = block_slices(len(pairs), executor)
+
+        # arrays with one value per pair are allocated once and reused
+        # in each iteration
+        gij = pairs.buffer("gij")
+        Pij = pairs.buffer("Pij")
+        tmp = pairs.buffer("tmp")
+
         # calculate the triggering density values gij
         logger.debug("    calculating gij")
-        Pij_0 = self.distances.copy()
         source_kappa = (
-            pd.merge(
-                Pij_0[[]],
-                self.source_events["source_kappa"],
-                left_index=True,
-                right_index=True,
-            )
-            .copy()
-            .fillna(0)
+            self.source_events["source_kappa"].fillna(0).to_numpy()
             if self.free_productivity
-            else {"source_kappa": None}
-        )
-        Pij_0["gij"] = triggering_kernel(
-            [
-                Pij_0["time_distance"],
-                Pij_0["spatial_distance_squared"],
-                Pij_0["source_magnitude"],
-                source_kappa["source_kappa"],
-            ],
-            [theta, mc_min],
+            else None
         )
+        pair_triggering_kernel(
+            pairs, [theta, mc_min], source_kappa, out=gij, executor=executor)
 
         # responsibility factor for invisible triggering events
-        Pij_0["xi_plus_1"] = responsibility_factor(
-            theta, self.beta, Pij_0["source_completeness_above_ref"]
+        xi_plus_1 = responsibility_factor(
+            theta,
+            self.beta,
+            pairs.sources["source_completeness_above_ref"].to_numpy(),
         )
-        Pij_0["zeta_plus_1"] = observation_factor(
-            self.beta, Pij_0["target_completeness_above_ref"]
+        pair_zeta_plus_1 = observation_factor(
+            self.beta,
+            pairs.targets["target_completeness_above_ref"].to_numpy(),
         )
+
         # calculate muj for each target. currently constant, could be improved
-        target_events_0 = self.target_events.copy()
-        target_events_0["mu"] = mu
-        if self.free_background:
-            target_events_0["mu"] = (
-                (
-                    (
-                        (
-                            np.exp(
-                                -1 / 2
-                                * Pij_0["spatial_distance_squared"]
-                                / self.bw_sq
-                            )
-                            / (self.bw_sq * 2 * np.pi)
-                        ).mul(target_events_0["P_background"], level=0)
-                    )
-                    .groupby(level=1)
-                    .sum()
-                    + target_events_0["P_background"]
-                    / (self.bw_sq * 2 * np.pi)
-                )
-                / (
-                    self.timewindow_length
-                    # TODO: divide by tw_length minus
-                    # target_to_end_time_distance
-                )
-            ).fillna(0)
+        if self.free_background and self.background_density == "neighbours":
+            mu_j = self.neighbour_background_density() / (
+                self.timewindow_length)
+        elif self.free_background:
+            # background probability of the sources, sources which are
+            # not targets do not contribute
+            source_p_background = target_events["P_background"].reindex(
+                pairs.source_ids).fillna(0).to_numpy()
+            spatial_distance_squared = pairs["spatial_distance_squared"]
+
+            def background_kernel(block):
+                np.take(
+                    source_p_background, source_idx[block], out=tmp[block],
+                    mode="clip")
+                np.multiply(
+                    spatial_distance_squared[block], -1 / 2 / self.bw_sq,
+                    out=Pij[block])
+                np.exp(Pij[block], out=Pij[block])
+                tmp[block] *= Pij[block]
+
+            map_blocks(background_kernel, blocks, executor)
+            background_density = (
+                pairs.sum_by_target(tmp, executor)
+                + target_events["P_background"].to_numpy()
+            ) / (self.bw_sq * 2 * np.pi)
+            # targets without any pairs get no background rate
+            has_pairs = np.bincount(
+                target_idx, minlength=len(target_events)) > 0
+            mu_j = np.where(has_pairs, background_density, 0) / (
+                self.timewindow_length
+                # TODO: divide by tw_length minus
+                # target_to_end_time_distance
+            )
+            mu_j[np.isnan(mu_j)] = 0
         else:
-            target_events_0["mu"] = mu
+            mu_j = np.full(len(target_events), mu)
 
         if self.bg_term is not None:
-            target_events_0["ind"] = iota * target_events_0["bg_term"]
+            ind_j = iota * target_events["bg_term"].to_numpy()
 
         # calculate triggering probabilities Pij
         logger.debug("    calculating Pij")
-        Pij_0["tot_rates"] = 0
-        Pij_0["tot_rates"] = (
-            Pij_0["tot_rates"]
-            .add((Pij_0["gij"] * Pij_0["xi_plus_1"]).groupby(level=1).sum())
-            .add(target_events_0["mu"])
+
+        def triggering_rate(block):
+            np.take(xi_plus_1, source_idx[block], out=tmp[block], mode="clip")
+            tmp[block] *= gij[block]
+
+        map_blocks(triggering_rate, blocks, executor)
+        tot_rates = pairs.sum_by_target(tmp, executor) + mu_j
+        if self.bg_term is not None:
+            tot_rates += ind_j
+
+        def probability(block):
+            np.take(tot_rates, target_idx[block], out=Pij[block], mode="clip")
+            np.divide(gij[block], Pij[block], out=Pij[block])
+
+        map_blocks(probability, blocks, executor)
+
+        # calculate probabilities of being triggered or background
+        p_triggered = pairs.sum_by_target(Pij, executor)
+        p_background = mu_j / tot_rates
+        zeta_plus_1 = observation_factor(
+            self.beta, target_events["mc_current_above_ref"].to_numpy()
         )
+
+        # calculate expected number of background events
+        logger.debug("    calculating n_hat and l_hat")
+        # with free_background, targets without pairs have no rate at all.
+        # their probabilities are nan and are skipped, as in pandas
+        n_hat_0 = np.nansum(p_background * zeta_plus_1)
+        i_hat_0 = 0
+        if self.bg_term is not None:
+            p_induced = ind_j / tot_rates
+            i_hat_0 = np.nansum(p_induced * zeta_plus_1)
+
+        # calculate aftershocks per source event. sources without pairs
+        # have no aftershocks (yet)
+        def observed_probability(block):
+            np.take(
+                pair_zeta_plus_1, target_idx[block], out=tmp[block],
+                mode="clip")
+            tmp[block] *= Pij[block]
+
+        map_blocks(observed_probability, blocks, executor)
+        l_hat = pairs.sum_by_source(tmp, executor)
+
+        Pij_0 = pairs.copy()
+        Pij_0.sources["xi_plus_1"] = xi_plus_1
+        Pij_0.targets["zeta_plus_1"] = pair_zeta_plus_1
+        Pij_0.targets["tot_rates"] = tot_rates
+        # the buffers are reused by the next expectation step
+        Pij_0["gij"] = gij.copy()
+        Pij_0["Pij"] = Pij.copy()
+
+        target_events_0 = target_events.copy()
+        target_events_0["mu"] = mu_j
         if self.bg_term is not None:
-            Pij_0["tot_rates"] = Pij_0["tot_rates"].add(target_events_0["ind"])
-        Pij_0["Pij"] = Pij_0["gij"].div(Pij_0["tot_rates"])
+            target_events_0["ind"] = ind_j
+        target_events_0["P_triggered"] = p_triggered
+        target_events_0["P_background"] = p_background
+        if self.bg_term is not None:
+            target_events_0["P_induced"] = p_induced
+        target_events_0["zeta_plus_1"] = zeta_plus_1
+
+        source_events_0 = self.source_events.copy()
+        source_events_0["l_hat"] = l_hat
 
-        tot_rates_by_target = (
-            Pij_0.groupby(level=1).first()["tot_rates"]
-            .reindex(target_events_0.index)
+        logger.debug(
+            "    expectation step took {}".format(
+                dt.datetime.now() - calc_start)
         )
+        return Pij_0, target_events_0, source_events_0, n_hat_0, i_hat_0
+
+    def chunked_expectation_step(self, theta, mc_min):
+        """
+        Same as expectation_step, for pairs stored on disk (PairChunks).
+        Pairs are read in chunks of pair_memory_budget bytes, twice: once
+        to sum the rates of each target, and once to calculate Pij, which
+        is written to a temporary file in pair_chunk_dir. All pairs of a
+        target are in the same chunk, and aftershocks of a source are
+        summed pair by pair, the result does therefore not depend on the
+        size of the chunks. The file with Pij is reused by each call, the
+        returned pairs are only valid until the next call.
+        """
+        calc_start = dt.datetime.now()
+        log10_mu = theta[0]
+        mu = np.power(10, log10_mu)
+
         if self.bg_term is not None:
-            tot_rates_by_target = tot_rates_by_target.fillna(
-                target_events_0["mu"] + target_events_0["ind"]
-            )
-        else:
-            tot_rates_by_target = tot_rates_by_target.fillna(
-                target_events_0["mu"]
-            )
+            log10_iota = theta[1]
+            iota = np.power(10, log10_iota)
 
-        # calculate probabilities of being triggered or background
-        target_events_0["P_triggered"] = 0
-        target_events_0["P_triggered"] = (
-            target_events_0["P_triggered"]
-            .add(Pij_0["Pij"].groupby(level=1).sum())
-            .fillna(0)
+        pairs = self.distances.align(
+            self.source_events.index, self.target_events.index)
+        columns = ["time_distance", "spatial_distance_squared"]
+
+        source_kappa = (
+            self.source_events["source_kappa"].fillna(0).to_numpy()
+            if self.free_productivity
+            else None
+        )
+        xi_plus_1 = responsibility_factor(
+            theta,
+            self.beta,
+            pairs.sources["source_completeness_above_ref"].to_numpy(),
         )
-        target_events_0["P_background"] = target_events_0["mu"].div(
-            tot_rates_by_target
+        pair_zeta_plus_1 = observation_factor(
+            self.beta,
+            pairs.targets["target_completeness_above_ref"].to_numpy(),
         )
+        # background density summed over the pairs
+        pair_background = self.free_background \
+            and self.background_density == "pairs"
+        if pair_background:
+            source_p_background = self.target_events["P_background"].reindex(
+                pairs.source_ids).fillna(0).to_numpy()
+            background_kernel_sum = np.zeros(len(self.target_events))
+
+        # with n_workers, the kernel is evaluated in parallel. sums are
+        # formed chunk by chunk
+        executor = worker_pool(self.n_workers)
 
-        if self.bg_term is not None:
-            target_events_0["P_induced"] = target_events_0["ind"].div(
-                tot_rates_by_target
+        logger.debug("    calculating gij")
+        triggering_rates = np.zeros(len(self.target_events))
+        for chunk in pairs.chunks(columns, self.pair_memory_budget):
+            gij = pair_triggering_kernel(
+                chunk, [theta, mc_min], source_kappa,
+                out=chunk.buffer("gij"), executor=executor)
+            tmp = chunk.buffer("tmp")
+            np.take(xi_plus_1, chunk.source_idx, out=tmp, mode="clip")
+            tmp *= gij
+            triggering_rates += chunk.sum_by_target(tmp)
+
+            if pair_background:
+                kernel = chunk.buffer("Pij")
+                np.take(
+                    source_p_background, chunk.source_idx, out=tmp,
+                    mode="clip")
+                np.multiply(
+                    chunk["spatial_distance_squared"], -1 / 2 / self.bw_sq,
+                    out=kernel)
+                np.exp(kernel, out=kernel)
+                tmp *= kernel
+                background_kernel_sum += chunk.sum_by_target(tmp)
+
+        if self.free_background and not pair_background:
+            mu_j = self.neighbour_background_density() / (
+                self.timewindow_length)
+        elif self.free_background:
+            background_density = (
+                background_kernel_sum
+                + self.target_events["P_background"].to_numpy()
+            ) / (self.bw_sq * 2 * np.pi)
+            # targets without any pairs get no background rate
+            has_pairs = np.diff(pairs.target_ptr) > 0
+            mu_j = np.where(has_pairs, background_density, 0) / (
+                self.timewindow_length
             )
-        target_events_0["zeta_plus_1"] = observation_factor(
-            self.beta, target_events_0["mc_current_above_ref"]
+            mu_j[np.isnan(mu_j)] = 0
+        else:
+            mu_j = np.full(len(self.target_events), mu)
+
+        if self.bg_term is not None:
+            ind_j = iota * self.target_events["bg_term"].to_numpy()
+
+        tot_rates = triggering_rates + mu_j
+        if self.bg_term is not None:
+            tot_rates += ind_j
+
+        # calculate triggering probabilities Pij and aftershocks per source
+        logger.debug("    calculating Pij")
+        pair_Pij = pairs.disk_buffer("Pij")
+        p_triggered = np.zeros(len(self.target_events))
+        l_hat = np.zeros(len(pairs.sources))
+        for chunk in pairs.chunks(columns, self.pair_memory_budget):
+            gij = pair_triggering_kernel(
+                chunk, [theta, mc_min], source_kappa,
+                out=chunk.buffer("gij"), executor=executor)
+            Pij = chunk.buffer("Pij")
+            tmp = chunk.buffer("tmp")
+            np.take(tot_rates, chunk.target_idx, out=Pij, mode="clip")
+            np.divide(gij, Pij, out=Pij)
+            p_triggered += chunk.sum_by_target(Pij)
+
+            np.take(pair_zeta_plus_1, chunk.target_idx, out=tmp, mode="clip")
+            tmp *= Pij
+            chunk.add_by_source(tmp, l_hat)
+            pair_Pij[chunk.start:chunk.stop] = Pij
+
+        p_background = mu_j / tot_rates
+        zeta_plus_1 = observation_factor(
+            self.beta, self.target_events["mc_current_above_ref"].to_numpy()
         )
 
-        # calculate expected number of background events
         logger.debug("    calculating n_hat and l_hat")
-        n_hat_0 = (
-            target_events_0["P_background"] * target_events_0["zeta_plus_1"]
-        ).sum()
+        n_hat_0 = np.nansum(p_background * zeta_plus_1)
         i_hat_0 = 0
         if self.bg_term is not None:
-            i_hat_0 = (
-                target_events_0["P_induced"] * target_events_0["zeta_plus_1"]
-            ).sum()
+            p_induced = ind_j / tot_rates
+            i_hat_0 = np.nansum(p_induced * zeta_plus_1)
+
+        Pij_0 = pairs.copy()
+        Pij_0.sources["xi_plus_1"] = xi_plus_1
+        Pij_0.targets["zeta_plus_1"] = pair_zeta_plus_1
+        Pij_0.targets["tot_rates"] = tot_rates
+        Pij_0["Pij"] = pair_Pij
+
+        target_events_0 = self.target_events.copy()
+        target_events_0["mu"] = mu_j
+        if self.bg_term is not None:
+            target_events_0["ind"] = ind_j
+        target_events_0["P_triggered"] = p_triggered
+        target_events_0["P_background"] = p_background
+        if self.bg_term is not None:
+            target_events_0["P_induced"] = p_induced
+        target_events_0["zeta_plus_1"] = zeta_plus_1
 
-        # calculate aftershocks per source event
         source_events_0 = self.source_events.copy()
-        source_events_0["l_hat"] = (
-            (Pij_0["Pij"] * Pij_0["zeta_plus_1"]).groupby(level=0).sum()
-        )
-        # filling NaN with 0 to indicate
-        # that those sources have no aftershocks (yet)
-        source_events_0["l_hat"] = source_events_0["l_hat"].fillna(0)
+        source_events_0["l_hat"] = l_hat
 
         logger.debug(
             "    expectation step took {}".format(
@@ -1852,36 +4846,110 @@ class ETASParameterCalculation:
         )
         return Pij_0, target_events_0, source_events_0, n_hat_0, i_hat_0
 
+    def neighbour_background_density(self):
+        """
+        Background density at each target event for background_density
+        "neighbours", the Gaussian kernel with squared bandwidth bw_sq
+        summed over all target events, weighted by their background
+        probability.
+        """
+        if self.background_weights is None:
+            self.background_weights = self.calculate_background_weights()
+        p_background = self.target_events["P_background"].fillna(
+            0).to_numpy()
+        return self.background_weights @ p_background / (
+            self.bw_sq * 2 * np.pi)
+
+    def calculate_background_weights(self):
+        """
+        Gaussian kernel weights of background_density "neighbours" between
+        the target events, up to the distance at which the kernel drops
+        below BACKGROUND_KERNEL_CUTOFF.
+        """
+        calc_start = dt.datetime.now()
+        range_squared = -2 * self.bw_sq * np.log(BACKGROUND_KERNEL_CUTOFF)
+        if self.three_dim:
+            points = self.target_events[["x", "y", "z"]].to_numpy(dtype=float)
+            radius = np.sqrt(range_squared)
+
+            def distance_squared(i, j):
+                return np.sum(np.square(points[i] - points[j]), axis=1)
+        else:
+            lat_rad = np.radians(self.target_events["latitude"].to_numpy())
+            lon_rad = np.radians(self.target_events["longitude"].to_numpy())
+            points = unit_sphere_coordinates(lat_rad, lon_rad)
+            # chord length on the unit sphere, slightly enlarged
+            radius = 2 * np.sin(min(
+                np.sqrt(range_squared) / self.earth_radius, np.pi
+            ) / 2) * (1 + 1e-9) + 1e-12
+
+            def distance_squared(i, j):
+                return np.square(haversine(
+                    lat_rad[i], lat_rad[j], lon_rad[i], lon_rad[j],
+                    self.earth_radius))
+
+        weights = gaussian_kernel_matrix(
+            points, radius, distance_squared, self.bw_sq)
+        self.logger.debug(
+            "    {} background kernel weights, took {}".format(
+                weights.nnz, dt.datetime.now() - calc_start))
+        return weights
+
+    def free_productivity_expected_aftershocks(self, theta):
+        """
+        Expected number of aftershocks of each source with
+        free_productivity: source_kappa times the area and time factors
+        of expected_aftershocks. The time integral only depends on
+        log10_c, omega, log10_tau, it is kept until they change.
+        """
+        log10_c, omega, log10_tau, log10_d, gamma, rho = theta[4:]
+        if self.time_integral_cache is None \
+                or self.time_integral_cache[0] != (log10_c, omega, log10_tau):
+            self.time_integral_cache = (
+                (log10_c, omega, log10_tau),
+                aftershock_time_integral(
+                    [log10_c, omega, log10_tau],
+                    self.source_events[
+                        "pos_source_to_start_time_distance"].to_numpy(),
+                    self.source_events[
+                        "source_to_end_time_distance"].to_numpy(),
+                ),
+            )
+        time_integral = self.time_integral_cache[1]
+
+        m_diff = self.source_events["source_magnitude"].to_numpy() \
+            - (self.m_ref - self.delta_m / 2)
+        area_factor = np.pi * np.power(
+            np.power(10, log10_d) * np.exp(gamma * m_diff), -1 * rho) / rho
+        return self.source_events["source_kappa"].to_numpy() \
+            * area_factor * time_integral
+
     def update_source_kappa(self):
-        self.source_events["G"] = expected_aftershocks_free_prod(
-            [
-                self.source_events["source_magnitude"],
-                self.source_events["source_kappa"],
-                self.source_events["pos_source_to_start_time_distance"],
-                self.source_events["source_to_end_time_distance"],
-            ],
-            [self.__theta[4:], self.m_ref - self.delta_m / 2],
-        )
+        G = self.free_productivity_expected_aftershocks(self.__theta)
         # filling nan with 0 because I believe the only way this can be
         # undefined is when G is zero, which only happens when source_kappa
         # is zero. so should be fine.
-        self.source_events["source_kappa"] = (
-            self.source_events["source_kappa"]
-            * self.source_events["l_hat"]
-            / self.source_events["G"]
-        ).fillna(0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            source_kappa = self.source_events["source_kappa"].to_numpy() \
+                * self.source_events["l_hat"].to_numpy() / G
+        source_kappa[np.isnan(source_kappa)] = 0
+        self.source_events["G"] = G
+        self.source_events["source_kappa"] = source_kappa
 
     def calc_a_k0_from_kappa(self):
-        prim_mags = self.catalog.query(
-            "time >=@self.timewindow_start")["magnitude"]
-        kappas_estimated = pd.merge(
-            prim_mags,
-            self.source_events[["source_kappa"]],
-            left_index=True,
-            right_index=True,
-            how="left",
-        ).fillna(0)
+        # positions of the events of the primary catalog among the
+        # sources, they do not change during the inversion
+        if self.primary_source_positions is None:
+            primary = self.catalog.query("time >=@self.timewindow_start")
+            self.primary_source_positions = (
+                self.source_events.index.get_indexer(primary.index),
+                primary["magnitude"].to_numpy()
+                - (self.m_ref - self.delta_m / 2),
+            )
+        positions, m_diff = self.primary_source_positions
+        source_kappa = self.source_events["source_kappa"].fillna(
+            0).to_numpy()
+        # events which are not sources have a kappa of 0
+        kappa = np.where(positions >= 0, source_kappa[positions], 0)
         self.__theta[3], self.__theta[2] = calc_a_k0_from_kappa(
-            kappas_estimated["source_kappa"],
-            kappas_estimated["magnitude"] - (self.m_ref - self.delta_m / 2),
-        )
+            kappa, m_diff)
@@ -0,0 +1,72 @@
+##############################################################################
+# fitted ETAS model
+#
+# the part of an ETAS inversion which is needed to simulate catalogs: the
+# parameters, the magnitude settings, the region and time window, and the
+# prepared source and target tables. it is much smaller than the
+# ETASParameterCalculation it comes from (no catalog, distances or pij),
+# and cheap to copy and to send to other processes.
+##############################################################################
+
+import dataclasses
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+from etas.geometry import Region
+
+
+@dataclasses.dataclass(frozen=True, eq=False)
+class FittedModel:
+    """
+    Fitted ETAS model, as created by ETASParameterCalculation.fitted_model.
+
+    Attributes cannot be set. The tables are shared between copies (see
+    with_theta) and must not be modified.
+
+    Parameters
+    ----------
+    theta : dict
+        ETAS parameters.
+    beta : float
+        Beta of the magnitude distribution.
+    m_ref : float
+        Reference magnitude of the parameters.
+    delta_m : float
+        Bin size of magnitudes.
+    shape_coords : np.ndarray
+        Coordinates of the region ([[lat1, lon1], ...]).
+    auxiliary_start : pd.Timestamp
+        Start of the auxiliary catalog.
+    timewindow_end : pd.Timestamp
+        End of the training period, start of forecasts.
+    catalog : pd.DataFrame
+        Source events with latitude, longitude, time, magnitude and
+        xi_plus_1, the events which trigger aftershocks in simulations.
+    target_events : pd.DataFrame
+        Target events above m_ref - delta_m/2 in the region, with
+        latitude, longitude, P_background and zeta_plus_1. Their
+        locations are used to simulate background events.
+    calculation_date : str, optional
+        When the parameters were calculated.
+    """
+
+    theta: dict
+    beta: float
+    m_ref: float
+    delta_m: float
+    shape_coords: np.ndarray
+    auxiliary_start: pd.Timestamp
+    timewindow_end: pd.Timestamp
+    catalog: pd.DataFrame
+    target_events: pd.DataFrame
+    calculation_date: str = None
+
+    @cached_property
+    def region(self):
+        return Region(self.shape_coords)
+
+    def with_theta(self, theta):
+        """Copy of the model with parameters theta, sharing the tables."""
+        return dataclasses.replace(self, theta=dict(theta))
@@ -1,4 +1,3 @@
-import copy
 from importlib import resources
 
 import numpy as np
@@ -52,7 +51,7 @@ def entrypoint_suiETAS(model_input: ModelInput) -> list[ForecastCatalog]:
     etas_parameters.invert()
 
     # Run ETAS Simulation
-    simulation = ETASSimulation(etas_parameters, m_max=7.6)
+    simulation = ETASSimulation(etas_parameters.fitted_model(), m_max=7.6)
     simulation.prepare()
 
     # prepare background grid for simulation of locations
@@ -122,12 +121,7 @@ def entrypoint_genETAS(model_input: ModelInput) -> list[ForecastCatalog]:
     etas_parameters.prepare()
     etas_parameters.invert()
 
-    # Run ETAS Simulation
-    simulation_deep = ETASSimulation(copy.deepcopy(etas_parameters), m_max=7.6)
-    simulation_deep.prepare()
-    simulation_shallow = ETASSimulation(copy.deepcopy(etas_parameters),
-                                        m_max=7.6)
-    simulation_shallow.prepare()
+    fitted_model = etas_parameters.fitted_model()
 
     # prepare background grid for simulation of locations
     with resources.open_binary("etas.oef.data", "SUIhaz2015_rates.csv") as f:
@@ -137,9 +131,7 @@ def entrypoint_genETAS(model_input: ModelInput) -> list[ForecastCatalog]:
     background_lons = bg_grid.query("in_poly")["longitude"].copy()
     background_probs = 1000 * bg_grid.query("in_poly")["rate_2.5"].copy()
 
-    log10_mu_inverted = simulation_deep.inversion_params.theta["log10_mu"]
-    parameters_inverted_deep = simulation_deep.inversion_params.theta
-    parameters_inverted_shallow = simulation_shallow.inversion_params.theta
+    log10_mu_inverted = fitted_model.theta["log10_mu"]
     standard_deep = {
         'a': -2.23,
         'p': 1.08,
@@ -153,20 +145,25 @@ def entrypoint_genETAS(model_input: ModelInput) -> list[ForecastCatalog]:
         'log10_c': -2.76
     }
     parameters_deep = parameters_from_standard_formulation(
-        standard_deep, parameters_inverted_deep,
-        delta_m_ref=simulation_deep.inversion_params.m_ref - 4.5,
+        standard_deep, fitted_model.theta,
+        delta_m_ref=fitted_model.m_ref - 4.5,
         dm_max_st=7.6 - 4.5
     )
     parameters_shallow = parameters_from_standard_formulation(
-        standard_shallow, parameters_inverted_shallow,
-        delta_m_ref=simulation_shallow.inversion_params.m_ref - 4.5,
+        standard_shallow, fitted_model.theta,
+        delta_m_ref=fitted_model.m_ref - 4.5,
         dm_max_st=7.6 - 4.5
     )
     parameters_deep["log10_mu"] = log10_mu_inverted
     parameters_shallow["log10_mu"] = log10_mu_inverted
 
-    simulation_deep.inversion_params.theta = parameters_deep
-    simulation_shallow.inversion_params.theta = parameters_shallow
+    # Run ETAS Simulation
+    simulation_deep = ETASSimulation(
+        fitted_model.with_theta(parameters_deep), m_max=7.6)
+    simulation_deep.prepare()
+    simulation_shallow = ETASSimulation(
+        fitted_model.with_theta(parameters_shallow), m_max=7.6)
+    simulation_shallow.prepare()
 
     for simulation in [simulation_deep, simulation_shallow]:
         simulation.bg_grid = True
@@ -0,0 +1,905 @@
+##############################################################################
+# storage of the pairs of potentially related events of the ETAS inversion
+#
+# PairTable keeps the pairs in memory in a compressed sparse row layout,
+# sorted by source, with one table of sources and one of targets. PairChunks
+# keeps them on disk as memory-mapped .npy files, sorted by target, and
+# processes them in chunks. with n_workers, operations on pairs are split
+# into blocks of fixed size which are evaluated by a pool of threads.
+##############################################################################
+
+import atexit
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# with n_workers, sources and pairs are split into blocks of about this
+# size. the blocks do not depend on the number of workers, and partial
+# sums of the blocks are added in the order of the blocks
+WORKER_BLOCK_SIZE = 2 ** 16
+# thread pools of the workers, per process and number of workers. they are
+# shut down by shutdown_worker_pools, at the latest when the interpreter
+# exits
+worker_pools = {}
+
+
+def worker_pool(n_workers):
+    """
+    Returns a thread pool with n_workers threads, or None if n_workers is
+    None or 1. numpy releases the GIL in operations on arrays, such that the
+    workers share the arrays of sources and pairs without copying them.
+    Pools are created once per process.
+    """
+    # a single worker only adds the overhead of the blocks and the pool
+    if n_workers is None or n_workers <= 1:
+        return None
+    key = (os.getpid(), n_workers)
+    if key not in worker_pools:
+        worker_pools[key] = ThreadPoolExecutor(max_workers=n_workers)
+    return worker_pools[key]
+
+
+@atexit.register
+def shutdown_worker_pools():
+    """
+    Shuts down the thread pools of worker_pool of this process. Pools
+    are created again when they are needed.
+    """
+    for key in [key for key in worker_pools if key[0] == os.getpid()]:
+        worker_pools.pop(key).shutdown(wait=True)
+
+
+def block_slices(n, executor=None, block_size=WORKER_BLOCK_SIZE):
+    """
+    Splits range(n) into slices of block_size elements if executor is
+    given, otherwise returns a single slice.
+    """
+    if executor is None:
+        return [slice(0, n)]
+    return [slice(start, min(start + block_size, n))
+            for start in range(0, n, block_size)]
+
+
+def aligned_block_bounds(ptr, block_size=WORKER_BLOCK_SIZE):
+    """
+    Splits the rows of a compressed sparse row pointer ptr into blocks of
+    consecutive rows with at least block_size elements, except for the
+    last block. Returns the first row of each block, followed by the end
+    of the last block.
+    """
+    bounds = [0]
+    while ptr[bounds[-1]] < ptr[-1]:
+        row = np.searchsorted(ptr, ptr[bounds[-1]] + block_size)
+        bounds.append(int(min(row, len(ptr) - 1)))
+    return np.array(bounds)
+
+
+def map_blocks(function, blocks, executor=None):
+    """
+    Applies function to each block, with the workers of executor if given.
+    Results are returned in the order of the blocks.
+    """
+    if executor is None:
+        return [function(block) for block in blocks]
+    return list(executor.map(function, blocks))
+
+
+SOURCE_PAIR_COLUMNS = (
+    "source_magnitude",
+    "source_completeness_above_ref",
+    "source_to_end_time_distance",
+    "pos_source_to_start_time_distance",
+    "xi_plus_1",
+)
+TARGET_PAIR_COLUMNS = (
+    "target_time",
+    "target_completeness_above_ref",
+    "zeta_plus_1",
+    "tot_rates",
+)
+# column order of the pair csv files of store_results. the first column,
+# id, repeats the target id
+PAIR_CSV_COLUMNS = (
+    "target_time",
+    "source_magnitude",
+    "source_completeness_above_ref",
+    "target_completeness_above_ref",
+    "spatial_distance_squared",
+    "time_distance",
+    "source_to_end_time_distance",
+    "pos_source_to_start_time_distance",
+    "gij",
+    "xi_plus_1",
+    "zeta_plus_1",
+    "tot_rates",
+    "Pij",
+)
+
+
+def pair_csv_frame(pairs):
+    """
+    Pairs (PairTable or PairChunks) as a DataFrame in the layout of the
+    pair csv files of store_results, which can be read with
+    PairTable.from_frame.
+    """
+    frame = pairs.to_frame()
+    frame = frame[
+        [c for c in PAIR_CSV_COLUMNS if c in frame.columns]
+        + [c for c in frame.columns if c not in PAIR_CSV_COLUMNS]
+    ]
+    frame.insert(0, "id", frame.index.get_level_values("target_id"))
+    return frame
+
+
+class PairTable:
+    """
+    Pairs of potentially related events (source, target), stored in
+    compressed sparse row (CSR) layout.
+
+    Pairs are sorted by source, pairs of the i-th source are at positions
+    source_ptr[i]:source_ptr[i + 1]. For each pair, the positions of source
+    and target in the source and target tables are stored as int32.
+    Values which are constant per source or per target are stored only
+    once in the respective table, and are gathered when a column is
+    accessed.
+
+    Columns are accessed like in a DataFrame, pair_table["Pij"] returns
+    an array with one value per pair, pair_table[mask] returns a PairTable
+    containing the pairs selected by a boolean mask.
+
+    Parameters
+    ----------
+    source_idx : np.ndarray
+        Position of the source of each pair in sources.
+    target_idx : np.ndarray
+        Position of the target of each pair in targets.
+    sources : pd.DataFrame
+        Source table, index is the source_id.
+    targets : pd.DataFrame
+        Target table, index is the target_id.
+    columns : dict, optional
+        Columns with one value per pair.
+    """
+
+    def __init__(self, source_idx, target_idx, sources, targets,
+                 columns=None):
+        source_idx = np.asarray(source_idx, dtype=np.int32)
+        target_idx = np.asarray(target_idx, dtype=np.int32)
+        columns = dict(columns or {})
+
+        if np.any(source_idx[1:] < source_idx[:-1]):
+            order = np.argsort(source_idx, kind="stable")
+            source_idx = source_idx[order]
+            target_idx = target_idx[order]
+            columns = {name: np.asarray(values)[order]
+                       for name, values in columns.items()}
+
+        self.source_idx = source_idx
+        self.target_idx = target_idx
+        self.sources = sources.rename_axis("source_id")
+        self.targets = targets.rename_axis("target_id")
+        self.columns = {name: np.asarray(values)
+                        for name, values in columns.items()}
+        self.source_ptr = np.concatenate([
+            [0],
+            np.cumsum(np.bincount(source_idx, minlength=len(sources))),
+        ]).astype(np.int64)
+        self.buffers = {}
+        self.worker_blocks = {}
+
+    @classmethod
+    def from_frame(cls, frame):
+        """
+        Creates a PairTable from a DataFrame with a (source_id, target_id)
+        MultiIndex, as stored by ETASParameterCalculation.store_results.
+        """
+        # id repeats the target id, see pair_csv_frame
+        frame = frame.drop(columns="id", errors="ignore")
+        source_idx, source_ids = pd.factorize(
+            frame.index.get_level_values("source_id"))
+        target_idx, target_ids = pd.factorize(
+            frame.index.get_level_values("target_id"))
+        source_columns = [
+            c for c in frame.columns if c in SOURCE_PAIR_COLUMNS]
+        target_columns = [
+            c for c in frame.columns if c in TARGET_PAIR_COLUMNS]
+        pair_columns = [
+            c for c in frame.columns
+            if c not in source_columns and c not in target_columns
+        ]
+
+        sources = frame[source_columns].iloc[
+            np.unique(source_idx, return_index=True)[1]]
+        sources.index = source_ids
+        targets = frame[target_columns].iloc[
+            np.unique(target_idx, return_index=True)[1]]
+        targets.index = target_ids
+
+        return cls(
+            source_idx,
+            target_idx,
+            sources,
+            targets,
+            {c: frame[c].to_numpy() for c in pair_columns},
+        )
+
+    @classmethod
+    def from_bundle(cls, bundle, table):
+        """
+        Reads a PairTable stored as table of a Bundle, see bundle_parts.
+        The arrays of the pairs are memory-mapped.
+        """
+        parts = bundle.read(table)
+        obj = cls.__new__(cls)
+        obj.source_idx = parts.pop("source_idx")
+        obj.target_idx = parts.pop("target_idx")
+        obj.source_ptr = parts.pop("source_ptr")
+        obj.sources = parts.pop("sources").rename_axis("source_id")
+        obj.targets = parts.pop("targets").rename_axis("target_id")
+        obj.columns = {
+            part[len("column."):]: values for part, values in parts.items()
+        }
+        obj.buffers = {}
+        obj.worker_blocks = {}
+        return obj
+
+    def bundle_parts(self):
+        """Parts of the PairTable to be stored with write_bundle."""
+        return {
+            "source_idx": self.source_idx,
+            "target_idx": self.target_idx,
+            "source_ptr": self.source_ptr,
+            "sources": self.sources,
+            "targets": self.targets,
+            **{
+                "column." + name: values
+                for name, values in self.columns.items()
+            },
+        }
+
+    def __len__(self):
+        return len(self.source_idx)
+
+    @property
+    def source_ids(self):
+        return self.sources.index
+
+    @property
+    def target_ids(self):
+        return self.targets.index
+
+    def __contains__(self, name):
+        return (
+            name in self.columns
+            or name in self.sources.columns
+            or name in self.targets.columns
+        )
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self.columns:
+                return self.columns[key]
+            if key in self.sources.columns:
+                return self.sources[key].to_numpy()[self.source_idx]
+            if key in self.targets.columns:
+                return self.targets[key].to_numpy()[self.target_idx]
+            if key == "source_id":
+                return self.source_ids.to_numpy()[self.source_idx]
+            if key == "target_id":
+                return self.target_ids.to_numpy()[self.target_idx]
+            raise KeyError(key)
+
+        mask = np.asarray(key, dtype=bool)
+        return PairTable(
+            self.source_idx[mask],
+            self.target_idx[mask],
+            self.sources,
+            self.targets,
+            {name: values[mask] for name, values in self.columns.items()},
+        )
+
+    def __setitem__(self, key, values):
+        values = np.asarray(values)
+        assert len(values) == len(self), \
+            "pair columns must have one value per pair."
+        self.columns[key] = values
+
+    def copy(self):
+        """
+        Copies the source and target tables. Pair columns are shared with
+        the copy, setting a column on the copy does not affect the
+        original.
+        """
+        obj = PairTable.__new__(PairTable)
+        obj.source_idx = self.source_idx
+        obj.target_idx = self.target_idx
+        obj.source_ptr = self.source_ptr
+        obj.sources = self.sources.copy()
+        obj.targets = self.targets.copy()
+        obj.columns = dict(self.columns)
+        obj.buffers = {}
+        obj.worker_blocks = self.worker_blocks
+        return obj
+
+    def buffer(self, name):
+        """
+        Returns a preallocated float array with one value per pair. The
+        same array is returned for the same name on each call, such that
+        it can be reused as output of repeated calculations. Its content
+        is overwritten by each of them.
+        """
+        if name not in self.buffers:
+            self.buffers[name] = np.empty(len(self))
+        return self.buffers[name]
+
+    def source_blocks(self, executor=None):
+        """
+        Bounds of blocks of consecutive sources with about
+        WORKER_BLOCK_SIZE pairs if executor is given, otherwise a single
+        block of all sources.
+        """
+        if executor is None:
+            return [(0, len(self.sources))]
+        if "source" not in self.worker_blocks:
+            bounds = aligned_block_bounds(self.source_ptr)
+            self.worker_blocks["source"] = list(zip(bounds[:-1], bounds[1:]))
+        return self.worker_blocks["source"]
+
+    def target_blocks(self):
+        """
+        Order of the pairs by target, the position of the first pair of
+        each target in this order, and bounds of blocks of consecutive
+        targets with about WORKER_BLOCK_SIZE pairs.
+        """
+        if "target" not in self.worker_blocks:
+            order = np.argsort(self.target_idx, kind="stable")
+            target_ptr = np.concatenate([
+                [0],
+                np.cumsum(np.bincount(
+                    self.target_idx, minlength=len(self.targets))),
+            ])
+            bounds = aligned_block_bounds(target_ptr)
+            self.worker_blocks["target"] = (
+                order, target_ptr, list(zip(bounds[:-1], bounds[1:])))
+        return self.worker_blocks["target"]
+
+    def sum_by_source(self, values, executor=None):
+        """
+        Sums values given per pair for each source. With executor, blocks
+        of sources are summed in parallel, with the same result.
+        """
+        sums = np.zeros(len(self.sources))
+        values = np.asarray(values, dtype=float)
+
+        def sum_block(block):
+            first, last = block
+            starts = self.source_ptr[first:last]
+            has_pairs = starts < self.source_ptr[first + 1:last + 1]
+            if np.any(has_pairs):
+                offset = self.source_ptr[first]
+                sums[first:last][has_pairs] = np.add.reduceat(
+                    values[offset:self.source_ptr[last]],
+                    starts[has_pairs] - offset,
+                )
+
+        map_blocks(sum_block, self.source_blocks(executor), executor)
+        return sums
+
+    def sum_by_target(self, values, executor=None):
+        """
+        Sums values given per pair for each target. With executor, blocks
+        of targets are summed in parallel. The pairs of a target are
+        summed in the same order, the result is the same.
+        """
+        if executor is None:
+            return np.bincount(
+                self.target_idx, weights=values, minlength=len(self.targets))
+
+        order, target_ptr, blocks = self.target_blocks()
+        sums = np.zeros(len(self.targets))
+
+        def sum_block(block):
+            first, last = block
+            pairs = order[target_ptr[first]:target_ptr[last]]
+            sums[first:last] = np.bincount(
+                self.target_idx[pairs] - first,
+                weights=values[pairs],
+                minlength=last - first,
+            )
+
+        map_blocks(sum_block, blocks, executor)
+        return sums
+
+    def align(self, source_ids, target_ids):
+        """
+        Reorders source and target tables such that their index is
+        source_ids and target_ids. Pairs whose source or target is not
+        contained in source_ids or target_ids are dropped.
+        """
+        if self.source_ids.equals(source_ids) \
+                and self.target_ids.equals(target_ids):
+            return self
+
+        source_position = pd.Index(source_ids).get_indexer(self.source_ids)
+        target_position = pd.Index(target_ids).get_indexer(self.target_ids)
+        source_idx = source_position[self.source_idx]
+        target_idx = target_position[self.target_idx]
+        keep = (source_idx >= 0) & (target_idx >= 0)
+
+        return PairTable(
+            source_idx[keep],
+            target_idx[keep],
+            self.sources.reindex(source_ids),
+            self.targets.reindex(target_ids),
+            {name: values[keep] for name, values in self.columns.items()},
+        )
+
+    def to_frame(self):
+        """
+        Returns the pairs as a DataFrame with a (source_id, target_id)
+        MultiIndex, one row per pair.
+        """
+        frame = pd.DataFrame(
+            {
+                **{c: self[c] for c in self.sources.columns},
+                **{c: self[c] for c in self.targets.columns},
+                **self.columns,
+            },
+            index=pd.MultiIndex.from_arrays(
+                [self["source_id"], self["target_id"]],
+                names=["source_id", "target_id"],
+            ),
+        )
+        return frame
+
+
+# pairs stored on disk are processed in chunks of whole blocks. blocks
+# contain whole targets and at least PAIR_BLOCK_SIZE pairs. partial sums
+# are formed per block, per target or per source, such that results do
+# not depend on the size of the chunks
+PAIR_BLOCK_SIZE = 2 ** 18
+# number of targets whose pairs are collected in one file while writing
+PAIR_BUCKET_SIZE = 2 ** 16
+# approximate memory needed per pair of a chunk, for its columns and the
+# buffers of the expectation step
+PAIR_CHUNK_BYTES_PER_PAIR = 64
+PAIR_RECORD = np.dtype([
+    ("source_idx", np.int32),
+    ("target_idx", np.int32),
+    ("spatial_distance_squared", float),
+])
+
+
+class PairChunks:
+    """
+    Pairs of potentially related events (source, target), stored on disk
+    as memory-mapped .npy files, one file per column.
+
+    Pairs are sorted by target and then by source, and are divided into
+    blocks which contain all pairs of consecutive targets. The pairs are
+    processed in chunks of whole blocks (see chunks), such that only one
+    chunk needs to be in memory at a time. Source and target tables are
+    kept in memory, as in PairTable.
+
+    Files are created with PairChunkWriter.
+
+    Parameters
+    ----------
+    directory : str
+        Directory containing the files.
+    sources : pd.DataFrame
+        Source table, index is the source_id.
+    targets : pd.DataFrame
+        Target table, index is the target_id.
+    """
+
+    stored_columns = ("spatial_distance_squared", "time_distance")
+
+    def __init__(self, directory, sources, targets):
+        self.directory = directory
+        self.sources = sources.rename_axis("source_id")
+        self.targets = targets.rename_axis("target_id")
+        self.open()
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".npy")
+
+    def open(self):
+        def load(name):
+            return np.load(self.path(name), mmap_mode="r")
+
+        self.source_idx = load("source_idx")
+        self.target_idx = load("target_idx")
+        self.columns = {name: load(name) for name in self.stored_columns}
+        self.target_ptr = np.load(self.path("target_ptr"))
+        self.block_ptr = np.load(self.path("block_ptr"))
+        # positions of the sources of a block's pairs among the sources of
+        # the block, and the sources of each block
+        self.block_group = load("block_group")
+        self.block_sources = load("block_sources")
+        self.block_sources_ptr = np.load(self.path("block_sources_ptr"))
+        self.buffers = {}
+        self.disk_buffers = {}
+
+    def __getstate__(self):
+        # only the tables are pickled, the files are opened again
+        return {
+            "directory": self.directory,
+            "sources": self.sources,
+            "targets": self.targets,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        return len(self.source_idx)
+
+    @property
+    def source_ids(self):
+        return self.sources.index
+
+    @property
+    def target_ids(self):
+        return self.targets.index
+
+    def __contains__(self, name):
+        return (
+            name in self.columns
+            or name in self.sources.columns
+            or name in self.targets.columns
+        )
+
+    def __getitem__(self, key):
+        """
+        Returns a column for all pairs. Pair columns are memory-mapped,
+        other columns are loaded into memory.
+        """
+        if key in self.columns:
+            return self.columns[key]
+        if key in self.sources.columns:
+            return self.sources[key].to_numpy()[self.source_idx]
+        if key in self.targets.columns:
+            return self.targets[key].to_numpy()[self.target_idx]
+        raise KeyError(key)
+
+    def __setitem__(self, key, values):
+        assert len(values) == len(self), \
+            "pair columns must have one value per pair."
+        self.columns[key] = values
+
+    def copy(self):
+        """
+        Copies the source and target tables. Files and pair columns are
+        shared with the copy.
+        """
+        obj = PairChunks.__new__(PairChunks)
+        obj.__dict__.update(self.__dict__)
+        obj.sources = self.sources.copy()
+        obj.targets = self.targets.copy()
+        obj.columns = dict(self.columns)
+        obj.buffers = {}
+        return obj
+
+    def align(self, source_ids, target_ids):
+        """
+        Same as PairTable.align. Pairs on disk are not reordered, source_ids
+        and target_ids need to be the index of the source and target
+        tables.
+        """
+        if self.source_ids.equals(source_ids) \
+                and self.target_ids.equals(target_ids):
+            return self
+        raise ValueError(
+            "pairs stored in {} can not be aligned to other source and "
+            "target events.".format(self.directory))
+
+    def disk_buffer(self, name):
+        """
+        Returns a memory-mapped float array with one value per pair, in an
+        anonymous temporary file in the directory of the pairs. As with
+        PairTable.buffer, the same array is returned for the same name on
+        each call. Buffers are not shared between processes.
+        """
+        key = (os.getpid(), name)
+        if key not in self.disk_buffers:
+            self.disk_buffers[key] = np.memmap(
+                tempfile.TemporaryFile(dir=self.directory),
+                dtype=float,
+                mode="w+",
+                shape=(len(self),),
+            )
+        return self.disk_buffers[key]
+
+    def chunks(self, columns, memory_budget=None):
+        """
+        Yields the pairs in chunks of consecutive blocks, as PairChunk with
+        the given pair columns loaded into memory.
+
+        Parameters
+        ----------
+        columns : list of str
+            Pair columns to load.
+        memory_budget : int, optional
+            Approximate memory for a chunk in bytes. Chunks contain at
+            least one block. If None, all pairs are loaded at once.
+        """
+        n_blocks = len(self.block_ptr) - 1
+        first = 0
+        while first < n_blocks:
+            if memory_budget is None:
+                last = n_blocks
+            else:
+                max_pairs = memory_budget // PAIR_CHUNK_BYTES_PER_PAIR
+                last = np.searchsorted(
+                    self.block_ptr,
+                    self.block_ptr[first] + max_pairs,
+                    side="right",
+                ) - 1
+                last = min(max(last, first + 1), n_blocks)
+            yield PairChunk(self, first, last, columns)
+            first = last
+
+    def to_frame(self):
+        """
+        Returns the pairs as a DataFrame, same as PairTable.to_frame.
+        All pairs are loaded into memory.
+        """
+        return pd.concat([
+            PairTable(
+                chunk.source_idx,
+                chunk.target_idx,
+                self.sources,
+                self.targets,
+                chunk.columns,
+            ).to_frame()
+            for chunk in self.chunks(list(self.columns))
+        ])
+
+
+class PairChunk:
+    """
+    Pairs of consecutive blocks of a PairChunks. Columns are accessed like
+    in a PairTable, and are views of the memory-mapped files.
+
+    Parameters
+    ----------
+    pairs : PairChunks
+        Pairs on disk.
+    first_block, last_block : int
+        The chunk consists of blocks first_block to last_block - 1.
+    columns : list of str
+        Pair columns to access.
+    """
+
+    def __init__(self, pairs, first_block, last_block, columns):
+        self.pairs = pairs
+        self.first_block = first_block
+        self.last_block = last_block
+        self.start = int(pairs.block_ptr[first_block])
+        self.stop = int(pairs.block_ptr[last_block])
+        self.sources = pairs.sources
+        self.targets = pairs.targets
+        self.source_idx = np.asarray(
+            pairs.source_idx[self.start:self.stop])
+        self.target_idx = np.asarray(
+            pairs.target_idx[self.start:self.stop])
+        self.columns = {
+            name: np.asarray(pairs.columns[name][self.start:self.stop])
+            for name in columns
+        }
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if key in self.columns:
+            return self.columns[key]
+        if key in self.sources.columns:
+            return self.sources[key].to_numpy()[self.source_idx]
+        if key in self.targets.columns:
+            return self.targets[key].to_numpy()[self.target_idx]
+        raise KeyError(key)
+
+    def buffer(self, name):
+        """
+        Same as PairTable.buffer. Buffers are shared by the chunks of the
+        same PairChunks.
+        """
+        buffer = self.pairs.buffers.get(name)
+        if buffer is None or len(buffer) < len(self):
+            buffer = np.empty(len(self))
+            self.pairs.buffers[name] = buffer
+        return buffer[:len(self)]
+
+    def sum_by_target(self, values):
+        """
+        Sums values given per pair for each target. All pairs of a target
+        are in the same chunk, targets of other chunks get zero.
+        """
+        return np.bincount(
+            self.target_idx, weights=values, minlength=len(self.targets))
+
+    def add_by_source(self, values, out):
+        """
+        Adds values given per pair to out, for each source. Values are
+        added one by one in the order of the pairs, the sums do therefore
+        not depend on how pairs are divided into chunks.
+        """
+        np.add.at(out, self.source_idx, values)
+
+    def blocks(self):
+        """
+        Yields for each block of the chunk its number, the slice of its
+        pairs in the chunk, the position of their sources among the
+        sources of the block, and the sources of the block.
+        """
+        pairs = self.pairs
+        for block in range(self.first_block, self.last_block):
+            start = pairs.block_ptr[block]
+            stop = pairs.block_ptr[block + 1]
+            yield (
+                block,
+                slice(start - self.start, stop - self.start),
+                np.asarray(pairs.block_group[start:stop]),
+                np.asarray(pairs.block_sources[
+                    pairs.block_sources_ptr[block]:
+                    pairs.block_sources_ptr[block + 1]
+                ]),
+            )
+
+
+class PairChunkWriter:
+    """
+    Writes pairs to disk for PairChunks. Pairs can be added in any order,
+    they are first collected in one file per bucket of PAIR_BUCKET_SIZE
+    targets. finish() sorts the pairs of one bucket at a time.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the files, created if it does not exist. Existing
+        pairs in the directory are replaced by finish().
+    n_targets : int
+        Number of targets.
+    """
+
+    def __init__(self, directory, n_targets):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.n_targets = n_targets
+        self.n_buckets = max(1, -(-n_targets // PAIR_BUCKET_SIZE))
+        self.bucket_counts = np.zeros(self.n_buckets, dtype=np.int64)
+        for bucket in range(self.n_buckets):
+            if os.path.exists(self.bucket_path(bucket)):
+                os.remove(self.bucket_path(bucket))
+
+    def bucket_path(self, bucket):
+        return os.path.join(self.directory, "bucket_{}.tmp".format(bucket))
+
+    def append(self, source_idx, target_idx, spatial_distance_squared):
+        records = np.empty(len(source_idx), dtype=PAIR_RECORD)
+        records["source_idx"] = source_idx
+        records["target_idx"] = target_idx
+        records["spatial_distance_squared"] = spatial_distance_squared
+
+        bucket = records["target_idx"] // PAIR_BUCKET_SIZE
+        records = records[np.argsort(bucket, kind="stable")]
+        counts = np.bincount(bucket, minlength=self.n_buckets)
+        ptr = np.concatenate([[0], np.cumsum(counts)])
+        for b in np.flatnonzero(counts):
+            with open(self.bucket_path(b), "ab") as f:
+                records[ptr[b]:ptr[b + 1]].tofile(f)
+        self.bucket_counts += counts
+
+    def finish(self, sources, targets, source_times, target_times,
+               distance_dtype=float):
+        """
+        Sorts the pairs by target and source, calculates their time
+        distance and divides them into blocks.
+
+        Parameters
+        ----------
+        sources, targets : pd.DataFrame
+            Source and target tables.
+        source_times, target_times : np.ndarray
+            Times of sources and targets.
+        distance_dtype : dtype, optional
+            Dtype of spatial and time distances.
+
+        Returns
+        -------
+        PairChunks
+        """
+        n_pairs = int(self.bucket_counts.sum())
+        n_sources = len(sources)
+        dtypes = {
+            "source_idx": np.int32,
+            "target_idx": np.int32,
+            "spatial_distance_squared": distance_dtype,
+            "time_distance": distance_dtype,
+            "block_group": np.int32,
+        }
+        # files are written under a temporary name and replaced at the
+        # end, previous pairs in the same directory stay readable
+        files = {
+            name: np.lib.format.open_memmap(
+                os.path.join(self.directory, name + ".npy.tmp"),
+                mode="w+",
+                dtype=dtype,
+                shape=(n_pairs,),
+            )
+            for name, dtype in dtypes.items()
+        }
+
+        target_counts = np.zeros(self.n_targets, dtype=np.int64)
+        position = 0
+        for bucket in np.flatnonzero(self.bucket_counts):
+            records = np.fromfile(self.bucket_path(bucket), dtype=PAIR_RECORD)
+            os.remove(self.bucket_path(bucket))
+            records = records[np.argsort(
+                records["target_idx"].astype(np.int64) * n_sources
+                + records["source_idx"],
+                kind="stable",
+            )]
+            source_idx = records["source_idx"]
+            target_idx = records["target_idx"]
+            stop = position + len(records)
+            files["source_idx"][position:stop] = source_idx
+            files["target_idx"][position:stop] = target_idx
+            files["spatial_distance_squared"][position:stop] = \
+                records["spatial_distance_squared"]
+            files["time_distance"][position:stop] = (
+                target_times[target_idx] - source_times[source_idx]
+            ) / np.timedelta64(1, "D")
+
+            first_target = bucket * PAIR_BUCKET_SIZE
+            counts = np.bincount(
+                target_idx - first_target,
+                minlength=min(PAIR_BUCKET_SIZE,
+                              self.n_targets - first_target),
+            )
+            target_counts[first_target:first_target + len(counts)] = counts
+            position = stop
+
+        target_ptr = np.concatenate([[0], np.cumsum(target_counts)])
+        block_ptr = target_ptr[
+            aligned_block_bounds(target_ptr, PAIR_BLOCK_SIZE)]
+
+        block_sources = []
+        for start, stop in zip(block_ptr[:-1], block_ptr[1:]):
+            sources_of_block, files["block_group"][start:stop] = np.unique(
+                files["source_idx"][start:stop], return_inverse=True)
+            block_sources.append(sources_of_block.astype(np.int32))
+        block_sources_ptr = np.concatenate(
+            [[0], np.cumsum([len(s) for s in block_sources])])
+
+        for values in files.values():
+            values.flush()
+        files.clear()
+        arrays = {
+            "target_ptr": target_ptr,
+            "block_ptr": block_ptr,
+            "block_sources": np.concatenate(
+                block_sources + [np.empty(0, dtype=np.int32)]),
+            "block_sources_ptr": block_sources_ptr.astype(np.int64),
+        }
+        for name, values in arrays.items():
+            with open(os.path.join(self.directory, name + ".npy.tmp"),
+                      "wb") as f:
+                np.save(f, values)
+        for name in [*dtypes, *arrays]:
+            fn = os.path.join(self.directory, name + ".npy")
+            os.replace(fn + ".tmp", fn)
+
+        logger.debug(
+            "    wrote {} pairs in {} blocks to {}".format(
+                n_pairs, len(block_ptr) - 1, self.directory))
+        return PairChunks(self.directory, sources, targets)
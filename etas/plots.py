@@ -59,7 +59,7 @@ def temporal_decay_plot(
     plot that represent other kernels.
 
     Args:
-        p_mat: dataframe containing pairs of events, columns:
+        p_mat: dataframe or PairTable containing pairs of events, columns:
             'time_distance' - the difference in time between events
             'Pij' - probability that event i triggered j
             'zeta_plus_1' - scaling factor adjusting for incompleteness
@@ -144,7 +144,7 @@ def productivity_plot(
     plot that represent other productivities.
 
     Args:
-        p_mat: dataframe containing pairs of events, columns:
+        p_mat: dataframe or PairTable containing pairs of events, columns:
             'source_magnitude' - the magnitude of the triggering event
             'Pij' - probability that event i triggered j
             'zeta_plus_1' - scaling factor adjusting for incompleteness
@@ -225,7 +225,7 @@ def spatial_decay_plot(
     plot that represent other kernels.
 
     Args:
-        p_mat: dataframe containing pairs of events, columns:
+        p_mat: dataframe or PairTable containing pairs of events, columns:
             'spatial_distance_squared' - the distance between events
             'source_magnitude' - the magnitude of the triggering event
             'Pij' - probability that event i triggered j
@@ -16,19 +16,19 @@ import logging
 import os
 import pprint
 
-import geopandas as gpd
 import numpy as np
 import pandas as pd
 from scipy.special import gamma as gamma_func
 from scipy.special import gammainccinv
 from seismostats import ForecastCatalog
-from shapely.geometry import Polygon
 
+from etas.geometry import as_region, rectangle_surface
 from etas.inversion import (ETASParameterCalculation, branching_integral,
                             branching_ratio, expected_aftershocks, haversine,
                             parameter_dict2array, round_half_up, to_days,
                             upper_gamma_ext)
 from etas.mc_b_est import simulate_magnitudes, simulate_magnitudes_from_zone
+from etas.model import FittedModel
 
 logger = logging.getLogger(__name__)
 
@@ -361,24 +361,18 @@ def generate_background_events(
     mfd_zones=None,
     zones_from_latlon=None,
 ):
-    from etas.inversion import polygon_surface, to_days
+    from etas.inversion import to_days
 
     theta = parameter_dict2array(parameters)
     theta_without_mu = theta[2:]
 
-    area = polygon_surface(polygon)
+    region = as_region(polygon)
+    area = region.area
     timewindow_length = to_days(timewindow_end - timewindow_start)
 
     # area of surrounding rectangle
-    min_lat, min_lon, max_lat, max_lon = polygon.bounds
-    coords = [
-        [min_lat, min_lon],
-        [max_lat, min_lon],
-        [max_lat, max_lon],
-        [min_lat, max_lon],
-    ]
-    rectangle = Polygon(coords)
-    rectangle_area = polygon_surface(rectangle)
+    min_lat, min_lon, max_lat, max_lon = region.bounds
+    rectangle_area = rectangle_surface(min_lat, max_lat, min_lon, max_lon)
 
     # number of background events
     expected_n_background = (
@@ -420,11 +414,7 @@ def generate_background_events(
         catalog["longitude"] = np.random.uniform(
             min_lon, max_lon, size=n_generate)
 
-    catalog = gpd.GeoDataFrame(
-        catalog, geometry=gpd.points_from_xy(
-            catalog.latitude, catalog.longitude)
-    )
-    catalog = catalog[catalog.intersects(polygon)].head(n_background)
+    catalog = region.filter(catalog).head(n_background).copy()
 
     # if not enough events fell into the polygon, do it again...
     while len(catalog) != n_background:
@@ -449,11 +439,7 @@ def generate_background_events(
         catalog["longitude"] = np.random.uniform(
             min_lon, max_lon, size=n_generate)
 
-        catalog = gpd.GeoDataFrame(
-            catalog, geometry=gpd.points_from_xy(
-                catalog.latitude, catalog.longitude)
-        )
-        catalog = catalog[catalog.intersects(polygon)].head(n_background)
+        catalog = region.filter(catalog).head(n_background).copy()
 
     # generate time, magnitude
     catalog["time"] = [
@@ -493,7 +479,7 @@ def generate_background_events(
     catalog["n_aftershocks"] = np.random.poisson(
         lam=catalog["expected_n_aftershocks"])
 
-    return catalog.drop("geometry", axis=1)
+    return catalog
 
 
 def generate_aftershocks(
@@ -599,12 +585,7 @@ def generate_aftershocks(
 
     # as_cols = ["parent", "gen_0_parent", "time", "latitude", "longitude"]
     if polygon is not None:
-        aftershocks = gpd.GeoDataFrame(
-            aftershocks,
-            geometry=gpd.points_from_xy(
-                aftershocks.latitude, aftershocks.longitude),
-        )
-        aftershocks = aftershocks[aftershocks.intersects(polygon)]
+        aftershocks = as_region(polygon).filter(aftershocks)
 
     aadf = aftershocks.reset_index(drop=True)
 
@@ -698,7 +679,7 @@ def generate_catalog(
 
     Parameters
     ----------
-    polygon : Polygon
+    polygon : Polygon or Region
         Coordinates of boundaries in which catalog is generated.
     timewindow_start : datetime
         Simulation start.
@@ -735,11 +716,12 @@ def generate_catalog(
 
     if beta_aftershock is None:
         beta_aftershock = beta_main
+    region = as_region(polygon)
 
     # generate background events
     logger.info("generating background events..")
     catalog = generate_background_events(
-        polygon,
+        region,
         timewindow_start,
         timewindow_end,
         parameters,
@@ -804,14 +786,10 @@ def generate_catalog(
         generation = generation + 1
 
     logger.info(f"\n\ntotal events simulated: {len(catalog)}")
-    catalog = gpd.GeoDataFrame(
-        catalog, geometry=gpd.points_from_xy(
-            catalog.latitude, catalog.longitude)
-    )
-    catalog = catalog[catalog.intersects(polygon)]
+    catalog = region.filter(catalog)
     logger.info(f"inside the polygon: {len(catalog)}")
 
-    return catalog.drop("geometry", axis=1)
+    return catalog
 
 
 def simulate_catalog_continuation(
@@ -851,7 +829,7 @@ def simulate_catalog_continuation(
         Start time of auxiliary catalog.
     auxiliary_end : datetime
         End time of auxiliary_catalog. start of simulation period.
-    polygon : Polygon
+    polygon : Polygon or Region
         Polygon in which events are generated.
     simulation_end : datetime
         End time of simulation period.
@@ -907,9 +885,10 @@ def simulate_catalog_continuation(
     # preparing betas
     if beta_aftershock is None:
         beta_aftershock = beta_main
+    region = as_region(polygon)
 
     background = generate_background_events(
-        polygon,
+        region,
         auxiliary_end,
         simulation_end,
         parameters,
@@ -931,15 +910,13 @@ def simulate_catalog_continuation(
     background["xi_plus_1"] = 1
 
     if induced_lats is not None:
-        from etas.inversion import polygon_surface
-
         parameters_induced = parameters.copy()
-        area = polygon_surface(polygon)
+        area = region.area
         timewindow_length = to_days(simulation_end - auxiliary_end)
         mu_induced = n_induced / (timewindow_length * area)
         parameters_induced["log10_mu"] = np.log10(mu_induced)
         induced = generate_background_events(
-            polygon,
+            region,
             auxiliary_end,
             simulation_end,
             parameters_induced,
@@ -1025,20 +1002,23 @@ def simulate_catalog_continuation(
 
         generation = generation + 1
     if filter_polygon:
-        catalog = gpd.GeoDataFrame(
-            catalog, geometry=gpd.points_from_xy(
-                catalog.latitude, catalog.longitude)
-        )
-        catalog = catalog[catalog.intersects(polygon)]
-        return catalog.drop("geometry", axis=1)
+        return region.filter(catalog)
     else:
         return catalog
 
 
 class ETASSimulation:
+    """
+    Simulates catalogs from a fitted ETAS model.
+
+    inversion_params is either a FittedModel or an ETASParameterCalculation
+    after its inversion. A FittedModel is much smaller, use it when the
+    simulation is copied or sent to other processes.
+    """
+
     def __init__(
         self,
-        inversion_params: ETASParameterCalculation,
+        inversion_params: FittedModel | ETASParameterCalculation,
         gaussian_scale: float = 0.1,
         approx_times: bool = False,
         m_max: float = None,
@@ -1056,6 +1036,7 @@ class ETASSimulation:
         self.source_events = None
 
         self.polygon = None
+        self._region = None
 
         self.m_max = m_max
         self.gaussian_scale = gaussian_scale
@@ -1105,51 +1086,22 @@ class ETASSimulation:
             )
         )
 
-    def prepare(self):
-        self.polygon = Polygon(self.inversion_params.shape_coords)
-        # Xi_plus_1 is aftershock productivity inflation factor.
-        # If not used, set to 1.
-        self.source_events = self.inversion_params.source_events.copy()
-        if "xi_plus_1" not in self.source_events.columns:
-            self.source_events["xi_plus_1"] = 1
-
-        self.catalog = pd.merge(
-            self.source_events,
-            self.inversion_params.catalog[
-                ["latitude", "longitude", "time", "magnitude"]
-            ],
-            left_index=True,
-            right_index=True,
-            how="left",
-        )
-        assert len(self.catalog) == len(self.source_events), (
-            "lost/found some sources in the merge! "
-            f"{len(self.catalog)} -- "
-            f"{len(self.source_events)}"
-        )
+    @property
+    def region(self):
+        """Region of self.polygon, built again if polygon is replaced."""
+        if self._region is None or self._region.polygon is not self.polygon:
+            self._region = as_region(self.polygon)
+        return self._region
 
-        np.testing.assert_allclose(
-            self.catalog.magnitude.min(),
-            self.inversion_params.m_ref,
-            err_msg="smallest magnitude in sources is "
-            f"{self.catalog.magnitude.min()} "
-            f"but I am supposed to simulate "
-            f"above {self.inversion_params.m_ref}",
-        )
-
-        self.target_events = self.inversion_params.target_events.query(
-            "magnitude>=@self.inversion_params.m_ref "
-            "-@self.inversion_params.delta_m/2"
-        )
-        self.target_events = gpd.GeoDataFrame(
-            self.target_events,
-            geometry=gpd.points_from_xy(
-                self.target_events.latitude, self.target_events.longitude
-            ),
-        )
-        self.target_events = self.target_events[
-            self.target_events.intersects(self.polygon)
-        ]
+    def prepare(self):
+        model = self.inversion_params
+        if not isinstance(model, FittedModel):
+            model = model.fitted_model()
+        self._region = model.region
+        self.polygon = self._region.polygon
+        self.source_events = model.catalog
+        self.catalog = model.catalog
+        self.target_events = model.target_events
 
         self.background_lats = self.target_events["latitude"]
         self.background_lons = self.target_events["longitude"]
@@ -1191,7 +1143,7 @@ class ETASSimulation:
                 self.catalog,
                 auxiliary_start=self.inversion_params.auxiliary_start,
                 auxiliary_end=self.forecast_start_date,
-                polygon=self.polygon,
+                polygon=self.region,
                 simulation_end=self.forecast_end_date,
                 parameters=self.inversion_params.theta,
                 mc=(self.inversion_params.m_ref
@@ -1246,14 +1198,7 @@ class ETASSimulation:
 
                 # now filter polygon
                 if filter_polygon:
-                    simulations = gpd.GeoDataFrame(
-                        simulations,
-                        geometry=gpd.points_from_xy(
-                            simulations.latitude, simulations.longitude
-                        ),
-                    )
-                    simulations = simulations[simulations.intersects(
-                        self.polygon)]
+                    simulations = self.region.filter(simulations)
 
                 yield simulations[cols]
 
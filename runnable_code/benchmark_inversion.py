@@ -0,0 +1,404 @@
+##############################################################################
+# benchmarks for the ETAS parameter inversion
+#
+# synthetic catalogs of increasing size are generated (uniform in space and
+# time, Gutenberg-Richter magnitudes), and the run time of the different
+# steps of the inversion is measured. the region grows with the number of
+# events, such that the density of events (and the number of pairs per
+# event) stays the same.
+##############################################################################
+
+import datetime as dt
+import json
+import logging
+import os
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from scipy.spatial import ConvexHull
+
+from etas import set_up_logger
+from etas.geometry import Region
+from etas.inversion import (ETASParameterCalculation, create_initial_values,
+                            in_convex_hull, in_hull, parameter_array2dict,
+                            parameter_dict2array, read_catalog,
+                            read_shape_coords, write_catalog)
+from etas.simulation import generate_catalog
+
+set_up_logger(level=logging.WARNING)
+
+THETA_0 = {
+    "log10_mu": -5.8,
+    "log10_k0": -2.6,
+    "a": 1.8,
+    "log10_c": -2.5,
+    "omega": -0.02,
+    "log10_tau": 3.5,
+    "log10_d": -0.85,
+    "gamma": 1.3,
+    "rho": 0.66,
+}
+
+
+def region_width(n_events):
+    # longitude extent of the region, 1000 events per square degree
+    return n_events / 10000
+
+
+def synthetic_catalog(n_events, seed=0):
+    rng = np.random.default_rng(seed)
+    catalog = pd.DataFrame({
+        "time": pd.Timestamp("1980-01-01") + pd.to_timedelta(
+            np.sort(rng.uniform(0, 40 * 365.25, n_events)), unit="D"),
+        "latitude": rng.uniform(32, 42, n_events),
+        "longitude": rng.uniform(-170, -170 + region_width(n_events),
+                                 n_events),
+        "magnitude": 3.0 + rng.exponential(1 / 2.3, n_events),
+    })
+    catalog.index.name = "id"
+    return catalog
+
+
+def synthetic_3d_catalog(n_events, seed=0):
+    # events in a box of 20 x 20 x 10 km, around the hull of
+    # synthetic_3d_region
+    rng = np.random.default_rng(seed)
+    catalog = pd.DataFrame({
+        "time": pd.Timestamp("1980-01-01") + pd.to_timedelta(
+            np.sort(rng.uniform(0, 40 * 365.25, n_events)), unit="D"),
+        "x": rng.uniform(-10, 10, n_events),
+        "y": rng.uniform(-10, 10, n_events),
+        "z": rng.uniform(0, 10, n_events),
+        "magnitude": 3.0 + rng.exponential(1 / 2.3, n_events),
+    })
+    catalog.index.name = "id"
+    return catalog
+
+
+def synthetic_3d_region(n_points=50, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, [4, 4, 2], size=(n_points, 3)) + [0, 0, 5]
+
+
+def synthetic_calculation(n_events, seed=0, **settings):
+    # settings replace or extend the metadata below
+    lon_max = -170 + region_width(n_events)
+    metadata = {
+        "catalog": synthetic_catalog(n_events, seed),
+        "auxiliary_start": "1980-01-01",
+        "timewindow_start": "1985-01-01",
+        "timewindow_end": "2020-01-01",
+        "mc": 3.0,
+        "delta_m": 0.1,
+        "coppersmith_multiplier": 10,
+        "shape_coords": [
+            [32, -170], [42, -170], [42, lon_max], [32, lon_max]],
+        "theta_0": THETA_0,
+    }
+    metadata.update(settings)
+    return ETASParameterCalculation(metadata)
+
+
+def benchmark_distances(sizes):
+    print("calculate_distances")
+    for n_events in sizes:
+        calculation = synthetic_calculation(n_events)
+        calculation.catalog = calculation.filter_catalog(calculation.catalog)
+        start = dt.datetime.now()
+        distances = calculation.calculate_distances()
+        print("  {:>8d} events, {:>10d} pairs: {}".format(
+            n_events, len(distances), dt.datetime.now() - start))
+
+
+def benchmark_hull_filter(sizes, n_linprog=2000):
+    print("three_dim region filter, in_hull (linprog) and in_convex_hull")
+    shape_coords = synthetic_3d_region()
+    hull = ConvexHull(shape_coords)
+    for n_events in sizes:
+        coordinates = synthetic_3d_catalog(n_events)[["x", "y", "z"]]
+        # vertices and centroids of facets are on the boundary
+        coordinates = np.concatenate([
+            hull.points[hull.vertices],
+            hull.points[hull.simplices].mean(axis=1),
+            coordinates.to_numpy(),
+        ])
+        start = dt.datetime.now()
+        inside = in_convex_hull(hull, coordinates)
+        vectorized_time = dt.datetime.now() - start
+
+        # linprog is evaluated on the first n_linprog events only
+        n = min(n_linprog, len(coordinates))
+        start = dt.datetime.now()
+        inside_linprog = [in_hull(shape_coords, x) for x in coordinates[:n]]
+        linprog_time = (dt.datetime.now() - start) * len(coordinates) / n
+        print("  {:>8d} events: in_hull {} (extrapolated), in_convex_hull {}, "
+              "{} of {} differ".format(
+                  n_events, linprog_time, vectorized_time,
+                  np.sum(inside[:n] != inside_linprog), n))
+
+
+def benchmark_region_filter(fn_config, sizes):
+    print("region filter, GeoDataFrame.intersects and Region.contains")
+    with open(fn_config, "r") as f:
+        calculation = ETASParameterCalculation(json.load(f))
+    region = Region(calculation.shape_coords)
+    min_lat, min_lon, max_lat, max_lon = region.bounds
+    for n_events in sizes:
+        rng = np.random.default_rng(0)
+        # vertices of the polygon are on the boundary
+        latitude = np.concatenate([
+            calculation.shape_coords[:, 0],
+            rng.uniform(min_lat - 1, max_lat + 1, n_events),
+        ])
+        longitude = np.concatenate([
+            calculation.shape_coords[:, 1],
+            rng.uniform(min_lon - 1, max_lon + 1, n_events),
+        ])
+        start = dt.datetime.now()
+        points = gpd.GeoSeries(gpd.points_from_xy(latitude, longitude))
+        inside_gpd = points.intersects(region.polygon).to_numpy()
+        gpd_time = dt.datetime.now() - start
+
+        # the raster is built on the first call for many points
+        region = Region(calculation.shape_coords)
+        start = dt.datetime.now()
+        inside = region.contains(latitude, longitude)
+        region_time = dt.datetime.now() - start
+        print("  {:>8d} events: GeoDataFrame {}, Region {}, "
+              "{} differ".format(
+                  n_events, gpd_time, region_time,
+                  np.sum(inside != inside_gpd)))
+
+
+def benchmark_expectation_step(sizes, n_iterations=5):
+    print("expectation_step (per iteration)")
+    for n_events in sizes:
+        calculation = synthetic_calculation(n_events)
+        calculation.prepare()
+        theta = parameter_dict2array(THETA_0)
+        mc_min = calculation.m_ref - calculation.delta_m / 2
+        start = dt.datetime.now()
+        for _ in range(n_iterations):
+            calculation.expectation_step(theta, mc_min)
+        print("  {:>8d} events, {:>10d} pairs: {}".format(
+            n_events, len(calculation.distances),
+            (dt.datetime.now() - start) / n_iterations))
+
+
+def benchmark_em_acceleration(fn_configs):
+    print("invert, plain and accelerated EM")
+    for fn_config in fn_configs:
+        with open(fn_config, 'r') as f:
+            inversion_config = json.load(f)
+        for accelerate_em in [False, True]:
+            inversion_config["accelerate_em"] = accelerate_em
+            calculation = ETASParameterCalculation(inversion_config)
+            calculation.prepare()
+            start = dt.datetime.now()
+            calculation.invert()
+            print("  {}, accelerate_em={}: {} iterations, {}".format(
+                fn_config, accelerate_em, calculation.i,
+                dt.datetime.now() - start))
+
+
+def benchmark_minibatch(fn_configs, minibatch_sizes, n_random_starts=2):
+    # from the initial values of the config, and from random initial
+    # values, which are far from the solution
+    print("invert, full and mini-batch EM")
+    for fn_config in fn_configs:
+        with open(fn_config, 'r') as f:
+            inversion_config = json.load(f)
+        rng = np.random.default_rng(0)
+        starts = [("theta_0", inversion_config["theta_0"])] + [
+            ("random", parameter_array2dict(create_initial_values(rng=rng)))
+            for _ in range(n_random_starts)
+        ]
+        for name, theta_0 in starts:
+            results = []
+            for minibatch_size in [None] + minibatch_sizes:
+                calculation = ETASParameterCalculation({
+                    **inversion_config,
+                    "theta_0": theta_0,
+                    "minibatch_size": minibatch_size,
+                    "minibatch_seed": 0,
+                })
+                calculation.prepare()
+                start = dt.datetime.now()
+                theta = calculation.invert()
+                duration = dt.datetime.now() - start
+                results.append(
+                    parameter_dict2array(theta)[2:].astype(float))
+                print("  {}, {}, minibatch_size={}: {} mini-batch and {} "
+                      "full iterations, {}, maximum difference of "
+                      "parameters to full EM: {}".format(
+                          fn_config, name, minibatch_size,
+                          len(calculation.minibatch_sizes or []),
+                          calculation.i, duration,
+                          np.max(np.abs(results[-1] - results[0]))))
+
+
+def simulated_catalog(fn_config, mc_simulation, seed=0):
+    # ETAS catalog in the region and time window of the config, simulated
+    # with its initial values down to mc_simulation
+    with open(fn_config, 'r') as f:
+        inversion_config = json.load(f)
+    np.random.seed(seed)
+    catalog = generate_catalog(
+        Region(read_shape_coords(inversion_config["shape_coords"])),
+        pd.to_datetime(inversion_config["auxiliary_start"]),
+        pd.to_datetime(inversion_config["timewindow_end"]),
+        inversion_config["theta_0"],
+        mc_simulation,
+        np.log(10),
+        delta_m=0.1,
+    )
+    catalog = catalog[["latitude", "longitude", "time", "magnitude"]]
+    catalog.index.name = "id"
+    return catalog
+
+
+def benchmark_minibatch_simulated(fn_config, mc, minibatch_sizes,
+                                  mc_simulation=3.0):
+    # many pairs per target event and many EM iterations, the case in
+    # which mini-batches pay off
+    print("invert a simulated catalog, full and mini-batch EM")
+    with open(fn_config, 'r') as f:
+        inversion_config = json.load(f)
+    catalog = simulated_catalog(fn_config, mc_simulation)
+    catalog = catalog[catalog["magnitude"] >= mc - 0.05]
+    results = []
+    for minibatch_size in [None] + minibatch_sizes:
+        calculation = ETASParameterCalculation({
+            **inversion_config,
+            "catalog": catalog,
+            "mc": mc,
+            "minibatch_size": minibatch_size,
+            "minibatch_seed": 0,
+        })
+        calculation.prepare()
+        start = dt.datetime.now()
+        theta = calculation.invert()
+        duration = dt.datetime.now() - start
+        results.append(parameter_dict2array(theta)[2:].astype(float))
+        print("  {} target events, {} pairs, minibatch_size={}: {} "
+              "mini-batch and {} full iterations, {}, maximum difference "
+              "of parameters to full EM: {}".format(
+                  len(calculation.target_events),
+                  len(calculation.distances), minibatch_size,
+                  len(calculation.minibatch_sizes or []), calculation.i,
+                  duration, np.max(np.abs(results[-1] - results[0]))))
+
+
+def benchmark_catalog_formats(
+        sizes, formats=("csv", "parquet", "feather", "npz")):
+    print("reading catalogs with string ids and a column of bg_term")
+    for n_events in sizes:
+        catalog = synthetic_catalog(n_events)
+        catalog.index = "event_" + catalog.index.astype(str)
+        catalog.index.name = "id"
+        catalog["bg_weight"] = np.linspace(1, 2, n_events)
+        with tempfile.TemporaryDirectory() as directory:
+            for file_format in formats:
+                fn = os.path.join(directory, "catalog." + file_format)
+                if file_format == "csv":
+                    catalog.to_csv(fn)
+                else:
+                    write_catalog(catalog, fn, columns=["bg_weight"])
+                start = dt.datetime.now()
+                read = read_catalog(fn, columns=["bg_weight"])
+                duration = dt.datetime.now() - start
+                pd.testing.assert_frame_equal(read, catalog[read.columns])
+                print("  {} events, {}: {}".format(
+                    n_events, file_format, duration))
+
+
+def check_catalog_formats_bg_term(
+        n_events, formats=("parquet", "feather", "npz")):
+    # the column of bg_term is read from columnar catalogs
+    catalog = synthetic_catalog(n_events)
+    catalog["bg_weight"] = np.linspace(1, 2, n_events)
+    expected = synthetic_calculation(
+        n_events, catalog=catalog, bg_term="bg_weight")
+    expected.prepare()
+    with tempfile.TemporaryDirectory() as directory:
+        for file_format in formats:
+            fn = os.path.join(directory, "catalog." + file_format)
+            write_catalog(catalog, fn, columns=["bg_weight"])
+            calculation = synthetic_calculation(
+                n_events, catalog=None, fn_catalog=fn, bg_term="bg_weight")
+            calculation.prepare()
+            pd.testing.assert_series_equal(
+                calculation.target_events["bg_term"],
+                expected.target_events["bg_term"])
+    print("bg_term of columnar catalogs: ok")
+
+
+def benchmark_workers(n_events, worker_counts, n_iterations=3):
+    print("expectation step and M-step with n_workers, {} events".format(
+        n_events))
+    calculation = synthetic_calculation(n_events)
+    calculation.prepare()
+    theta = parameter_dict2array(THETA_0)
+    for n_workers in worker_counts:
+        calculation.n_workers = n_workers
+        start = dt.datetime.now()
+        for _ in range(n_iterations):
+            calculation.update_expectation(theta)
+        expectation_time = (dt.datetime.now() - start) / n_iterations
+        start = dt.datetime.now()
+        calculation.optimize_parameters(theta)
+        print("  n_workers={}: expectation step {}, M-step {}".format(
+            n_workers, expectation_time, dt.datetime.now() - start))
+
+
+def benchmark_m_step(n_events, fn_configs):
+    print("M-step, joint and block_coordinate")
+    calculation = synthetic_calculation(n_events)
+    calculation.prepare()
+    calculations = [("{} events".format(n_events), calculation)]
+    for fn_config in fn_configs:
+        with open(fn_config, 'r') as f:
+            calculation = ETASParameterCalculation(json.load(f))
+        calculation.prepare()
+        calculations.append((fn_config, calculation))
+    for name, calculation in calculations:
+        theta = parameter_dict2array(calculation.theta_0)[-10:]
+        calculation.update_expectation(theta)
+        results = []
+        for m_step in ["joint", "block_coordinate"]:
+            calculation.m_step = m_step
+            start = dt.datetime.now()
+            results.append(
+                calculation.optimize_parameters(theta)[2:].astype(float))
+            print("  {}, m_step={}: {}".format(
+                name, m_step, dt.datetime.now() - start))
+        print("  maximum difference of parameters: {}".format(
+            np.max(np.abs(results[0] - results[1]))))
+
+
+if __name__ == '__main__':
+    benchmark_distances([1000, 10000, 100000, 1000000])
+    benchmark_hull_filter([1000, 10000, 100000, 1000000])
+    benchmark_region_filter(
+        "../config/invert_etas_config.json",
+        [1000, 10000, 100000, 1000000])
+    benchmark_catalog_formats([10000, 1000000])
+    check_catalog_formats_bg_term(10000)
+    benchmark_expectation_step([1000, 10000, 100000, 300000])
+    benchmark_em_acceleration([
+        "../config/invert_etas_config.json",
+        "../config/ch_forecast_config.json",
+    ])
+    benchmark_minibatch([
+        "../config/invert_etas_config.json",
+        "../config/ch_forecast_config.json",
+    ], [300, 1000])
+    benchmark_minibatch_simulated(
+        "../config/invert_etas_config.json", 5.0, [1000])
+    benchmark_workers(300000, [None, 1, 2, 4, 8, 16])
+    benchmark_m_step(300000, [
+        "../config/invert_etas_config.json",
+        "../config/invert_etas_with_constraints.json",
+    ])
@@ -0,0 +1,28 @@
+import json
+import logging
+
+from etas import set_up_logger
+from etas.bootstrap import bootstrap_inversion, bootstrap_summary
+
+set_up_logger(level=logging.INFO)
+
+if __name__ == '__main__':
+    # reads configuration for example ETAS parameter inversion
+    with open("../config/invert_etas_config.json", 'r') as f:
+        inversion_config = json.load(f)
+
+    # parameters and beta as estimated by invert_etas.py
+    with open("../output_data/parameters_0.json", 'r') as f:
+        inversion_output = json.load(f)
+
+    # simulates 20 catalogs from the estimated parameters and inverts them.
+    # if interrupted, running this again only inverts the missing catalogs
+    results = bootstrap_inversion(
+        inversion_config,
+        inversion_output["final_parameters"],
+        n_catalogs=20,
+        fn_results="../output_data/bootstrap_0.jsonl",
+        beta=inversion_output["beta"],
+        seed=777,
+    )
+    print(bootstrap_summary(results))